@@ -0,0 +1,275 @@
+"""Sincronizzazione di più account Dexcom nello stesso processo.
+
+Ogni account ha la propria sessione Share (``get_shared_client``), il proprio
+storico in memoria, le proprie regole con cooldown e i propri destinatari
+Telegram; le glicemie finiscono nel database MongoDB dell'account, usando
+però un solo ``MongoClient`` (e quindi un solo pool di connessioni) per tutti.
+
+Le letture sono job APScheduler in un executor dedicato con pochi thread:
+la concorrenza resta limitata anche con centinaia di account. L'istante di
+ogni job dipende da un hash dell'id dell'account, così le letture sono
+distribuite su tutto l'intervallo e restano nella stessa posizione dopo un
+riavvio o una ricarica dell'elenco.
+"""
+
+import json
+import os
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from pymongo.errors import OperationFailure
+
+from alert_rules import RuleEngine
+from daily_stats import ensure_stats_indexes, update_daily_stats
+from dexcom_g7 import DexcomG7Client, get_shared_client
+from glucose_history import GlucoseHistory
+from nightscout_entries import EntryWriter, build_entry, ensure_indexes
+
+SYNC_INTERVAL = 300
+DEFAULT_WORKERS = 4
+EXECUTOR = "account"
+JOBSTORE = "memoria"
+JOB_PREFIX = "sync-account-"
+
+
+@dataclass(frozen=True)
+class Account:
+    id: str
+    username: str
+    password: str = field(repr=False)
+    region: str = "OUS"
+    name: str = ""
+    chat_ids: Tuple[str, ...] = ()
+    database: str = ""
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Account":
+        account_id = str(data.get("id") or data.get("_id") or "").strip()
+        if not account_id:
+            raise ValueError("Ogni account richiede un id")
+        for required in ("username", "password"):
+            if not data.get(required):
+                raise ValueError(f"L'account {account_id} richiede {required}")
+        chat_ids = data.get("chat_ids") or ()
+        if isinstance(chat_ids, str):
+            chat_ids = chat_ids.split(",")
+        return cls(
+            id=account_id,
+            username=data["username"],
+            password=data["password"],
+            region=data.get("region", "OUS"),
+            name=data.get("name") or account_id,
+            chat_ids=tuple(str(c).strip() for c in chat_ids if str(c).strip()),
+            database=data.get("database") or f"nightscout_{account_id}",
+        )
+
+    def offset(self, interval: float) -> float:
+        """Posizione fissa dell'account nel ciclo di ``interval`` secondi."""
+
+        return (zlib.crc32(self.id.encode()) % 10_000) / 10_000 * interval
+
+
+def load_accounts(path: Optional[str] = None, collection=None) -> List[Account]:
+    """Account da un file JSON (``ACCOUNTS_FILE``) oppure dalla collection Mongo.
+
+    Il file contiene una lista di oggetti con ``id``, ``username``,
+    ``password`` e facoltativi ``region``, ``name``, ``chat_ids``,
+    ``database``; senza ``chat_ids`` gli allarmi vanno alle chat predefinite
+    del notificatore. Nella collection gli account con ``enabled: false`` sono
+    ignorati. Un account non valido viene segnalato e saltato, senza
+    fermare gli altri.
+    """
+
+    path = path or os.getenv("ACCOUNTS_FILE")
+    if path:
+        with open(path, encoding="utf-8") as f:
+            docs = json.load(f)
+    elif collection is not None:
+        docs = list(collection.find({"enabled": {"$ne": False}}))
+    else:
+        return []
+    accounts = []
+    for index, doc in enumerate(docs):
+        try:
+            accounts.append(Account.from_dict(doc))
+        except (AttributeError, TypeError, ValueError) as e:
+            print(f"❌ Account {index + 1} ignorato: {e}")
+    return accounts
+
+
+class AccountSync:
+    """Stato e ciclo di lettura di un singolo account."""
+
+    def __init__(self, account: Account, mongo_client, notify: Callable[[str, Optional[Tuple[str, ...]]], object],
+                 tz, rules_config: Optional[dict] = None,
+                 client_factory: Callable[[Account], DexcomG7Client] = None):
+        self.account = account
+        self._notify = notify
+        self._tz = tz
+        database = mongo_client[account.database]
+        self.entries = database.entries
+        self.daily_stats = database.daily_stats
+        self.writer = EntryWriter(self.entries)
+        factory = client_factory or (lambda a: get_shared_client(a.username, a.password, a.region))
+        self.client = factory(account)
+        self.history = GlucoseHistory()
+        self.rules = RuleEngine(rules_config)
+        self.cooldown = self.rules.new_cooldown()
+        self.active: set = set()
+        self._lock = threading.Lock()
+        self._ready = False
+        self.polls = 0
+        self.errors = 0
+        self.alerts = 0
+        self.last_poll: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def _prepare(self):
+        """Indici e storico in memoria, una sola volta alla prima lettura."""
+
+        ensure_stats_indexes(self.daily_stats)
+        try:
+            ensure_indexes(self.entries)
+        except OperationFailure as e:
+            # Duplicati già presenti: gli upsert restano idempotenti anche senza indice univoco
+            print(f"⚠️ Indice univoco non creato per l'account {self.account.id}: {e}")
+        self.history.seed(self.entries.find(
+            {"type": "sgv"}, {"sgv": 1, "direction": 1, "date": 1}
+        ).sort("date", -1).limit(self.history.capacity))
+        self._ready = True
+
+    def poll(self) -> bool:
+        """Legge Share, salva la glicemia e valuta le regole; True se la lettura è nuova."""
+
+        # max_instances=1 nello scheduler evita già le sovrapposizioni: il lock protegge le chiamate dirette
+        with self._lock:
+            self.polls += 1
+            self.last_poll = time.time()
+            try:
+                if not self._ready:
+                    self._prepare()
+                reading = self.client.cache.get().reading
+                if reading is None:
+                    return False
+                value = float(reading.value)
+                trend = reading.trend_arrow or "Flat"
+                self.writer.add(build_entry(value, reading.time, trend))
+                report = self.writer.flush()
+                if report.inserted_entries:
+                    update_daily_stats(self.daily_stats, report.inserted_entries, self._tz)
+                if not self.history.append(value, trend, int(reading.time.timestamp() * 1000)):
+                    return False
+                self._evaluate()
+                return True
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                print(f"❌ Errore sincronizzazione account {self.account.id}: {e}")
+                return False
+
+    def _evaluate(self):
+        evaluation = self.rules.evaluate(self.history)
+        now = time.time()
+        if evaluation.reset:
+            for code in self.active:
+                self.cooldown.reset(code)
+            self.active.clear()
+        fired = evaluation.alerts + ((evaluation.predicted,) if evaluation.predicted else ())
+        for rule in fired:
+            if not self.cooldown.allow(rule.code, now):
+                continue
+            self.cooldown.record(rule.code, now)
+            self.active.add(rule.code)
+            self.alerts += 1
+            # None: nessuna chat propria, il notificatore usa quelle predefinite
+            self._notify(f"🚨 {self.account.name}: {rule.title}\n{rule.message}", self.account.chat_ids or None)
+
+    def status(self) -> dict:
+        return {
+            "id": self.account.id,
+            "name": self.account.name,
+            "database": self.account.database,
+            "polls": self.polls,
+            "errors": self.errors,
+            "alerts": self.alerts,
+            "last_poll": self.last_poll,
+            "last_error": self.last_error,
+            "last_reading": self.history.date(-1) if len(self.history) else None,
+            "active_alerts": sorted(self.active),
+        }
+
+
+class SyncEngine:
+    """Registra un job per account nello scheduler, sfalsati sull'intervallo."""
+
+    def __init__(self, scheduler, factory: Callable[[Account], AccountSync], interval: float = SYNC_INTERVAL):
+        self.scheduler = scheduler
+        self.interval = interval
+        self._factory = factory
+        self._accounts: Dict[str, AccountSync] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._accounts)
+
+    def get(self, account_id: str) -> Optional[AccountSync]:
+        return self._accounts.get(account_id)
+
+    def update(self, accounts: Iterable[Account], now: Optional[datetime] = None) -> Tuple[int, int]:
+        """Allinea i job all'elenco ``accounts``; restituisce (aggiunti, rimossi).
+
+        Un account con credenziali o destinatari cambiati viene ricreato da capo;
+        se la creazione fallisce (per esempio una regione sconosciuta) l'account
+        resta fuori fino al prossimo aggiornamento, senza toccare gli altri.
+        """
+
+        now = now or datetime.now(timezone.utc)
+        wanted = {account.id: account for account in accounts}
+        added = removed = 0
+        with self._lock:
+            for account_id in list(self._accounts):
+                current = self._accounts[account_id].account
+                if wanted.get(account_id) != current:
+                    self._remove(account_id)
+                    removed += 1
+            for account_id, account in wanted.items():
+                if account_id in self._accounts:
+                    continue
+                try:
+                    self._add(account, now)
+                except Exception as e:
+                    self._accounts.pop(account_id, None)
+                    print(f"❌ Account {account_id} non avviato: {e}")
+                    continue
+                added += 1
+        return added, removed
+
+    def _add(self, account: Account, now: datetime):
+        sync = self._factory(account)
+        self._accounts[account.id] = sync
+        # Prima lettura nella posizione dell'account nel ciclo, poi ogni ``interval``
+        offset = account.offset(self.interval)
+        elapsed = now.timestamp() % self.interval
+        delay = (offset - elapsed) % self.interval
+        self.scheduler.add_job(
+            sync.poll, "interval", seconds=self.interval,
+            next_run_time=now + timedelta(seconds=delay),
+            id=JOB_PREFIX + account.id, jobstore=JOBSTORE, executor=EXECUTOR,
+            replace_existing=True, max_instances=1, coalesce=True, misfire_grace_time=int(self.interval),
+        )
+
+    def _remove(self, account_id: str):
+        self._accounts.pop(account_id, None)
+        try:
+            self.scheduler.remove_job(JOB_PREFIX + account_id, jobstore=JOBSTORE)
+        except Exception:
+            pass
+
+    def status(self) -> List[dict]:
+        with self._lock:
+            syncs = list(self._accounts.values())
+        return [sync.status() for sync in syncs]
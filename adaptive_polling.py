@@ -0,0 +1,169 @@
+"""Letture di Share allineate al ciclo di pubblicazione del sensore.
+
+Il G7 pubblica un valore ogni 5 minuti sempre nella stessa fase: l'orario
+della lettura (``G7Reading.time``) più ``READING_INTERVAL`` indica quando
+arriverà la successiva, a cui si somma il ritardo con cui Share la rende
+disponibile. ``PublishSchedule`` stima quel ritardo come il minimo dei ritardi
+osservati di recente e programma la lettura subito dopo la pubblicazione
+attesa; se il valore non c'è ancora riprova a breve, fino a metà dello slot,
+poi passa a quello successivo. Con il sensore muto (riscaldamento, perdita di
+segnale) gli slot saltati raddoppiano fino a ``MAX_SKIP``; con Share in errore
+l'attesa raddoppia da ``ERROR_BACKOFF`` a ``ERROR_BACKOFF_MAX`` secondi.
+
+Il ritardo di acquisizione di ogni lettura (ora della lettura → momento in cui
+la vediamo) finisce nell'istogramma ``glucose_ingest_lag_seconds``.
+"""
+
+import math
+import statistics
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+import metrics
+from dexcom_g7 import PUBLISH_GRACE, READING_INTERVAL
+
+RETRY_DELAYS = (10, 15, 30)
+# Un'ora di letture per stimare il ritardo di pubblicazione
+LAG_WINDOW = 12
+# Con il sensore muto si controlla comunque almeno ogni 30 minuti
+MAX_SKIP = 6
+ERROR_BACKOFF = 30
+ERROR_BACKOFF_MAX = 900
+MIN_DELAY = 1.0
+INGEST_SAMPLES = 288
+
+INGEST_LAG = metrics.histogram("glucose_ingest_lag_seconds",
+                               "Ritardo tra l'orario di una glicemia e la sua acquisizione",
+                               buckets=(5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300, 600))
+POLLS = metrics.counter("dexcom_polls_total", "Letture del ciclo di sincronizzazione per esito",
+                        labels=("outcome",))
+
+
+@dataclass(frozen=True)
+class Plan:
+    delay: float
+    reason: str
+
+
+class PublishSchedule:
+    """Decide quando rileggere Share in base all'ultima lettura vista."""
+
+    def __init__(
+        self,
+        interval: float = READING_INTERVAL,
+        publish_delay: float = PUBLISH_GRACE,
+        retry_delays=RETRY_DELAYS,
+        max_skip: int = MAX_SKIP,
+        error_backoff: float = ERROR_BACKOFF,
+        error_backoff_max: float = ERROR_BACKOFF_MAX,
+        lag_window: int = LAG_WINDOW,
+    ):
+        self.interval = interval
+        self.retry_delays = tuple(retry_delays)
+        self.max_skip = max_skip
+        self.error_backoff = error_backoff
+        self.error_backoff_max = error_backoff_max
+        self._default_delay = publish_delay
+        self._lags: deque = deque(maxlen=lag_window)
+        self._ingest: deque = deque(maxlen=INGEST_SAMPLES)
+        self._lock = threading.Lock()
+        # True se la lettura in corso era programmata su una pubblicazione attesa:
+        # solo allora il ritardo osservato misura quello di Share
+        self._aligned = False
+        self._retries = 0
+        self._misses = 0
+        self._errors = 0
+        self.last_time: Optional[float] = None
+        self.next_poll: Optional[float] = None
+        self.readings = 0
+
+    @property
+    def publish_delay(self) -> float:
+        """Ritardo stimato tra l'orario di una lettura e la sua comparsa su Share."""
+
+        return min(self._lags) if self._lags else self._default_delay
+
+    def expected_publish(self, now: float) -> Optional[float]:
+        """Prima pubblicazione attesa dopo ``now``, None prima della prima lettura."""
+
+        if self.last_time is None:
+            return None
+        delay = self.publish_delay
+        slots = max(1, math.floor((now - self.last_time - delay) / self.interval) + 1)
+        return self.last_time + slots * self.interval + delay
+
+    def _plan(self, now: float, delay: float, reason: str, aligned: bool) -> Plan:
+        delay = max(MIN_DELAY, delay)
+        self.next_poll = now + delay
+        self._aligned = aligned
+        return Plan(delay, reason)
+
+    def on_reading(self, reading_time: Optional[float], now: float) -> Plan:
+        """Esito di una lettura riuscita: ``reading_time`` è l'orario del valore (epoch), se c'è."""
+
+        with self._lock:
+            self._errors = 0
+            if reading_time is not None and (self.last_time is None or reading_time > self.last_time):
+                POLLS.inc("new")
+                lag = max(0.0, now - reading_time)
+                if self._aligned and lag < self.interval:
+                    self._lags.append(lag)
+                self._ingest.append(lag)
+                INGEST_LAG.observe(lag)
+                self.readings += 1
+                self.last_time = reading_time
+                self._retries = self._misses = 0
+                return self._plan(now, self.expected_publish(now) - now, "new", True)
+
+            POLLS.inc("unchanged")
+            if self.last_time is None:
+                # Nessun valore su Share: sensore in riscaldamento o account appena collegato
+                self._misses += 1
+                skip = min(self.max_skip, 2 ** (self._misses - 1))
+                return self._plan(now, skip * self.interval, "no-data", False)
+
+            expected = self.expected_publish(now)
+            if expected - self.interval < self.last_time + self.interval:
+                # Nessuna pubblicazione ancora dovuta: siamo in anticipo
+                return self._plan(now, expected - now, "early", True)
+            if self.retry_delays:
+                # Età del valore mancante: si insiste fino a metà del suo slot,
+                # così un ritardo di Share più lungo della stima viene imparato
+                missing = expected - self.interval - self.publish_delay
+                delay = self.retry_delays[min(self._retries, len(self.retry_delays) - 1)]
+                if self._retries < len(self.retry_delays) or now + delay - missing < self.interval / 2:
+                    self._retries += 1
+                    return self._plan(now, delay, "retry", True)
+
+            # Slot perso: si salta a quelli successivi, sempre più distanti
+            self._retries = 0
+            self._misses += 1
+            skip = min(self.max_skip, 2 ** (self._misses - 1))
+            return self._plan(now, expected + (skip - 1) * self.interval - now, "missed", True)
+
+    def on_error(self, now: float) -> Plan:
+        """Share non ha risposto: attesa esponenziale, senza toccare la fase stimata."""
+
+        with self._lock:
+            POLLS.inc("error")
+            self._errors += 1
+            delay = min(self.error_backoff_max, self.error_backoff * 2 ** (self._errors - 1))
+            return self._plan(now, delay, "error", False)
+
+    def status(self) -> dict:
+        with self._lock:
+            ingest = list(self._ingest)
+            return {
+                "last_reading": self.last_time,
+                "next_poll": self.next_poll,
+                "publish_delay": self.publish_delay,
+                "readings": self.readings,
+                "retries": self._retries,
+                "missed_slots": self._misses,
+                "errors": self._errors,
+                "ingest_lag_last": ingest[-1] if ingest else None,
+                "ingest_lag_median": statistics.median(ingest) if ingest else None,
+                "ingest_lag_mean": statistics.fmean(ingest) if ingest else None,
+            }
@@ -0,0 +1,153 @@
+"""Ambulatory Glucose Profile (AGP) calcolato con NumPy.
+
+Le glicemie di 14-90 giorni vengono lette da MongoDB solo come colonne
+``date``/``sgv`` (proiezione e cursore a blocchi) e tenute in due array.
+Percentili per fascia oraria, tempo in range ed episodi di ipo/iperglicemia
+sono calcolati in forma vettoriale, senza costruire un dizionario per
+lettura.
+"""
+
+from array import array
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+PERCENTILES = (5, 25, 50, 75, 95)
+DEFAULT_BIN_MINUTES = 15
+LOAD_BATCH_SIZE = 5000
+HYPO_THRESHOLD = 70
+HYPER_THRESHOLD = 180
+# Un episodio dura almeno 15 minuti; un buco di più di 15 minuti lo interrompe
+EPISODE_MIN_MS = 15 * 60 * 1000
+EPISODE_MAX_GAP_MS = 15 * 60 * 1000
+
+
+def load_series(collection, start_ms: int, end_ms: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Colonne ``date`` (int64, ms) e ``sgv`` (float64) ordinate per data."""
+
+    dates = array("q")
+    values = array("d")
+    cursor = collection.find(
+        {"type": "sgv", "date": {"$gte": start_ms, "$lt": end_ms}},
+        {"_id": 0, "date": 1, "sgv": 1},
+    ).sort("date", 1).batch_size(LOAD_BATCH_SIZE)
+    try:
+        for doc in cursor:
+            dates.append(doc["date"])
+            values.append(doc["sgv"])
+    finally:
+        cursor.close()
+    return np.frombuffer(dates, dtype=np.int64), np.frombuffer(values, dtype=np.float64)
+
+
+def local_minutes(dates: np.ndarray, tz) -> np.ndarray:
+    """Minuto del giorno nel fuso ``tz``, gestendo l'ora legale.
+
+    L'offset viene calcolato una volta per ogni ora distinta e poi applicato
+    a tutte le letture di quell'ora.
+    """
+
+    if not len(dates):
+        return np.zeros(0, dtype=np.int64)
+    hours, inverse = np.unique(dates // 3_600_000, return_inverse=True)
+    offsets = np.fromiter(
+        (datetime.fromtimestamp(int(h) * 3600, tz).utcoffset().total_seconds() * 1000 for h in hours),
+        dtype=np.int64, count=len(hours),
+    )
+    local_ms = dates + offsets[inverse]
+    return (local_ms % 86_400_000) // 60_000
+
+
+def bin_percentiles(bins: np.ndarray, values: np.ndarray, n_bins: int,
+                    percentiles=PERCENTILES) -> Tuple[np.ndarray, np.ndarray]:
+    """Percentili (interpolazione lineare, come ``np.percentile``) per ogni fascia.
+
+    Restituisce una matrice ``len(percentiles) x n_bins`` (NaN per le fasce
+    vuote) e il numero di letture per fascia.
+    """
+
+    order = np.lexsort((values, bins))
+    ordered = values[order]
+    counts = np.bincount(bins, minlength=n_bins)
+    starts = np.cumsum(counts) - counts
+    result = np.full((len(percentiles), n_bins), np.nan)
+    filled = counts > 0
+    for row, p in enumerate(percentiles):
+        position = starts[filled] + (counts[filled] - 1) * (p / 100.0)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        weight = position - low
+        result[row, filled] = ordered[low] * (1 - weight) + ordered[high] * weight
+    return result, counts
+
+
+def episodes(dates: np.ndarray, values: np.ndarray, below: float = None, above: float = None,
+             min_duration_ms: int = EPISODE_MIN_MS, max_gap_ms: int = EPISODE_MAX_GAP_MS) -> List[dict]:
+    """Episodi consecutivi sotto ``below`` (o sopra ``above``) lunghi almeno ``min_duration_ms``."""
+
+    if not len(values):
+        return []
+    mask = values < below if below is not None else values > above
+    # Un buco nei dati spezza l'episodio anche se entrambe le letture sono fuori soglia
+    gaps = np.diff(dates) > max_gap_ms
+    opens = np.ones(len(values), dtype=bool)
+    opens[1:] = ~mask[:-1] | gaps
+    closes = np.ones(len(values), dtype=bool)
+    closes[:-1] = ~mask[1:] | gaps
+    starts = np.flatnonzero(mask & opens)
+    ends = np.flatnonzero(mask & closes)
+
+    durations = dates[ends] - dates[starts]
+    keep = durations >= min_duration_ms
+    extreme_key = "nadir" if below is not None else "peak"
+    result = []
+    for start, end, duration in zip(starts[keep], ends[keep], durations[keep]):
+        segment = values[start:end + 1]
+        extreme = segment.min() if below is not None else segment.max()
+        result.append({
+            "start": int(dates[start]),
+            "end": int(dates[end]),
+            "minutes": int(duration // 60_000),
+            extreme_key: float(extreme),
+        })
+    return result
+
+
+def agp(dates: np.ndarray, values: np.ndarray, tz, bin_minutes: int = DEFAULT_BIN_MINUTES) -> Dict:
+    """Profilo AGP: percentili per fascia oraria, riepilogo ed episodi."""
+
+    n_bins = (24 * 60) // bin_minutes
+    if not len(values):
+        return {"count": 0, "bin_minutes": bin_minutes, "bins": [], "hypo": [], "hyper": []}
+
+    bins = local_minutes(dates, tz) // bin_minutes
+    table, counts = bin_percentiles(bins, values, n_bins)
+
+    profile = []
+    for index in range(n_bins):
+        minute = index * bin_minutes
+        row = {"time": f"{minute // 60:02d}:{minute % 60:02d}", "count": int(counts[index])}
+        for p, value in zip(PERCENTILES, table[:, index]):
+            row[f"p{p}"] = None if np.isnan(value) else round(float(value), 1)
+        profile.append(row)
+
+    mean = float(values.mean())
+    sd = float(values.std())
+    return {
+        "count": int(len(values)),
+        "from": int(dates[0]),
+        "to": int(dates[-1]),
+        "bin_minutes": bin_minutes,
+        "mean": round(mean, 1),
+        "cv": round(100 * sd / mean, 1) if mean else None,
+        "gmi": round(3.31 + 0.02392 * mean, 2),
+        "tir": {
+            "below_70": round(100 * float((values < HYPO_THRESHOLD).mean()), 1),
+            "in_range": round(100 * float(((values >= HYPO_THRESHOLD) & (values <= HYPER_THRESHOLD)).mean()), 1),
+            "above_180": round(100 * float((values > HYPER_THRESHOLD).mean()), 1),
+        },
+        "bins": profile,
+        "hypo": episodes(dates, values, below=HYPO_THRESHOLD),
+        "hyper": episodes(dates, values, above=HYPER_THRESHOLD),
+    }
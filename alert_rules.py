@@ -0,0 +1,441 @@
+"""Regole di allarme ipoglicemia descritte come dati.
+
+Ogni regola è un dizionario con soglie, frecce di trend e lunghezza della
+finestra; al caricamento viene compilata in una lista di condizioni. Le
+statistiche della finestra (minimo, massimo, monotonia, frecce presenti)
+vengono calcolate una sola volta per lettura, in un unico passaggio sullo
+storico, e condivise da tutte le regole.
+
+Le regole predefinite riproducono quelle storiche di ``monitor_loop``; un file
+JSON indicato da ``ALERT_RULES_FILE`` può sostituirle senza toccare il codice::
+
+    {
+      "cooldown": {"max_notifications": 2, "seconds": 1800},
+      "reset": {"value_at_least": 85, "trends": ["→", "↗", "↑", "↑↑"]},
+      "rules": [{"code": "rapida", "title": "...", "message": "...",
+                 "value_below": 90, "trends": ["↓", "↓↓"]}]
+    }
+
+La sezione facoltativa ``predictive`` attiva l'allarme di ipo prevista: la
+pendenza delle ultime letture (``glucose_forecast``) proietta la glicemia a
+``horizon_minutes`` e l'allarme scatta se la proiezione scende sotto
+``threshold`` mentre nessuna regola classica è ancora scattata.
+"""
+
+import json
+import os
+from array import array
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+from statistics import median
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from glucose_forecast import PredictiveLow
+from glucose_history import GlucoseHistory, trend_code
+
+DEFAULT_CONFIG = {
+    "cooldown": {"max_notifications": 2, "seconds": 1800},
+    "reset": {"value_at_least": 85, "trends": ["→", "↑", "↗", "↑↑"]},
+    "rules": [
+        {
+            "code": "rapida",
+            "title": "Discesa rapida",
+            "message": "Correggi subito con un succo o 3 bustine di zucchero o 3 caramelle zuccherate.",
+            "value_below": 90,
+            "trends": ["↓", "↓↓"],
+        },
+        {
+            "code": "stabile_86",
+            "title": "Glicemia stabile ma in calo",
+            "message": "Monitora attentamente.\nSe continua a scendere, interverremo.",
+            "window": 3,
+            "window_trends": ["→"],
+            "value_above": 70,
+            "value_at_most": 86,
+        },
+        {
+            "code": "stabile_70",
+            "title": "Glicemia a 70",
+            "message": "Se non hai corretto, fallo ora.\nPrendi mezzo succo o 2 bustine di zucchero.",
+            "value_equals": 70,
+            "trends": ["→"],
+        },
+        {
+            "code": "stabile_sotto70",
+            "title": "Glicemia ancora in discesa",
+            "message": "Prendi subito un succo intero.\nSe hai già corretto, attendi e monitora.",
+            "value_below": 70,
+            "trends": ["→"],
+        },
+        {
+            "code": "lenta_salto",
+            "title": "Discesa glicemica lenta",
+            "message": "Correggi subito con un succo intero o 3 bustine di zucchero.",
+            "trends": ["↘"],
+            "value_at_most": 86,
+            "previous_at_least": 90,
+        },
+        {
+            "code": "lenta_graduale",
+            "title": "Discesa lenta confermata",
+            "message": "Correggi con un succo intero o 3 bustine di zucchero.",
+            "window": 3,
+            "window_trends": ["↘"],
+            "window_max_below": 90,
+        },
+    ],
+    "predictive": {
+        "code": "prevista_ipo",
+        "title": "Ipoglicemia prevista",
+        "message": "Tra {minuti} minuti la glicemia potrebbe arrivare a {previsto} mg/dL.\n"
+                   "Valuta una piccola correzione adesso.",
+        "horizon_minutes": 20,
+        "threshold": 70,
+        "window": 4,
+        "min_slope": -0.5,
+    },
+}
+
+MIN_HISTORY = 3
+PREDICTIVE_KEYS = ("horizon_minutes", "threshold", "window", "min_slope", "min_points")
+# Un allarme classico senza altri allarmi classici nell'ora precedente apre un nuovo episodio
+LEAD_LOOKBACK_MS = 60 * 60 * 1000
+
+
+def _trend_mask(trends: Iterable[str]) -> int:
+    mask = 0
+    for trend in trends:
+        mask |= 1 << trend_code(trend)
+    return mask
+
+
+class WindowStats:
+    """Statistiche delle ultime ``k`` letture per ogni ``k`` fino a ``size``.
+
+    Gli array sono allocati una volta sola e riscritti a ogni ``update``.
+    ``minimum[k]`` è il minimo delle ultime ``k`` letture, ``decreasing[k]`` è
+    vero se le ultime ``k`` scendono strettamente, ``trends[k]`` è la maschera
+    di bit delle frecce presenti.
+    """
+
+    __slots__ = ("size", "available", "minimum", "maximum", "decreasing", "increasing", "trends")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.available = 0
+        self.minimum = array("d", bytes(8 * (size + 1)))
+        self.maximum = array("d", bytes(8 * (size + 1)))
+        self.decreasing = array("b", bytes(size + 1))
+        self.increasing = array("b", bytes(size + 1))
+        self.trends = array("q", bytes(8 * (size + 1)))
+
+    def update(self, history: GlucoseHistory):
+        self.available = available = min(self.size, len(history))
+        if not available:
+            return
+        newer = history.value(-1)
+        self.minimum[1] = self.maximum[1] = newer
+        self.decreasing[1] = self.increasing[1] = 1
+        self.trends[1] = 1 << history.trend_code(-1)
+        for k in range(2, available + 1):
+            value = history.value(-k)
+            self.minimum[k] = min(self.minimum[k - 1], value)
+            self.maximum[k] = max(self.maximum[k - 1], value)
+            self.decreasing[k] = self.decreasing[k - 1] and value > newer
+            self.increasing[k] = self.increasing[k - 1] and value < newer
+            self.trends[k] = self.trends[k - 1] | (1 << history.trend_code(-k))
+            newer = value
+
+
+Condition = Callable[[GlucoseHistory, WindowStats], bool]
+
+
+def _compile_conditions(spec: dict) -> Tuple[List[Condition], int]:
+    """Traduce le chiavi di una regola in condizioni e lunghezza di finestra richiesta."""
+
+    conditions: List[Condition] = []
+    needed = 1
+
+    if "value_below" in spec:
+        limit = spec["value_below"]
+        conditions.append(lambda h, w, limit=limit: w.minimum[1] < limit)
+    if "value_at_most" in spec:
+        limit = spec["value_at_most"]
+        conditions.append(lambda h, w, limit=limit: w.minimum[1] <= limit)
+    if "value_above" in spec:
+        limit = spec["value_above"]
+        conditions.append(lambda h, w, limit=limit: w.minimum[1] > limit)
+    if "value_at_least" in spec:
+        limit = spec["value_at_least"]
+        conditions.append(lambda h, w, limit=limit: w.minimum[1] >= limit)
+    if "value_equals" in spec:
+        limit = spec["value_equals"]
+        conditions.append(lambda h, w, limit=limit: w.minimum[1] == limit)
+    if "trends" in spec:
+        mask = _trend_mask(spec["trends"])
+        conditions.append(lambda h, w, mask=mask: w.trends[1] & ~mask == 0)
+    if "previous_at_least" in spec:
+        limit = spec["previous_at_least"]
+        needed = max(needed, 2)
+        conditions.append(lambda h, w, limit=limit: h.value(-2) >= limit)
+
+    window = spec.get("window")
+    if window:
+        needed = max(needed, window)
+        if "window_trends" in spec:
+            mask = _trend_mask(spec["window_trends"])
+            conditions.append(lambda h, w, mask=mask: w.trends[window] & ~mask == 0)
+        if "window_max_below" in spec:
+            limit = spec["window_max_below"]
+            conditions.append(lambda h, w, limit=limit: w.maximum[window] < limit)
+        if "window_min_at_least" in spec:
+            limit = spec["window_min_at_least"]
+            conditions.append(lambda h, w, limit=limit: w.minimum[window] >= limit)
+        if spec.get("window_decreasing"):
+            conditions.append(lambda h, w: w.decreasing[window])
+        if spec.get("window_increasing"):
+            conditions.append(lambda h, w: w.increasing[window])
+
+    return conditions, needed
+
+
+@dataclass(frozen=True)
+class AlertRule:
+    code: str
+    title: str
+    message: str
+    window: int
+    conditions: Tuple[Condition, ...] = field(repr=False)
+    max_notifications: Optional[int] = None
+    cooldown_seconds: Optional[float] = None
+
+    def matches(self, history: GlucoseHistory, stats: WindowStats) -> bool:
+        if stats.available < self.window:
+            return False
+        for condition in self.conditions:
+            if not condition(history, stats):
+                return False
+        return True
+
+
+def compile_rule(spec: dict) -> AlertRule:
+    conditions, window = _compile_conditions(spec)
+    return AlertRule(
+        code=spec["code"],
+        title=spec.get("title", spec["code"]),
+        message=spec.get("message", ""),
+        window=window,
+        conditions=tuple(conditions),
+        max_notifications=spec.get("max_notifications"),
+        cooldown_seconds=spec.get("cooldown_seconds"),
+    )
+
+
+class CooldownTracker:
+    """Limita ogni codice a ``max_notifications`` invii ogni ``seconds`` secondi."""
+
+    def __init__(self, max_notifications: int = 2, seconds: float = 1800,
+                 overrides: Optional[Dict[str, Tuple[int, float]]] = None):
+        self.max_notifications = max_notifications
+        self.seconds = seconds
+        self._overrides = overrides or {}
+        self._sent: Dict[str, Tuple[int, float]] = {}
+
+    def limits(self, code: str) -> Tuple[int, float]:
+        return self._overrides.get(code, (self.max_notifications, self.seconds))
+
+    def allow(self, code: str, now: float) -> bool:
+        limit, seconds = self.limits(code)
+        count, last = self._sent.get(code, (0, 0))
+        return not (count >= limit and (now - last) < seconds)
+
+    def record(self, code: str, now: float) -> int:
+        count, _ = self._sent.get(code, (0, 0))
+        self._sent[code] = (count + 1, now)
+        return count + 1
+
+    def sent(self, code: str) -> int:
+        return self._sent.get(code, (0, 0))[0]
+
+    def reset(self, code: str):
+        self._sent.pop(code, None)
+
+
+@dataclass(frozen=True)
+class Evaluation:
+    reset: bool
+    alerts: Tuple[AlertRule, ...]
+    predicted: Optional[AlertRule] = None
+
+
+class RuleEngine:
+    """Insieme di regole compilate con la finestra di statistiche condivisa."""
+
+    def __init__(self, config: Optional[dict] = None):
+        config = config or DEFAULT_CONFIG
+        self.rules: Tuple[AlertRule, ...] = tuple(compile_rule(spec) for spec in config["rules"])
+        reset_spec = dict(config.get("reset") or {}, code="reset")
+        self.reset_rule: Optional[AlertRule] = compile_rule(reset_spec) if config.get("reset") else None
+
+        cooldown = config.get("cooldown", {})
+        self.max_notifications = cooldown.get("max_notifications", 2)
+        self.cooldown_seconds = cooldown.get("seconds", 1800)
+
+        window = max([rule.window for rule in self.rules] + [MIN_HISTORY])
+        self._stats = WindowStats(window)
+
+        predictive = config.get("predictive")
+        self.predictive_rule: Optional[AlertRule] = None
+        self.predictor: Optional[PredictiveLow] = None
+        if predictive:
+            self.predictive_rule = compile_rule({k: v for k, v in predictive.items() if k not in PREDICTIVE_KEYS})
+            self.predictor = PredictiveLow(**{k: predictive[k] for k in PREDICTIVE_KEYS if k in predictive})
+        self._fed_ms: Optional[int] = None
+
+    def _feed_predictor(self, history: GlucoseHistory):
+        """Passa al predittore solo le letture arrivate dall'ultima valutazione."""
+
+        newest = history.date(-1)
+        if self._fed_ms is not None and newest < self._fed_ms:
+            # Storico ricaricato o replay di un altro periodo: si riparte da capo
+            self.predictor.estimator.reset()
+            self._fed_ms = None
+        fresh = 0
+        while fresh < len(history) and (self._fed_ms is None or history.date(-fresh - 1) > self._fed_ms):
+            fresh += 1
+        for k in range(fresh, 0, -1):
+            self.predictor.update(history.date(-k), history.value(-k))
+        self._fed_ms = newest
+
+    def _prediction(self) -> Optional[AlertRule]:
+        projected = self.predictor.check()
+        if projected is None:
+            return None
+        rule = self.predictive_rule
+        message = rule.message.format(minuti=self.predictor.horizon_minutes, previsto=round(projected))
+        return replace(rule, message=message)
+
+    def new_cooldown(self) -> CooldownTracker:
+        overrides = {
+            rule.code: (
+                rule.max_notifications if rule.max_notifications is not None else self.max_notifications,
+                rule.cooldown_seconds if rule.cooldown_seconds is not None else self.cooldown_seconds,
+            )
+            for rule in self.rules + ((self.predictive_rule,) if self.predictive_rule else ())
+            if rule.max_notifications is not None or rule.cooldown_seconds is not None
+        }
+        return CooldownTracker(self.max_notifications, self.cooldown_seconds, overrides)
+
+    def evaluate(self, history: GlucoseHistory) -> Evaluation:
+        if self.predictor is not None and len(history):
+            self._feed_predictor(history)
+        if len(history) < MIN_HISTORY:
+            return Evaluation(False, ())
+        stats = self._stats
+        stats.update(history)
+        reset = self.reset_rule is not None and self.reset_rule.matches(history, stats)
+        alerts = tuple(rule for rule in self.rules if rule.matches(history, stats))
+        # La previsione serve ad anticipare le regole classiche: se una è già scattata non aggiunge nulla
+        predicted = self._prediction() if self.predictor is not None and not alerts else None
+        return Evaluation(reset, alerts, predicted)
+
+
+def load_config(path: Optional[str] = None) -> dict:
+    """Configurazione da ``path`` o da ``ALERT_RULES_FILE``, altrimenti quella predefinita."""
+
+    path = path or os.getenv("ALERT_RULES_FILE")
+    if not path:
+        return DEFAULT_CONFIG
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+@dataclass(frozen=True)
+class ReplayAlert:
+    date: int
+    code: str
+    value: float
+    trend: str
+
+    def as_dict(self) -> dict:
+        return {
+            "date": self.date,
+            "dateString": datetime.fromtimestamp(self.date / 1000).strftime("%Y-%m-%dT%H:%M:%S"),
+            "code": self.code,
+            "sgv": self.value,
+            "direction": self.trend,
+        }
+
+
+def replay(entries: Iterable[dict], engine: Optional[RuleEngine] = None,
+           predicted: bool = False) -> List[ReplayAlert]:
+    """Esegue le regole su entries salvate, come se arrivassero una alla volta.
+
+    Il cooldown usa l'orario delle letture invece dell'orologio, quindi una
+    giornata intera si rigioca in pochi millisecondi. Con ``predicted`` sono
+    inclusi anche gli allarmi di ipo prevista.
+    """
+
+    engine = engine or RuleEngine()
+    cooldown = engine.new_cooldown()
+    history = GlucoseHistory()
+    active = set()
+    alerts: List[ReplayAlert] = []
+
+    for entry in sorted(entries, key=lambda e: e["date"]):
+        if not history.append(float(entry["sgv"]), entry.get("direction", "→"), int(entry["date"])):
+            continue
+        evaluation = engine.evaluate(history)
+        now = history.date(-1) / 1000
+        if evaluation.reset:
+            for code in active:
+                cooldown.reset(code)
+            active.clear()
+        fired = evaluation.alerts
+        if predicted and evaluation.predicted is not None:
+            fired += (evaluation.predicted,)
+        for rule in fired:
+            if cooldown.allow(rule.code, now):
+                cooldown.record(rule.code, now)
+                active.add(rule.code)
+                alerts.append(ReplayAlert(history.date(-1), rule.code, history.value(-1), history.trend(-1)))
+    return alerts
+
+
+def lead_times(alerts: List[ReplayAlert], predicted_code: str = "prevista_ipo",
+               lookback_ms: int = LEAD_LOOKBACK_MS) -> dict:
+    """Di quanti minuti l'allarme previsto anticipa le regole classiche.
+
+    Ogni episodio inizia con un allarme classico senza altri allarmi classici
+    nei ``lookback_ms`` precedenti; l'anticipo è la distanza dal primo allarme
+    previsto nella stessa finestra. Gli episodi senza allarme previsto restano
+    nel conteggio ma non nella media.
+    """
+
+    details = []
+    previous_rule = None
+    for alert in alerts:
+        if alert.code == predicted_code:
+            continue
+        opens = previous_rule is None or alert.date - previous_rule > lookback_ms
+        if opens:
+            since = alert.date - lookback_ms if previous_rule is None else max(previous_rule, alert.date - lookback_ms)
+            early = next((a for a in alerts
+                          if a.code == predicted_code and since < a.date <= alert.date), None)
+            details.append({
+                "date": alert.date,
+                "code": alert.code,
+                "predicted_date": early.date if early else None,
+                "lead_minutes": (alert.date - early.date) / 60_000 if early else None,
+            })
+        previous_rule = alert.date
+
+    leads = [d["lead_minutes"] for d in details if d["lead_minutes"] is not None]
+    return {
+        "episodes": len(details),
+        "anticipated": len(leads),
+        "mean_lead_minutes": round(sum(leads) / len(leads), 1) if leads else None,
+        "median_lead_minutes": median(leads) if leads else None,
+        "predicted_alerts": sum(1 for a in alerts if a.code == predicted_code),
+        "details": details,
+    }
@@ -0,0 +1,100 @@
+"""Benchmark del profilo AGP: NumPy contro la versione con dizionari Python.
+
+La versione di riferimento lavora come un client di ``/glicemie-oggi``: una
+lista di documenti completi, raggruppati per fascia oraria e ordinati in
+Python. Uso::
+
+    python bench_agp.py --days 90 --repeat 5
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime
+
+import numpy as np
+import pytz
+
+from agp_report import PERCENTILES, agp, bin_percentiles, local_minutes
+
+FIVE_MIN = 5 * 60 * 1000
+
+
+def synthetic_entries(days: int, seed: int = 1):
+    rng = random.Random(seed)
+    start = int(datetime(2025, 1, 1, tzinfo=pytz.utc).timestamp() * 1000)
+    value = 120.0
+    entries = []
+    for i in range(days * 288):
+        value = min(400.0, max(40.0, value + rng.gauss(0, 4)))
+        date = start + i * FIVE_MIN
+        entries.append({
+            "_id": f"{i:024x}",
+            "type": "sgv",
+            "sgv": round(value),
+            "date": date,
+            "dateString": datetime.fromtimestamp(date / 1000).strftime("%Y-%m-%dT%H:%M:%S"),
+            "direction": "Flat",
+            "device": "dexcom-g7",
+        })
+    return entries
+
+
+def _percentile(ordered, p):
+    position = (len(ordered) - 1) * p / 100.0
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def python_agp(entries, tz, bin_minutes=15):
+    """Percentili per fascia con liste e dizionari, come farebbe un client."""
+
+    bins = {}
+    for entry in entries:
+        local = datetime.fromtimestamp(entry["date"] / 1000, tz)
+        index = (local.hour * 60 + local.minute) // bin_minutes
+        bins.setdefault(index, []).append(entry["sgv"])
+    profile = {}
+    for index, values in bins.items():
+        values.sort()
+        profile[index] = [_percentile(values, p) for p in PERCENTILES]
+    return profile
+
+
+def _best(fn, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    tz = pytz.timezone("Europe/Rome")
+    entries = synthetic_entries(args.days)
+    dates = np.fromiter((e["date"] for e in entries), dtype=np.int64, count=len(entries))
+    values = np.fromiter((e["sgv"] for e in entries), dtype=np.float64, count=len(entries))
+
+    python_time, expected = _best(lambda: python_agp(entries, tz), args.repeat)
+    numpy_time, _ = _best(lambda: agp(dates, values, tz), args.repeat)
+
+    table, _ = bin_percentiles(local_minutes(dates, tz) // 15, values, 96)
+    for index, row in expected.items():
+        np.testing.assert_allclose(table[:, index], row)
+
+    print(f"letture: {len(entries)} ({args.days} giorni)")
+    print(f"python (solo percentili): {python_time * 1000:8.1f} ms")
+    print(f"numpy  (AGP completo):    {numpy_time * 1000:8.1f} ms")
+    print(f"speedup: {python_time / numpy_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
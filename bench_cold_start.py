@@ -0,0 +1,83 @@
+"""Tempo di avvio a freddo: dal lancio del processo alla prima risposta di /health.
+
+Ogni giro avvia un nuovo interprete che importa ``wsgi`` e serve l'app con il
+server WSGI di werkzeug, poi interroga ``/health`` finché non risponde 200.
+``MONGO_URI`` punta a un host ``.invalid``: il servizio deve rispondere prima
+di qualsiasi connessione a MongoDB o a Dexcom Share::
+
+    python bench_cold_start.py --runs 5
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CHILD = """
+import sys, time
+started = time.perf_counter()
+from wsgi import app
+print(round((time.perf_counter() - started) * 1000, 1), flush=True)
+from werkzeug.serving import make_server
+make_server("127.0.0.1", int(sys.argv[1]), app, threaded=True).serve_forever()
+"""
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def cold_start(timeout: float = 30.0) -> dict:
+    port = _free_port()
+    env = dict(os.environ, MONGO_URI="mongodb+srv://cold-start.invalid", SYNC_START_DELAY="3600",
+               DEXCOM_SHARE_URL="http://127.0.0.1:9")
+    started = time.perf_counter()
+    child = subprocess.Popen([sys.executable, "-c", CHILD, str(port)], cwd=HERE, env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        deadline = started + timeout
+        while time.perf_counter() < deadline:
+            try:
+                if requests.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                    ready_ms = (time.perf_counter() - started) * 1000
+                    return {"import_ms": float(child.stdout.readline()), "ready_ms": round(ready_ms, 1)}
+            except requests.ConnectionError:
+                time.sleep(0.005)
+        raise RuntimeError(f"/health non ha risposto entro {timeout} s")
+    finally:
+        child.kill()
+        child.wait()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="stampa il report in JSON")
+    args = parser.parse_args()
+
+    runs = [cold_start() for _ in range(args.runs)]
+    report = {
+        "runs": args.runs,
+        "import_ms_median": statistics.median(r["import_ms"] for r in runs),
+        "ready_ms_median": statistics.median(r["ready_ms"] for r in runs),
+        "ready_ms_max": max(r["ready_ms"] for r in runs),
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"import wsgi: {report['import_ms_median']:.0f} ms (mediana)")
+        print(f"prima risposta /health: {report['ready_ms_median']:.0f} ms (mediana), "
+              f"{report['ready_ms_max']:.0f} ms (massimo) su {args.runs} giri")
+
+
+if __name__ == "__main__":
+    main_cli()
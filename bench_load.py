@@ -0,0 +1,475 @@
+"""Benchmark end-to-end del servizio con Dexcom Share, Telegram e Supabase finti.
+
+L'app gira in un server WSGI multi-thread locale; N client in parallelo
+chiamano ``/glicemia``, ``/glicemie-oggi`` e ``/pianifica-ping`` mentre un
+thread esegue il ciclo di sincronizzazione (``invia_a_mongo`` e i ping
+post-pasto). MongoDB è ``mongomock`` (``pip install mongomock``) oppure un
+``mongod`` locale indicato con ``--mongo-uri``.
+
+Il report contiene p50/p99 per endpoint, le chiamate ai servizi esterni e il
+numero di thread; ``--save-baseline`` lo salva in ``bench_baseline.json`` e
+le esecuzioni successive segnalano le regressioni rispetto a quel file::
+
+    python bench_load.py --duration 10 --concurrency 16
+    python bench_load.py --share-latency 200 --share-errors 0.05
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+SHARE_PATH = "/ShareWebServices/Services"
+FIVE_MIN_MS = 5 * 60 * 1000
+# Una regressione è un p99 oltre 1.5 volte il riferimento (con 5 ms di margine
+# per il rumore sui valori piccoli) o più chiamate ai servizi esterni
+LATENCY_TOLERANCE = 1.5
+LATENCY_SLACK_MS = 5.0
+
+
+class _StubServer:
+    """``ThreadingHTTPServer`` in un thread, con contatori per percorso."""
+
+    handler_class = None
+
+    def __init__(self):
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(self.handler_class):
+            server_stub = stub
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def count(self, name: str):
+        with self.lock:
+            self.calls[name] += 1
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else {}
+
+    def _reply(self, status: int, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _ShareHandler(_QuietHandler):
+    def do_POST(self):
+        share = self.server_stub
+        url = urlparse(self.path)
+        endpoint = url.path[len(SHARE_PATH) + 1:]
+        body = self._body()
+        share.count(endpoint)
+        if share.latency:
+            time.sleep(share.latency)
+
+        if share.error_rate and share.rng.random() < share.error_rate:
+            share.count("errors")
+            if share.rng.random() < 0.5:
+                return self._reply(500, {"Code": "SessionNotValid", "Message": "Session ID not valid"})
+            return self._reply(503, {"Code": "ServiceUnavailable"})
+
+        if endpoint == "General/AuthenticatePublisherAccount":
+            return self._reply(200, share.account_id)
+        if endpoint == "General/LoginPublisherAccountById":
+            if body.get("accountId") != share.account_id:
+                return self._reply(500, {"Code": "SSO_AuthenticateAccountNotFound", "Message": "Account"})
+            return self._reply(200, share.session_id)
+        if endpoint == "Publisher/ReadPublisherLatestGlucoseValues":
+            params = parse_qs(url.query)
+            if params.get("sessionId", [None])[0] != share.session_id:
+                return self._reply(500, {"Code": "SessionIdNotFound", "Message": "Session ID not found"})
+            minutes = int(params.get("minutes", ["1440"])[0])
+            max_count = int(params.get("maxCount", ["288"])[0])
+            return self._reply(200, share.readings(minutes, max_count))
+        self._reply(404, {"Code": "NotFound"})
+
+
+class FakeShare(_StubServer):
+    """Dexcom Share finto compatibile con pydexcom: login in due passi e letture.
+
+    Le letture seguono un'onda lenta tra 70 e 180 mg/dL, una ogni 5 minuti
+    allineata all'orologio reale, come le pubblica il G7.
+    """
+
+    handler_class = _ShareHandler
+
+    def __init__(self, latency_ms: float = 0, error_rate: float = 0.0, seed: int = 1):
+        super().__init__()
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.account_id = str(uuid.UUID(int=random.Random(seed).getrandbits(128)))
+        self.session_id = str(uuid.uuid4())
+
+    @property
+    def url(self) -> str:
+        return super().url + SHARE_PATH
+
+    def expire_session(self):
+        """Invalida la sessione corrente, come fa Share dopo qualche ora."""
+
+        self.session_id = str(uuid.uuid4())
+
+    @staticmethod
+    def value_at(date_ms: int) -> int:
+        return round(125 + 55 * math.sin(date_ms / (3 * 3600 * 1000) * math.pi))
+
+    def readings(self, minutes: int, max_count: int) -> List[dict]:
+        latest = int(time.time() * 1000) // FIVE_MIN_MS * FIVE_MIN_MS
+        count = min(max_count, minutes // 5 + 1)
+        result = []
+        for i in range(count):
+            date = latest - i * FIVE_MIN_MS
+            trend = self.value_at(date) - self.value_at(date - FIVE_MIN_MS)
+            result.append({
+                "WT": f"Date({date})",
+                "ST": f"Date({date})",
+                "DT": f"Date({date}+0000)",
+                "Value": self.value_at(date),
+                "Trend": "SingleDown" if trend < -5 else "FortyFiveDown" if trend < -2
+                else "FortyFiveUp" if trend > 2 else "Flat",
+            })
+        return result
+
+
+class _TelegramHandler(_QuietHandler):
+    def do_POST(self):
+        self._body()
+        self.server_stub.count("sendMessage")
+        self._reply(200, {"ok": True, "result": {}})
+
+
+class FakeTelegram(_StubServer):
+    handler_class = _TelegramHandler
+
+
+class _SupabaseHandler(_QuietHandler):
+    def _no_content(self, name: str):
+        self._body()
+        self.server_stub.count(name)
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_PATCH(self):
+        self._no_content("patch")
+
+
+class FakeSupabase(_StubServer):
+    handler_class = _SupabaseHandler
+
+
+def percentile(samples: List[float], p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * p / 100.0
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.max_threads = threading.active_count()
+
+    def record(self, name: str, seconds: float, ok: bool):
+        with self.lock:
+            self.latencies[name].append(seconds * 1000)
+            if not ok:
+                self.errors[name] += 1
+
+    def sample_threads(self):
+        self.max_threads = max(self.max_threads, threading.active_count())
+
+    def summary(self, duration: float) -> Dict[str, dict]:
+        return {
+            name: {
+                "requests": len(samples),
+                "errors": self.errors[name],
+                "rps": round(len(samples) / duration, 1),
+                "p50_ms": round(percentile(samples, 50), 2),
+                "p99_ms": round(percentile(samples, 99), 2),
+            }
+            for name, samples in sorted(self.latencies.items())
+        }
+
+
+def _client_worker(base_url: str, recorder: Recorder, stop: threading.Event, seed: int):
+    rng = random.Random(seed)
+    session = requests.Session()
+    meal = seed * 1_000_000
+    while not stop.is_set():
+        pick = rng.random()
+        if pick < 0.7:
+            name, call = "/glicemia", lambda: session.get(f"{base_url}/glicemia", timeout=30)
+        elif pick < 0.9:
+            name, call = "/glicemie-oggi", lambda: session.get(f"{base_url}/glicemie-oggi", timeout=30)
+        else:
+            meal += 1
+            name, call = "/pianifica-ping", lambda: session.post(
+                f"{base_url}/pianifica-ping", json={"id": meal}, timeout=30)
+        started = time.perf_counter()
+        try:
+            response = call()
+            ok = response.status_code < 400
+            response.content
+        except requests.RequestException:
+            ok = False
+        recorder.record(name, time.perf_counter() - started, ok)
+
+
+def _sync_worker(main, recorder: Recorder, stop: threading.Event, every: float):
+    meal = 0
+    while not stop.wait(every):
+        meal += 1
+        started = time.perf_counter()
+        try:
+            main.invia_a_mongo()
+            # Il primo ping post-pasto arriva un'ora dopo un pasto dell'ultima ora
+            main.invia_ping(meal, "t1", datetime.now(timezone.utc) - timedelta(minutes=1))
+            ok = True
+        except Exception:
+            ok = False
+        recorder.record("sync", time.perf_counter() - started, ok)
+
+
+def _prepare_environment(args, share, telegram, supabase):
+    os.environ.update({
+        "DEXCOM_USERNAME": "bench",
+        "DEXCOM_PASSWORD": "bench",
+        "DEXCOM_REGION": "OUS",
+        "DEXCOM_SHARE_URL": share.url,
+        "TELEGRAM_BOT_TOKEN": "bench",
+        "TELEGRAM_CHAT_IDS": "1,2",
+        "TELEGRAM_API_URL": telegram.url,
+        "SUPABASE_URL": supabase.url,
+        "SUPABASE_KEY": "bench",
+        "MONGO_URI": args.mongo_uri or "mongodb://localhost:27017",
+    })
+    if args.mongo_uri:
+        return None
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("mongomock non installato: pip install mongomock, oppure usa --mongo-uri")
+    patcher = mongomock.patch(servers=(("localhost", 27017),))
+    patcher.start()
+    return patcher
+
+
+def run(args) -> dict:
+    from werkzeug.serving import make_server
+
+    if not args.verbose:
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    with FakeShare(args.share_latency, args.share_errors) as share, FakeTelegram() as telegram, \
+            FakeSupabase() as supabase:
+        patcher = _prepare_environment(args, share, telegram, supabase)
+        try:
+            import main
+            from dexcom_g7 import share_stats, shared_client_from_environment
+        finally:
+            if patcher is not None:
+                patcher.stop()
+
+        # Scheduler avviato senza i job di sincronizzazione: il ciclo lo guida _sync_worker
+        main.scheduler.start()
+        started = time.perf_counter()
+        main.avvia_sincronizzazione()
+        startup_ms = (time.perf_counter() - started) * 1000
+
+        server = make_server("127.0.0.1", 0, main.app, threaded=True)
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+        recorder = Recorder()
+        stop = threading.Event()
+        workers = [threading.Thread(target=_client_worker, args=(base_url, recorder, stop, i), daemon=True)
+                   for i in range(args.concurrency)]
+        workers.append(threading.Thread(target=_sync_worker, args=(main, recorder, stop, args.sync_every),
+                                        daemon=True))
+        share_before = dict(share.calls)
+        for worker in workers:
+            worker.start()
+
+        cache = shared_client_from_environment().cache
+        deadline = time.perf_counter() + args.duration
+        next_publish = time.perf_counter() + args.publish_every
+        while time.perf_counter() < deadline:
+            recorder.sample_threads()
+            if args.publish_every and time.perf_counter() >= next_publish:
+                # Ciclo di pubblicazione compresso: la cache scade come all'arrivo di un nuovo valore
+                cache.invalidate()
+                next_publish += args.publish_every
+            if args.expire_session_every and share.rng.random() < 0.1 / args.expire_session_every:
+                share.expire_session()
+            time.sleep(0.1)
+        stop.set()
+        for worker in workers:
+            worker.join(30)
+        main.notificatore.flush(5)
+        main.outbox.flush(5)
+        main.scheduler.shutdown(wait=False)
+        server.shutdown()
+
+        share_calls = {k: v - share_before.get(k, 0) for k, v in share.calls.items()}
+        return {
+            "config": {
+                "duration": args.duration,
+                "concurrency": args.concurrency,
+                "share_latency_ms": args.share_latency,
+                "share_errors": args.share_errors,
+                "sync_every": args.sync_every,
+                "publish_every": args.publish_every,
+                "mongo": "mongod" if args.mongo_uri else "mongomock",
+            },
+            "startup_ms": round(startup_ms, 1),
+            "endpoints": recorder.summary(args.duration),
+            "upstream": {
+                "share_logins": share_calls.get("General/LoginPublisherAccountById", 0),
+                "share_reads": share_calls.get("Publisher/ReadPublisherLatestGlucoseValues", 0),
+                "share_errors": share_calls.get("errors", 0),
+                "telegram_messages": telegram.calls.get("sendMessage", 0),
+                "supabase_requests": supabase.calls.get("patch", 0),
+            },
+            "share_cache": {k: v for k, v in share_stats().items() if k.startswith("cache_")},
+            "threads": {"max_active": recorder.max_threads, "after": threading.active_count()},
+        }
+
+
+def compare(report: dict, baseline: dict) -> List[str]:
+    """Regressioni di ``report`` rispetto a ``baseline`` (stessa configurazione)."""
+
+    problems = []
+    for name, current in report["endpoints"].items():
+        reference = baseline.get("endpoints", {}).get(name)
+        if not reference:
+            continue
+        limit = reference["p99_ms"] * LATENCY_TOLERANCE + LATENCY_SLACK_MS
+        if current["p99_ms"] > limit:
+            problems.append(f"{name}: p99 {current['p99_ms']} ms oltre {limit:.1f} ms "
+                            f"(riferimento {reference['p99_ms']} ms)")
+        if current["errors"] > reference["errors"]:
+            problems.append(f"{name}: {current['errors']} errori (riferimento {reference['errors']})")
+    for name, count in report["upstream"].items():
+        reference = baseline.get("upstream", {}).get(name)
+        # Le chiamate a Share dipendono dal ciclo di pubblicazione: una in più è tollerata
+        if reference is not None and count > reference + 1:
+            problems.append(f"{name}: {count} chiamate (riferimento {reference})")
+    reference_threads = baseline.get("threads", {}).get("max_active")
+    if reference_threads is not None and report["threads"]["max_active"] > reference_threads * LATENCY_TOLERANCE:
+        problems.append(f"thread attivi: {report['threads']['max_active']} (riferimento {reference_threads})")
+    return problems
+
+
+def print_report(report: dict):
+    print(f"avvio sincronizzazione: {report['startup_ms']} ms")
+    print(f"{'endpoint':<18}{'richieste':>10}{'errori':>8}{'rps':>9}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, row in report["endpoints"].items():
+        print(f"{name:<18}{row['requests']:>10}{row['errors']:>8}{row['rps']:>9}"
+              f"{row['p50_ms']:>10}{row['p99_ms']:>10}")
+    print("servizi esterni: " + ", ".join(f"{k}={v}" for k, v in report["upstream"].items()))
+    print("cache Share: " + ", ".join(f"{k}={v}" for k, v in report["share_cache"].items()))
+    print(f"thread: massimo {report['threads']['max_active']}, alla fine {report['threads']['after']}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--sync-every", type=float, default=1.0,
+                        help="secondi tra due cicli di sincronizzazione (in produzione 300)")
+    parser.add_argument("--publish-every", type=float, default=2.0,
+                        help="secondi tra due nuovi valori simulati (in produzione 300)")
+    parser.add_argument("--share-latency", type=float, default=50, help="latenza di Share finto in ms")
+    parser.add_argument("--share-errors", type=float, default=0.0, help="frazione di risposte di errore")
+    parser.add_argument("--expire-session-every", type=float, default=0,
+                        help="invalida la sessione Share in media ogni N secondi")
+    parser.add_argument("--mongo-uri", help="mongod locale invece di mongomock")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--json", action="store_true", help="stampa il report in JSON")
+    parser.add_argument("--verbose", action="store_true", help="mostra i log dell'app")
+    args = parser.parse_args()
+
+    if args.verbose:
+        report = run(args)
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"riferimento salvato in {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("config") != report["config"]:
+        print("configurazione diversa dal riferimento: confronto saltato")
+        return 0
+    problems = compare(report, baseline)
+    for problem in problems:
+        print(f"REGRESSIONE {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
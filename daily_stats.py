@@ -0,0 +1,163 @@
+"""Statistiche giornaliere delle glicemie mantenute in modo incrementale.
+
+Per ogni giorno (nel fuso configurato) la collection ``daily_stats`` conserva
+somme, somme dei quadrati, minimo, massimo e conteggi per fascia di
+glicemia. Ogni nuova entry aggiorna il proprio giorno con un ``$inc``; media,
+deviazione standard, CV, GMI e tempo in range di un intervallo qualsiasi si
+ricavano combinando questi documenti, senza rileggere le entries.
+"""
+
+import math
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List
+
+from pymongo import ASCENDING, ReplaceOne, UpdateOne
+
+from nightscout_entries import DEVICE
+
+# Fasce di consenso internazionale per il tempo in range (mg/dL)
+BANDS = (
+    ("very_low", None, 54),
+    ("low", 54, 70),
+    ("in_range", 70, 181),
+    ("high", 181, 251),
+    ("very_high", 251, None),
+)
+STATS_INDEX = "device_day"
+
+
+def band(value: float) -> str:
+    for name, low, high in BANDS:
+        if (low is None or value >= low) and (high is None or value < high):
+            return name
+    return BANDS[-1][0]
+
+
+def day_of(date_ms: int, tz) -> str:
+    return datetime.fromtimestamp(date_ms / 1000, tz).strftime("%Y-%m-%d")
+
+
+def ensure_stats_indexes(collection):
+    collection.create_index([("device", ASCENDING), ("day", ASCENDING)], name=STATS_INDEX, unique=True)
+
+
+def _stats_id(device: str, day: str) -> str:
+    return f"{device}:{day}"
+
+
+def update_daily_stats(collection, entries: Iterable[dict], tz) -> int:
+    """Aggiunge ``entries`` (appena inserite, mai ripetute) ai rispettivi giorni.
+
+    Le entries dello stesso giorno vengono sommate in memoria e scritte con un
+    solo ``$inc``; restituisce il numero di giorni aggiornati.
+    """
+
+    days: Dict[tuple, dict] = {}
+    for entry in entries:
+        value = float(entry["sgv"])
+        key = (entry.get("device", DEVICE), day_of(entry["date"], tz))
+        acc = days.get(key)
+        if acc is None:
+            acc = days[key] = {"inc": defaultdict(float), "min": value, "max": value}
+        inc = acc["inc"]
+        inc["count"] += 1
+        inc["sum"] += value
+        inc["sum_sq"] += value * value
+        inc[f"bands.{band(value)}"] += 1
+        acc["min"] = min(acc["min"], value)
+        acc["max"] = max(acc["max"], value)
+
+    if not days:
+        return 0
+    collection.bulk_write([
+        UpdateOne(
+            {"_id": _stats_id(device, day)},
+            {
+                "$inc": dict(acc["inc"]),
+                "$min": {"min": acc["min"]},
+                "$max": {"max": acc["max"]},
+                "$setOnInsert": {"device": device, "day": day},
+            },
+            upsert=True,
+        )
+        for (device, day), acc in days.items()
+    ], ordered=False)
+    return len(days)
+
+
+def rebuild_daily_stats(entries_collection, stats_collection, tz_name: str,
+                        start_ms: int = 0, end_ms: int = 2 ** 62) -> int:
+    """Ricalcola i giorni di ``[start_ms, end_ms)`` con un'aggregazione lato MongoDB."""
+
+    band_counts = {
+        f"band_{name}": {"$sum": {"$cond": [{"$and": [
+            {"$gte": ["$sgv", low]} if low is not None else True,
+            {"$lt": ["$sgv", high]} if high is not None else True,
+        ]}, 1, 0]}}
+        for name, low, high in BANDS
+    }
+    pipeline = [
+        {"$match": {"type": "sgv", "date": {"$gte": start_ms, "$lt": end_ms}}},
+        {"$group": {
+            "_id": {
+                "device": "$device",
+                "day": {"$dateToString": {"format": "%Y-%m-%d", "timezone": tz_name,
+                                          "date": {"$toDate": "$date"}}},
+            },
+            "count": {"$sum": 1},
+            "sum": {"$sum": "$sgv"},
+            "sum_sq": {"$sum": {"$multiply": ["$sgv", "$sgv"]}},
+            "min": {"$min": "$sgv"},
+            "max": {"$max": "$sgv"},
+            **band_counts,
+        }},
+    ]
+
+    operations = []
+    for group in entries_collection.aggregate(pipeline, allowDiskUse=True):
+        device = group["_id"]["device"] or DEVICE
+        day = group["_id"]["day"]
+        operations.append(ReplaceOne({"_id": _stats_id(device, day)}, {
+            "device": device,
+            "day": day,
+            "count": group["count"],
+            "sum": float(group["sum"]),
+            "sum_sq": float(group["sum_sq"]),
+            "min": float(group["min"]),
+            "max": float(group["max"]),
+            "bands": {name: group[f"band_{name}"] for name, _, _ in BANDS},
+        }, upsert=True))
+    if operations:
+        stats_collection.bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def summarize(days: List[dict]) -> dict:
+    """Media, deviazione standard, CV, GMI e tempo per fascia di un insieme di giorni."""
+
+    count = sum(d.get("count", 0) for d in days)
+    if not count:
+        return {"count": 0}
+    total = sum(d.get("sum", 0.0) for d in days)
+    total_sq = sum(d.get("sum_sq", 0.0) for d in days)
+    mean = total / count
+    sd = math.sqrt(max(0.0, total_sq / count - mean * mean))
+    bands = {name: sum(d.get("bands", {}).get(name, 0) for d in days) for name, _, _ in BANDS}
+    return {
+        "count": count,
+        "mean": round(mean, 1),
+        "sd": round(sd, 1),
+        "cv": round(100 * sd / mean, 1) if mean else None,
+        # Glucose Management Indicator (Bergenstal 2018), in %
+        "gmi": round(3.31 + 0.02392 * mean, 2),
+        "min": min(d["min"] for d in days if d.get("count")),
+        "max": max(d["max"] for d in days if d.get("count")),
+        "tir": {name: round(100 * n / count, 1) for name, n in bands.items()},
+    }
+
+
+def read_range(collection, from_day: str, to_day: str, device: str = DEVICE) -> List[dict]:
+    return list(collection.find(
+        {"device": device, "day": {"$gte": from_day, "$lte": to_day}}, {"_id": 0}
+    ).sort("day", ASCENDING))
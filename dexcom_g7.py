@@ -4,14 +4,72 @@ Il G7 pubblica le letture sullo stesso servizio Share usato dalle generazioni
 precedenti. Questa classe centralizza la configurazione, in particolare la
 regione dell'account, così che tutti gli endpoint dell'app usino il server
 corretto.
+
+I client sono condivisi a livello di processo: per ogni coppia
+(username, regione) esiste una sola sessione Share, riusata da tutti i thread
+finché Dexcom non la invalida, e tutte le chiamate passano da un'unica
+``requests.Session`` con keep-alive.
 """
 
 import os
+import threading
+import time
+from contextlib import nullcontext
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
+import requests
 from pydexcom import Dexcom
+from pydexcom.const import (
+    DEXCOM_BASE_URL,
+    DEXCOM_BASE_URL_OUS,
+    DEXCOM_GLUCOSE_READINGS_ENDPOINT,
+)
+from pydexcom.errors import AccountError, SessionError
+
+from metrics import counter, histogram, timed
+
+SHARE_TIMEOUT = 10
+SHARE_POOL_SIZE = 8
+
+# Il G7 pubblica un valore ogni 5 minuti; Share lo rende disponibile con
+# qualche secondo di ritardo.
+READING_INTERVAL = 300
+PUBLISH_GRACE = 20
+MIN_REFRESH = 30
+
+_SESSION_ERROR_CODES = {"SessionNotValid", "SessionIdNotFound"}
+_ACCOUNT_ERROR_CODES = {
+    "SSO_AuthenticateAccountNotFound",
+    "AccountPasswordInvalid",
+    "SSO_AuthenticateMaxAttemptsExceeed",
+    "InvalidArgument",
+}
+
+SHARE_SECONDS = histogram("dexcom_share_request_seconds", "Durata di login e letture verso Dexcom Share",
+                          labels=("operation",))
+SHARE_ERRORS = counter("dexcom_share_errors_total", "Risposte di errore di Dexcom Share", labels=("kind",))
+
+_http_session: Optional[requests.Session] = None
+_http_session_lock = threading.Lock()
+
+
+def _shared_http_session() -> requests.Session:
+    """Restituisce la ``requests.Session`` condivisa verso Dexcom Share."""
+
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=2, pool_maxsize=SHARE_POOL_SIZE
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _http_session = session
+    return _http_session
 
 
 @dataclass(frozen=True)
@@ -22,6 +80,207 @@ class G7Reading:
     time: datetime
 
 
+@dataclass(frozen=True)
+class CachedReading:
+    reading: Optional[G7Reading]
+    hit: bool
+    expires_at: float
+    fetched_at: float
+
+    def age_seconds(self, now: Optional[float] = None) -> Optional[int]:
+        if self.reading is None:
+            return None
+        now = time.time() if now is None else now
+        return max(0, int(now - self.reading.time.timestamp()))
+
+    def headers(self, now: Optional[float] = None) -> Dict[str, str]:
+        """Header HTTP che permettono ai client in polling di rallentare."""
+
+        now = time.time() if now is None else now
+        headers = {
+            "X-Cache": "HIT" if self.hit else "MISS",
+            "Cache-Control": f"max-age={max(0, int(self.expires_at - now))}",
+        }
+        age = self.age_seconds(now)
+        if age is not None:
+            headers["X-Reading-Age"] = str(age)
+        return headers
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ReadingCache:
+    """Cache della lettura corrente allineata al ciclo di pubblicazione G7.
+
+    La lettura resta valida fino a ``time + READING_INTERVAL + PUBLISH_GRACE``;
+    se Share non ha ancora un valore nuovo si riprova al massimo ogni
+    ``MIN_REFRESH`` secondi. Le richieste concorrenti che trovano la cache
+    scaduta aspettano un'unica chiamata a Share invece di farne una ciascuna.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[], Optional[G7Reading]],
+        interval: float = READING_INTERVAL,
+        grace: float = PUBLISH_GRACE,
+        min_refresh: float = MIN_REFRESH,
+        clock: Callable[[], float] = time.time,
+    ):
+        self._fetch = fetch
+        self._interval = interval
+        self._grace = grace
+        self._min_refresh = min_refresh
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entry: Optional[CachedReading] = None
+        self._flight: Optional[_Flight] = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _expiry(self, reading: Optional[G7Reading], now: float) -> float:
+        if reading is None:
+            return now + self._min_refresh
+        next_publish = reading.time.timestamp() + self._interval + self._grace
+        return max(next_publish, now + self._min_refresh)
+
+    def get(self) -> CachedReading:
+        with self._lock:
+            entry = self._entry
+            if entry is not None and self._clock() < entry.expires_at:
+                self.hits += 1
+                return CachedReading(entry.reading, True, entry.expires_at, entry.fetched_at)
+
+            flight = self._flight
+            leader = flight is None
+            if leader:
+                flight = self._flight = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not flight.done.wait(SHARE_TIMEOUT * 3):
+                raise TimeoutError("Lettura Dexcom Share in corso da troppo tempo")
+            if flight.error is not None:
+                raise flight.error
+            return CachedReading(
+                flight.result.reading, True, flight.result.expires_at, flight.result.fetched_at
+            )
+
+        try:
+            reading = self._fetch()
+            now = self._clock()
+            flight.result = CachedReading(reading, False, self._expiry(reading, now), now)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if flight.result is not None:
+                    self._entry = flight.result
+                self._flight = None
+            flight.done.set()
+
+    def peek(self) -> Optional[G7Reading]:
+        """Ultima lettura in cache, anche se scaduta, senza chiamare Share."""
+
+        entry = self._entry
+        return entry.reading if entry is not None else None
+
+    def invalidate(self):
+        with self._lock:
+            self._entry = None
+
+    def refresh(self) -> CachedReading:
+        """Chiede a Share una lettura nuova anche se la cache è valida.
+
+        Usato dal ciclo di sincronizzazione, che sa quando il sensore dovrebbe
+        aver pubblicato; le richieste in arrivo nel frattempo si accodano alla
+        stessa chiamata.
+        """
+
+        self.invalidate()
+        return self.get()
+
+
+class _PooledDexcom(Dexcom):
+    """``Dexcom`` con login pigro, sessione HTTP condivisa e contatori.
+
+    pydexcom esegue il login nel costruttore e apre una connessione nuova per
+    ogni richiesta; qui il login avviene alla prima lettura e viene ripetuto
+    solo quando Share risponde con ``SessionError``.
+    """
+
+    def __init__(self, username: str, password: str, ous: bool = False):
+        # DEXCOM_SHARE_URL punta a un server Share alternativo (per esempio quello finto dei benchmark)
+        self.base_url = os.getenv("DEXCOM_SHARE_URL") or (DEXCOM_BASE_URL_OUS if ous else DEXCOM_BASE_URL)
+        self.username = username
+        self.password = password
+        self.session_id = None
+        self.account_id = None
+        self.logins = 0
+        self.reads = 0
+        self._login_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def _request(self, method, endpoint, params=None, json=None):
+        is_read = endpoint == DEXCOM_GLUCOSE_READINGS_ENDPOINT
+        # Il login è misurato per intero in create_session
+        with timed(SHARE_SECONDS, "fetch") if is_read else nullcontext():
+            response = _shared_http_session().request(
+                method,
+                f"{self.base_url}/{endpoint}",
+                params=params,
+                json=json or {},
+                timeout=SHARE_TIMEOUT,
+            )
+        if is_read:
+            with self._stats_lock:
+                self.reads += 1
+
+        if response.status_code == 500:
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+            code = body.get("Code") if isinstance(body, dict) else None
+            if code in _SESSION_ERROR_CODES:
+                SHARE_ERRORS.inc("session")
+                raise SessionError(body.get("Message") or code)
+            if code in _ACCOUNT_ERROR_CODES:
+                SHARE_ERRORS.inc("account")
+                raise AccountError(body.get("Message") or code)
+
+        if response.status_code >= 400:
+            SHARE_ERRORS.inc("http")
+        response.raise_for_status()
+        return response.json()
+
+    def create_session(self):
+        stale_session_id = self.session_id
+        with self._login_lock:
+            # Un altro thread ha già rinnovato la sessione mentre aspettavamo.
+            if self.session_id is not None and self.session_id != stale_session_id:
+                return
+            with timed(SHARE_SECONDS, "login"):
+                super().create_session()
+            with self._stats_lock:
+                self.logins += 1
+
+    def ensure_session(self):
+        if self.session_id is None:
+            self.create_session()
+
+
 class DexcomG7Client:
     """Piccolo adapter per le letture G7 disponibili in Dexcom Share."""
 
@@ -33,7 +292,11 @@ class DexcomG7Client:
         if normalized_region not in {"US", "OUS"}:
             raise ValueError("DEXCOM_REGION deve essere US oppure OUS")
 
-        self._dexcom = Dexcom(username, password, ous=normalized_region == "OUS")
+        self.username = username
+        self.region = normalized_region
+        self._password = password
+        self._dexcom = _PooledDexcom(username, password, ous=normalized_region == "OUS")
+        self.cache = ReadingCache(self.get_current_reading)
 
     @classmethod
     def from_environment(cls):
@@ -43,11 +306,8 @@ class DexcomG7Client:
             os.getenv("DEXCOM_REGION", "OUS"),
         )
 
-    def get_current_reading(self) -> Optional[G7Reading]:
-        reading = self._dexcom.get_current_glucose_reading()
-        if reading is None:
-            return None
-
+    @staticmethod
+    def _normalize(reading) -> G7Reading:
         return G7Reading(
             value=float(reading.value),
             trend_description=reading.trend_description,
@@ -55,8 +315,100 @@ class DexcomG7Client:
             time=reading.time,
         )
 
+    def get_current_reading(self) -> Optional[G7Reading]:
+        self._dexcom.ensure_session()
+        reading = self._dexcom.get_current_glucose_reading()
+        if reading is None:
+            return None
+
+        return self._normalize(reading)
+
+    def get_readings(self, minutes: int = 1440, max_count: int = 288) -> List[G7Reading]:
+        """Letture degli ultimi ``minutes`` minuti, dalla più recente, con una sola chiamata."""
+
+        self._dexcom.ensure_session()
+        readings = self._dexcom.get_glucose_readings(minutes=minutes, max_count=max_count)
+        return [self._normalize(reading) for reading in readings or []]
+
+    def stats(self) -> Dict[str, int]:
+        """Numero di login e di letture eseguite verso Share."""
+
+        return {
+            "logins": self._dexcom.logins,
+            "reads": self._dexcom.reads,
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "cache_coalesced": self.cache.coalesced,
+        }
+
+
+_clients: Dict[Tuple[str, str], DexcomG7Client] = {}
+_clients_lock = threading.Lock()
+
+
+def get_shared_client(username: str, password: str, region: str = "OUS") -> DexcomG7Client:
+    """Restituisce il client condiviso per (username, regione), creandolo se serve.
+
+    Se la password cambia (per esempio dopo un aggiornamento delle variabili
+    d'ambiente) il client viene ricreato con una nuova sessione.
+    """
+
+    key = (username, region.strip().upper())
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None or client._password != password:
+            client = DexcomG7Client(username, password, region)
+            _clients[key] = client
+        return client
+
+
+def shared_client_from_environment() -> DexcomG7Client:
+    return get_shared_client(
+        os.getenv("DEXCOM_USERNAME", ""),
+        os.getenv("DEXCOM_PASSWORD", ""),
+        os.getenv("DEXCOM_REGION", "OUS"),
+    )
+
+
+def share_stats() -> Dict[str, int]:
+    """Contatori aggregati di login e letture per tutti i client condivisi."""
+
+    with _clients_lock:
+        clients = list(_clients.values())
+    totals = {"clients": len(clients), "logins": 0, "reads": 0, "cache_hits": 0, "cache_misses": 0,
+              "cache_coalesced": 0}
+    for client in clients:
+        for name, value in client.stats().items():
+            totals[name] += value
+    return totals
+
+
+def reset_shared_clients():
+    """Dimentica tutti i client condivisi (usato nei test)."""
+
+    with _clients_lock:
+        _clients.clear()
+
 
 def get_g7_reading() -> Optional[G7Reading]:
-    """Crea una sessione Share G7 e restituisce la lettura corrente."""
+    """Restituisce la lettura corrente usando la sessione Share condivisa."""
+
+    return shared_client_from_environment().get_current_reading()
+
+
+def get_g7_readings(minutes: int = 1440, max_count: int = 288) -> List[G7Reading]:
+    """Storico recente (massimo 24 ore / 288 letture) dalla sessione Share condivisa."""
+
+    return shared_client_from_environment().get_readings(minutes, max_count)
+
+
+def get_cached_g7_reading() -> CachedReading:
+    """Lettura corrente servita dalla cache finché Dexcom non ne pubblica una nuova."""
+
+    return shared_client_from_environment().cache.get()
+
+
+def get_fresh_g7_reading() -> CachedReading:
+    """Lettura corrente chiesta a Share, che aggiorna anche la cache."""
 
-    return DexcomG7Client.from_environment().get_current_reading()
+    return shared_client_from_environment().cache.refresh()
@@ -1,9 +1,12 @@
 from flask import Flask, jsonify, request
-from dexcom_g7 import get_g7_reading
+from dexcom_g7 import get_cached_g7_reading
 from dotenv import load_dotenv
 from flask_cors import CORS
-import requests
+from pymongo import MongoClient
+from lazy import Lazy
+from outbox import Outbox, SheetSink
 from datetime import datetime
+import os
 
 # Carica le variabili dal file .env
 load_dotenv()
@@ -11,26 +14,45 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app)
 
+GOOGLE_SHEET_URL = os.getenv("GOOGLE_SHEET_URL") or \
+    "https://script.google.com/macros/s/AKfycbzO4lT2z4bZL2S9sKUdnak1OHEpeuyltsPcXK3CSNgZemw1Hx4LO-41xcwmYIQdhbtZ8A/exec"
+
+# Con MONGO_URI le righe per il Google Sheet passano dall'outbox su Mongo: il
+# ping ritorna subito e l'invio avviene, con ritentativi, da un thread dedicato.
+# Senza MONGO_URI le righe partono subito, come prima dell'outbox.
+MONGO_URI = os.getenv("MONGO_URI")
+# Mongo irraggiungibile: il ping ripiega sull'invio diretto dopo pochi secondi
+MONGO_TIMEOUT_MS = 3000
+mongo_client = Lazy(lambda: MongoClient(MONGO_URI, serverSelectionTimeoutMS=MONGO_TIMEOUT_MS), "mongo_client")
+outbox = Outbox(mongo_client["nightscout"]["outbox"] if MONGO_URI else None, {
+    # 1 riga per POST finché lo script Apps Script non accetta le liste (vedi README)
+    "sheet": SheetSink(GOOGLE_SHEET_URL, batch_size=int(os.getenv("SHEET_BATCH_SIZE", "1"))),
+})
+# Voci rimaste in coda da prima del riavvio: il thread parte con il server, non al primo ping
+outbox.start()
+
 # Endpoint per glicemia attuale
 @app.route("/glicemia")
 def glicemia():
     try:
-        reading = get_g7_reading()
+        cached = get_cached_g7_reading()
+        reading = cached.reading
         if reading is None:
-            return jsonify({"errore": "Nessuna lettura G7 disponibile"}), 404
+            return jsonify({"errore": "Nessuna lettura G7 disponibile"}), 404, cached.headers()
 
         return jsonify({
             "glicemia": reading.value,
             "trend": reading.trend_description,
             "timestamp": reading.time.strftime("%Y-%m-%d %H:%M:%S")
-        })
+        }), 200, cached.headers()
     except Exception as e:
         return jsonify({"errore": str(e)}), 500
 
 # Funzione per inviare i ping al backend e al Google Sheet
-def invia_ping(distanza_minuti):
+def invia_ping(distanza_minuti, reading=None):
     try:
-        reading = get_g7_reading()
+        # La lettura in cache è quella corrente finché Dexcom non ne pubblica una nuova
+        reading = reading or get_cached_g7_reading().reading
         if reading is None:
             return jsonify({"errore": "Nessuna lettura G7 disponibile"}), 404
 
@@ -43,16 +65,10 @@ def invia_ping(distanza_minuti):
             "tipo": "monitoraggio post-prandiale"
         }
 
-        res = requests.post(
-            "https://script.google.com/macros/s/AKfycbzO4lT2z4bZL2S9sKUdnak1OHEpeuyltsPcXK3CSNgZemw1Hx4LO-41xcwmYIQdhbtZ8A/exec",
-            json=payload
-        )
-
-        if res.status_code == 200:
-            print(f"✅ Ping t+{distanza_minuti} min salvato.")
-            return jsonify({"messaggio": f"✅ Ping t+{distanza_minuti} min salvato."})
-        else:
-            return jsonify({"errore": f"Errore Google Sheet: {res.text}"}), 500
+        # Stessa lettura e stessa distanza: una sola riga anche se il ping viene ripetuto
+        outbox.append("sheet", f"{payload['timestampDexcom']}|{distanza_minuti}", payload)
+        print(f"✅ Ping t+{distanza_minuti} min accodato.")
+        return jsonify({"messaggio": f"✅ Ping t+{distanza_minuti} min accodato."})
 
     except Exception as e:
         return jsonify({"errore": str(e)}), 500
@@ -67,18 +83,27 @@ def ping():
         if distanza_minuti not in [10, 20, 45]:
             raise ValueError("Parametro 't' non valido. Usa t=10, 20, 45.")
 
+        # Una sola lettura per il ping di risveglio e per quello programmato
+        reading = get_cached_g7_reading().reading
+        if reading is None:
+            return jsonify({"errore": "Nessuna lettura G7 disponibile"}), 404
+
         # Risveglio prima del ping
         risveglio = distanza_minuti - 2
-        invia_ping(risveglio)  # Ping di risveglio
+        invia_ping(risveglio, reading)  # Ping di risveglio
 
         # Invio del ping programmato
-        invia_ping(distanza_minuti)
+        invia_ping(distanza_minuti, reading)
 
         return jsonify({"messaggio": f"✅ Ping t+{distanza_minuti} min e risveglio t+{risveglio} min eseguiti."})
 
     except Exception as e:
         return jsonify({"errore": str(e)}), 500
 
+@app.route("/outbox/stato", methods=["GET"])
+def stato_outbox():
+    return jsonify(outbox.stats())
+
 # Avvio server
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5001)
@@ -0,0 +1,134 @@
+"""Previsione a breve termine della glicemia per gli allarmi di ipo prevista.
+
+La pendenza è una regressione ai minimi quadrati sulle ultime ``window``
+letture, aggiornata in O(1) a ogni lettura mantenendo le somme di t, v, t² e
+t·v: entra il punto nuovo, esce il più vecchio. Un buco nei dati oltre
+``max_gap_ms`` azzera la finestra, perché la pendenza non sarebbe più
+affidabile.
+"""
+
+from array import array
+from typing import Optional
+
+DEFAULT_WINDOW = 4  # 15 minuti di letture G7
+DEFAULT_HORIZON_MINUTES = 20
+DEFAULT_THRESHOLD = 70
+DEFAULT_MIN_SLOPE = -0.5  # mg/dL al minuto
+MAX_GAP_MS = 12 * 60 * 1000
+
+
+class SlopeEstimator:
+    """Retta di regressione sulle ultime ``window`` letture, aggiornata in O(1)."""
+
+    __slots__ = ("window", "max_gap_ms", "_times", "_values", "_start", "_size", "_origin",
+                 "_last_ms", "_st", "_sv", "_stt", "_stv")
+
+    def __init__(self, window: int = DEFAULT_WINDOW, max_gap_ms: int = MAX_GAP_MS):
+        self.window = window
+        self.max_gap_ms = max_gap_ms
+        self._times = array("d", bytes(8 * window))
+        self._values = array("d", bytes(8 * window))
+        self.reset()
+
+    def reset(self):
+        self._start = 0
+        self._size = 0
+        self._origin = 0
+        self._last_ms = None
+        self._st = self._sv = self._stt = self._stv = 0.0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def update(self, date_ms: int, value: float) -> bool:
+        """Aggiunge una lettura; ignora quelle non più recenti dell'ultima."""
+
+        if self._last_ms is not None:
+            if date_ms <= self._last_ms:
+                return False
+            if date_ms - self._last_ms > self.max_gap_ms:
+                self.reset()
+        if self._size == 0:
+            # Tempi in minuti relativi alla prima lettura della finestra: numeri piccoli, somme precise
+            self._origin = date_ms
+        self._last_ms = date_ms
+        t = (date_ms - self._origin) / 60_000
+
+        if self._size == self.window:
+            old_t = self._times[self._start]
+            old_v = self._values[self._start]
+            self._st -= old_t
+            self._sv -= old_v
+            self._stt -= old_t * old_t
+            self._stv -= old_t * old_v
+            slot = self._start
+            self._start = (self._start + 1) % self.window
+        else:
+            slot = (self._start + self._size) % self.window
+            self._size += 1
+
+        self._times[slot] = t
+        self._values[slot] = value
+        self._st += t
+        self._sv += value
+        self._stt += t * t
+        self._stv += t * value
+        return True
+
+    @property
+    def slope(self) -> Optional[float]:
+        """Pendenza in mg/dL al minuto, None con meno di due letture."""
+
+        n = self._size
+        if n < 2:
+            return None
+        denominator = n * self._stt - self._st * self._st
+        if denominator <= 0:
+            return None
+        return (n * self._stv - self._st * self._sv) / denominator
+
+    def projected(self, horizon_minutes: float) -> Optional[float]:
+        """Valore previsto ``horizon_minutes`` dopo l'ultima lettura."""
+
+        slope = self.slope
+        if slope is None:
+            return None
+        n = self._size
+        last_t = (self._last_ms - self._origin) / 60_000
+        return self._sv / n + slope * (last_t + horizon_minutes - self._st / n)
+
+
+class PredictiveLow:
+    """Segnala quando la retta prevede una glicemia sotto soglia entro l'orizzonte.
+
+    Scatta solo se il valore attuale è ancora sopra soglia (le regole classiche
+    coprono già le glicemie basse) e la discesa è almeno ``min_slope``.
+    """
+
+    def __init__(self, horizon_minutes: float = DEFAULT_HORIZON_MINUTES, threshold: float = DEFAULT_THRESHOLD,
+                 window: int = DEFAULT_WINDOW, min_slope: float = DEFAULT_MIN_SLOPE, min_points: int = 3):
+        self.horizon_minutes = horizon_minutes
+        self.threshold = threshold
+        self.min_slope = min_slope
+        self.min_points = min_points
+        self.estimator = SlopeEstimator(window)
+        self._current = None
+
+    def update(self, date_ms: int, value: float) -> bool:
+        if self.estimator.update(date_ms, value):
+            self._current = value
+            return True
+        return False
+
+    def check(self) -> Optional[float]:
+        """Glicemia prevista se l'allarme deve scattare, altrimenti None."""
+
+        if len(self.estimator) < self.min_points or self._current is None:
+            return None
+        if self._current < self.threshold:
+            return None
+        slope = self.estimator.slope
+        if slope is None or slope > self.min_slope:
+            return None
+        projected = self.estimator.projected(self.horizon_minutes)
+        return projected if projected < self.threshold else None
@@ -0,0 +1,122 @@
+"""Storico recente delle glicemie in un buffer circolare a dimensione fissa.
+
+Le regole di allarme guardano solo le ultime letture: invece di rileggere
+MongoDB a ogni ciclo, lo storico viene caricato una volta all'avvio e poi
+aggiornato con ogni nuova lettura G7. Valori, trend e date sono salvati in
+``array`` preallocati, quindi un aggiornamento non alloca oggetti nuovi.
+"""
+
+from array import array
+from typing import Iterable, Optional
+
+from pydexcom.const import DEXCOM_TREND_ARROWS, DEXCOM_TREND_DIRECTIONS
+
+DEFAULT_CAPACITY = 36  # 3 ore di letture ogni 5 minuti
+
+_TREND_CODES = {arrow: code for code, arrow in enumerate(DEXCOM_TREND_ARROWS) if arrow}
+_TREND_CODES.update(DEXCOM_TREND_DIRECTIONS)
+_UNKNOWN_TREND = DEXCOM_TREND_ARROWS.index("-")
+
+
+def trend_code(trend) -> int:
+    """Codice numerico pydexcom per una freccia (``"→"``) o una direction (``"Flat"``)."""
+
+    return _TREND_CODES.get(trend, _UNKNOWN_TREND)
+
+
+class GlucoseHistory:
+    """Buffer circolare di (valore, trend, epoch ms) dal più vecchio al più recente.
+
+    Gli indici funzionano come in una lista: ``value(-1)`` è l'ultima lettura.
+    """
+
+    __slots__ = ("capacity", "_values", "_trends", "_dates", "_start", "_size")
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._values = array("d", bytes(8 * capacity))
+        self._trends = array("b", bytes(capacity))
+        self._dates = array("q", bytes(8 * capacity))
+        self._start = 0
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _slot(self, index: int) -> int:
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("indice fuori dallo storico")
+        return (self._start + index) % self.capacity
+
+    def append(self, value: float, trend, date_ms: int) -> bool:
+        """Aggiunge una lettura; ignora quelle non più recenti dell'ultima salvata."""
+
+        if self._size and date_ms <= self._dates[self._slot(-1)]:
+            return False
+        # I lettori non prendono lock: la lettura va scritta nello slot prima
+        # di renderla visibile spostando _size/_start.
+        full = self._size == self.capacity
+        slot = (self._start + self._size) % self.capacity
+        self._values[slot] = value
+        self._trends[slot] = trend if isinstance(trend, int) else trend_code(trend)
+        self._dates[slot] = date_ms
+        if full:
+            self._start = (self._start + 1) % self.capacity
+        else:
+            self._size += 1
+        return True
+
+    def seed(self, entries: Iterable[dict]) -> int:
+        """Carica entries Nightscout (``sgv``, ``direction``, ``date``) in qualunque ordine."""
+
+        added = 0
+        for entry in sorted(entries, key=lambda e: e["date"]):
+            added += self.append(float(entry["sgv"]), entry.get("direction", "→"), int(entry["date"]))
+        return added
+
+    def clear(self):
+        self._start = 0
+        self._size = 0
+
+    def value(self, index: int) -> float:
+        return self._values[self._slot(index)]
+
+    def trend(self, index: int) -> str:
+        return DEXCOM_TREND_ARROWS[self._trends[self._slot(index)]]
+
+    def trend_code(self, index: int) -> int:
+        return self._trends[self._slot(index)]
+
+    def date(self, index: int) -> int:
+        return self._dates[self._slot(index)]
+
+    def nearest(self, date_ms: int, tolerance_ms: int) -> Optional[int]:
+        """Indice della lettura più vicina a ``date_ms`` entro ``tolerance_ms``, se esiste."""
+
+        best, best_distance = None, tolerance_ms + 1
+        for index in range(self._size):
+            distance = abs(self._dates[(self._start + index) % self.capacity] - date_ms)
+            if distance < best_distance:
+                best, best_distance = index, distance
+        return best
+
+    def all_trend(self, count: int, arrow: str) -> bool:
+        """Vero se le ultime ``count`` letture hanno tutte la freccia ``arrow``."""
+
+        code = trend_code(arrow)
+        return self._size >= count and all(
+            self._trends[self._slot(-i)] == code for i in range(1, count + 1)
+        )
+
+    def max_value(self, count: int) -> float:
+        return max(self._values[self._slot(-i)] for i in range(1, min(count, self._size) + 1))
+
+    def min_value(self, count: int) -> float:
+        return min(self._values[self._slot(-i)] for i in range(1, min(count, self._size) + 1))
+
+    def strictly_decreasing(self, count: int) -> bool:
+        if self._size < count:
+            return False
+        return all(self.value(-i - 1) > self.value(-i) for i in range(1, count))
@@ -0,0 +1,489 @@
+"""Archivio delle glicemie su una time-series collection MongoDB, con rollup.
+
+La collection Nightscout ``entries`` ripete in ogni documento ``type``,
+``device`` e ``dateString`` e ha ``date`` in millisecondi. Qui le letture
+finiscono in una time-series collection (``glucose``): ``date`` è il campo
+temporale (BSON date) e ``meta`` contiene device e account, così MongoDB
+raggruppa le letture in bucket compressi e li scorre per intervallo. Con
+``retention_days`` i dati grezzi più vecchi vengono eliminati da MongoDB
+(``expireAfterSeconds``).
+
+Per i periodi lunghi restano i rollup orari (``glucose_1h``, ore UTC) e
+giornalieri (``glucose_1d``, giorni nel fuso configurato): conteggio, somma,
+somma dei quadrati, minimo e massimo, aggiornati con un ``$inc`` dalle sole
+letture appena inserite.
+
+``NightscoutView`` presenta la time-series collection con l'interfaccia di
+lettura di ``entries`` (``find``, ``find_one``, ``aggregate`` con ``date`` in
+millisecondi), quindi ``iter_range``, ``load_series`` e le altre query
+dell'app funzionano invariate. Per i lettori esterni ``create_entries_view``
+crea una vista MongoDB ``entries`` con lo stesso formato.
+"""
+
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pytz
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+from nightscout_entries import DEVICE, FlushReport
+
+RAW_COLLECTION = "glucose"
+ROLLUP_COLLECTIONS = {"1h": "glucose_1h", "1d": "glucose_1d"}
+ROLLUP_INDEX = "device_start"
+GRANULARITY = "minutes"
+MIN_DATE = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MAX_DATE = datetime(9999, 12, 31, tzinfo=timezone.utc)
+_MAX_MS = int(MAX_DATE.timestamp() * 1000)
+_RANGE_OPERATORS = ("$gt", "$gte", "$lt", "$lte", "$eq")
+
+
+def to_datetime(date_ms: int) -> datetime:
+    """Millisecondi Nightscout → BSON date, limitati all'intervallo rappresentabile."""
+
+    if date_ms <= 0:
+        return MIN_DATE
+    if date_ms >= _MAX_MS:
+        return MAX_DATE
+    return MIN_DATE + timedelta(milliseconds=date_ms)
+
+
+def to_ms(value: datetime) -> int:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int((value - MIN_DATE) / timedelta(milliseconds=1))
+
+
+def to_document(entry: dict, account: Optional[str] = None) -> dict:
+    meta = {"device": entry.get("device", DEVICE)}
+    if account:
+        meta["account"] = account
+    return {
+        "date": to_datetime(entry["date"]),
+        "meta": meta,
+        "sgv": entry["sgv"],
+        "direction": entry.get("direction", "Flat"),
+    }
+
+
+def to_entry(doc: dict) -> dict:
+    """Documento della time-series nel formato di una entry Nightscout."""
+
+    date_ms = to_ms(doc["date"])
+    entry = {
+        "type": "sgv",
+        "sgv": doc.get("sgv"),
+        "date": date_ms,
+        # Come build_entry: ora locale del server, senza fuso
+        "dateString": datetime.fromtimestamp(date_ms / 1000).strftime("%Y-%m-%dT%H:%M:%S"),
+        "direction": doc.get("direction", "Flat"),
+        "device": doc.get("meta", {}).get("device", DEVICE),
+    }
+    if "_id" in doc:
+        entry["_id"] = doc["_id"]
+    return entry
+
+
+def _translate_filter(query: Optional[dict]) -> dict:
+    """Filtro su ``entries`` (``date`` in ms, ``type``, ``device``) → filtro sulla time-series."""
+
+    translated = {}
+    for name, condition in (query or {}).items():
+        if name == "type":
+            if condition != "sgv":
+                # Nella time-series ci sono solo glicemie
+                return {"_id": {"$exists": False}}
+            continue
+        if name == "date":
+            if isinstance(condition, dict):
+                condition = {op: to_datetime(value) if op in _RANGE_OPERATORS else value
+                             for op, value in condition.items()}
+            else:
+                condition = to_datetime(condition)
+        elif name == "device":
+            name = "meta.device"
+        translated[name] = condition
+    return translated
+
+
+def _project(entry: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return entry
+    included = {name for name, flag in projection.items() if flag and name != "_id"}
+    keep_id = projection.get("_id", 1)
+    if not included:
+        result = {k: v for k, v in entry.items() if not (k in projection and not projection[k])}
+    else:
+        result = {k: v for k, v in entry.items() if k in included}
+        if keep_id and "_id" in entry:
+            result["_id"] = entry["_id"]
+    return result
+
+
+class _ViewCursor:
+    """Cursore sulla time-series che restituisce entries Nightscout."""
+
+    def __init__(self, collection, query: dict, projection: Optional[dict]):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort: List[Tuple[str, int]] = []
+        self._limit = 0
+        self._batch_size = 0
+        self._cursor = None
+
+    def sort(self, key, direction=ASCENDING):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        self._sort.extend(keys)
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    def batch_size(self, size: int):
+        self._batch_size = size
+        return self
+
+    def __iter__(self):
+        cursor = self._collection.find(self._query)
+        if self._sort:
+            cursor = cursor.sort(self._sort)
+        if self._limit:
+            cursor = cursor.limit(self._limit)
+        if self._batch_size:
+            cursor = cursor.batch_size(self._batch_size)
+        self._cursor = cursor
+        for doc in cursor:
+            yield _project(to_entry(doc), self._projection)
+
+    def close(self):
+        if self._cursor is not None:
+            self._cursor.close()
+
+
+class NightscoutView:
+    """Accesso in sola lettura alla time-series con le query scritte per ``entries``."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, query: Optional[dict] = None, projection: Optional[dict] = None) -> _ViewCursor:
+        return _ViewCursor(self.collection, _translate_filter(query), projection)
+
+    def find_one(self, query: Optional[dict] = None, projection: Optional[dict] = None, sort=None):
+        cursor = self.find(query, projection).limit(1)
+        if sort:
+            cursor.sort(sort)
+        return next(iter(cursor), None)
+
+    def count_documents(self, query: Optional[dict] = None) -> int:
+        return self.collection.count_documents(_translate_filter(query))
+
+    def aggregate(self, pipeline: List[dict], **kwargs):
+        """Esegue ``pipeline`` dopo aver riportato i documenti al formato Nightscout.
+
+        Il ``$match`` iniziale su ``date`` viene tradotto e anticipato, così
+        usa ancora l'indice temporale della time-series.
+        """
+
+        prefix = []
+        if pipeline and "$match" in pipeline[0]:
+            prefix.append({"$match": _translate_filter(pipeline[0]["$match"])})
+            pipeline = pipeline[1:]
+        prefix.append({"$addFields": {"type": "sgv", "device": "$meta.device", "date": {"$toLong": "$date"}}})
+        return self.collection.aggregate(prefix + list(pipeline), **kwargs)
+
+
+def _rollup_start(tier: str, date_ms: int, tz) -> int:
+    if tier == "1h":
+        return date_ms - date_ms % 3_600_000
+    local = datetime.fromtimestamp(date_ms / 1000, tz)
+    return int(tz.localize(datetime(local.year, local.month, local.day)).timestamp() * 1000)
+
+
+def _next_rollup_start(tier: str, start_ms: int, tz) -> int:
+    if tier == "1h":
+        return start_ms + 3_600_000
+    # 36 ore dopo la mezzanotte locale si è sempre nel giorno successivo, anche con l'ora legale
+    return _rollup_start(tier, start_ms + 36 * 3_600_000, tz)
+
+
+def _rollup_ceil(tier: str, date_ms: int, tz) -> int:
+    start = _rollup_start(tier, date_ms, tz)
+    return start if start == date_ms else _next_rollup_start(tier, start, tz)
+
+
+def retention_boundary(retention_days: Optional[float], tz, now: Optional[datetime] = None) -> Optional[int]:
+    """Mezzanotte locale da cui le glicemie grezze sono sicuramente tutte presenti; None senza retention.
+
+    Prima di questo istante MongoDB può aver già eliminato le letture, quindi
+    i rollup più vecchi non vanno ricalcolati dai dati grezzi.
+    """
+
+    if not retention_days:
+        return None
+    now = now or datetime.now(timezone.utc)
+    cutoff = to_ms(now - timedelta(days=retention_days))
+    return _rollup_ceil("1d", cutoff, tz)
+
+
+def update_rollups(db, entries: Iterable[dict], tz, collections: Dict[str, str] = ROLLUP_COLLECTIONS) -> int:
+    """Somma ``entries`` (appena inserite) ai rollup orari e giornalieri; restituisce i bucket toccati."""
+
+    entries = list(entries)
+    touched = 0
+    for tier, name in collections.items():
+        buckets: Dict[Tuple[str, int], dict] = {}
+        for entry in entries:
+            value = float(entry["sgv"])
+            device = entry.get("device", DEVICE)
+            key = (device, _rollup_start(tier, entry["date"], tz))
+            acc = buckets.get(key)
+            if acc is None:
+                acc = buckets[key] = {"count": 0, "sum": 0.0, "sum_sq": 0.0, "min": value, "max": value}
+            acc["count"] += 1
+            acc["sum"] += value
+            acc["sum_sq"] += value * value
+            acc["min"] = min(acc["min"], value)
+            acc["max"] = max(acc["max"], value)
+        if not buckets:
+            continue
+        db[name].bulk_write([
+            UpdateOne(
+                {"_id": f"{device}:{start}"},
+                {
+                    "$inc": {"count": acc["count"], "sum": acc["sum"], "sum_sq": acc["sum_sq"]},
+                    "$min": {"min": acc["min"]},
+                    "$max": {"max": acc["max"]},
+                    "$setOnInsert": {"device": device, "start": start},
+                },
+                upsert=True,
+            )
+            for (device, start), acc in sorted(buckets.items(), key=lambda item: item[0][1])
+        ], ordered=False)
+        touched += len(buckets)
+    return touched
+
+
+def rebuild_rollups(db, entries, tz, start_ms: Optional[int] = None, end_ms: Optional[int] = None,
+                    batch_size: int = 5000, collections: Dict[str, str] = ROLLUP_COLLECTIONS) -> int:
+    """Ricalcola dalle glicemie di ``entries`` (``entries`` o ``NightscoutView``) i rollup in ``[start_ms, end_ms)``.
+
+    Vengono cancellati e ricalcolati solo i bucket interamente compresi
+    nell'intervallo: quelli a cavallo dei limiti e quelli esterni restano
+    come sono. Senza limiti vengono ricalcolati tutti. Restituisce il numero
+    di letture sommate.
+    """
+
+    ranges: Dict[str, Tuple[Optional[int], Optional[int]]] = {}
+    for tier, name in collections.items():
+        low = _rollup_ceil(tier, start_ms, tz) if start_ms is not None else None
+        high = _rollup_start(tier, end_ms, tz) if end_ms is not None else None
+        if low is not None and high is not None and low >= high:
+            continue
+        bounds = {}
+        if low is not None:
+            bounds["$gte"] = low
+        if high is not None:
+            bounds["$lt"] = high
+        db[name].delete_many({"start": bounds} if bounds else {})
+        ranges[tier] = (low, high)
+    if not ranges:
+        return 0
+
+    lows = [low for low, _ in ranges.values()]
+    highs = [high for _, high in ranges.values()]
+    scan = {}
+    if None not in lows:
+        scan["$gte"] = min(lows)
+    if None not in highs:
+        scan["$lt"] = max(highs)
+    after, total = None, 0
+    while True:
+        date_filter = dict(scan) if after is None else dict(scan, **{"$gt": after})
+        query = {"type": "sgv", "date": date_filter} if date_filter else {"type": "sgv"}
+        docs = list(entries.find(query, {"_id": 0, "sgv": 1, "date": 1, "device": 1})
+                    .sort("date", ASCENDING).limit(batch_size))
+        if not docs:
+            return total
+        valid = [doc for doc in docs if isinstance(doc.get("sgv"), (int, float))]
+        counted = set()
+        for tier, (low, high) in ranges.items():
+            inside = [doc for doc in valid
+                      if (low is None or doc["date"] >= low) and (high is None or doc["date"] < high)]
+            update_rollups(db, inside, tz, {tier: collections[tier]})
+            counted.update(id(doc) for doc in inside)
+        total += len(counted)
+        after = docs[-1]["date"]
+
+
+def read_rollups(db, tier: str, start_ms: int, end_ms: int, device: str = DEVICE) -> List[dict]:
+    """Bucket del livello ``tier`` in ``[start_ms, end_ms)`` con media e deviazione standard."""
+
+    docs = db[ROLLUP_COLLECTIONS[tier]].find(
+        {"device": device, "start": {"$gte": start_ms, "$lt": end_ms}}, {"_id": 0}
+    ).sort("start", ASCENDING)
+    result = []
+    for doc in docs:
+        count = doc["count"]
+        mean = doc["sum"] / count
+        variance = max(0.0, doc["sum_sq"] / count - mean * mean)
+        result.append({
+            "start": doc["start"],
+            "count": count,
+            "mean": round(mean, 1),
+            "sd": round(variance ** 0.5, 1),
+            "min": doc["min"],
+            "max": doc["max"],
+        })
+    return result
+
+
+def ensure_rollup_indexes(db, collections: Dict[str, str] = ROLLUP_COLLECTIONS):
+    for name in collections.values():
+        db[name].create_index([("device", ASCENDING), ("start", ASCENDING)], name=ROLLUP_INDEX)
+
+
+def ensure_timeseries(db, name: str = RAW_COLLECTION, retention_days: Optional[float] = None) -> bool:
+    """Crea la time-series collection se manca e allinea la retention; True se l'ha creata."""
+
+    expire = int(retention_days * 86_400) if retention_days else None
+    if name not in db.list_collection_names():
+        options = {"timeseries": {"timeField": "date", "metaField": "meta", "granularity": GRANULARITY}}
+        if expire:
+            options["expireAfterSeconds"] = expire
+        db.create_collection(name, **options)
+        db[name].create_index([("meta.device", ASCENDING), ("date", DESCENDING)], name="device_date")
+        return True
+    db.command({"collMod": name, "expireAfterSeconds": expire if expire else "off"})
+    return False
+
+
+def create_entries_view(db, tz_name: str, name: str = "entries", source: str = RAW_COLLECTION):
+    """Vista MongoDB in formato Nightscout sopra la time-series, per i lettori esterni."""
+
+    db.create_collection(name, viewOn=source, pipeline=[{"$project": {
+        "type": {"$literal": "sgv"},
+        "sgv": 1,
+        "date": {"$toLong": "$date"},
+        "dateString": {"$dateToString": {"format": "%Y-%m-%dT%H:%M:%S", "date": "$date", "timezone": tz_name}},
+        "direction": 1,
+        "device": "$meta.device",
+    }}])
+
+
+class TimeSeriesWriter:
+    """Stessa interfaccia di ``EntryWriter``, con scrittura sulla time-series.
+
+    Le time-series collection non hanno indici univoci: prima dell'inserimento
+    si leggono le date già presenti nell'intervallo del lotto e si scartano.
+    Controllo e inserimento sono serializzati all'interno del processo (sync e
+    ``/backfill`` insieme), ma non tra processi: sulla stessa time-series deve
+    scrivere un solo processo, il leader del lease (vedi README).
+    """
+
+    def __init__(self, collection, account: Optional[str] = None):
+        self._collection = collection
+        self._account = account
+        self._lock = threading.Lock()
+        # Controllo dei duplicati e inserimento non devono alternarsi tra due flush
+        self._flush_lock = threading.Lock()
+        self._buffer: Dict[Tuple[str, int], dict] = {}
+        self.inserted = 0
+        self.deduped = 0
+        self.flushes = 0
+
+    def add(self, entry: dict):
+        key = (entry["device"], entry["date"])
+        with self._lock:
+            if key in self._buffer:
+                self.deduped += 1
+            self._buffer[key] = entry
+
+    def add_many(self, entries: List[dict]):
+        for entry in entries:
+            self.add(entry)
+
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def _restore(self, entries: List[dict]):
+        with self._lock:
+            for entry in entries:
+                self._buffer.setdefault((entry["device"], entry["date"]), entry)
+
+    def _existing(self, entries: List[dict]) -> set:
+        existing = set()
+        for device in {entry["device"] for entry in entries}:
+            dates = [entry["date"] for entry in entries if entry["device"] == device]
+            cursor = self._collection.find(
+                {"meta.device": device, "date": {"$gte": to_datetime(min(dates)), "$lte": to_datetime(max(dates))}},
+                {"date": 1, "_id": 0},
+            )
+            existing.update((device, to_ms(doc["date"])) for doc in cursor)
+        return existing
+
+    def flush(self) -> FlushReport:
+        with self._flush_lock:
+            with self._lock:
+                if not self._buffer:
+                    return FlushReport(0, 0)
+                entries = sorted(self._buffer.values(), key=lambda e: e["date"])
+                self._buffer = {}
+
+            try:
+                existing = self._existing(entries)
+                new = [entry for entry in entries if (entry["device"], entry["date"]) not in existing]
+                if new:
+                    self._collection.insert_many([to_document(entry, self._account) for entry in new],
+                                                 ordered=True)
+            except Exception:
+                self._restore(entries)
+                raise
+        report = FlushReport(len(new), len(entries) - len(new), tuple(new))
+        with self._lock:
+            self.inserted += report.inserted
+            self.deduped += report.deduped
+            self.flushes += 1
+        return report
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "inserted": self.inserted,
+            "deduped": self.deduped,
+            "flushes": self.flushes,
+            "pending": self.pending(),
+        }
+
+
+class GlucoseStore:
+    """Time-series, rollup e vista Nightscout di un database."""
+
+    def __init__(self, db, tz_name: str, retention_days: Optional[float] = None, account: Optional[str] = None,
+                 raw: str = RAW_COLLECTION):
+        self.db = db
+        self.tz_name = tz_name
+        self.tz = pytz.timezone(tz_name)
+        self.retention_days = retention_days
+        self.raw_name = raw
+        self.raw = db[raw]
+        self.entries = NightscoutView(self.raw)
+        self.writer = TimeSeriesWriter(self.raw, account)
+
+    def ensure(self) -> bool:
+        ensure_rollup_indexes(self.db)
+        return ensure_timeseries(self.db, self.raw_name, self.retention_days)
+
+    def rebuild_rollups(self) -> int:
+        """Ricalcola i rollup coperti dai dati grezzi, senza toccare quelli già oltre la retention."""
+
+        return rebuild_rollups(self.db, self.entries, self.tz,
+                               start_ms=retention_boundary(self.retention_days, self.tz))
+
+    def update_rollups(self, entries: Iterable[dict]) -> int:
+        return update_rollups(self.db, entries, self.tz)
+
+    def rollups(self, tier: str, start_ms: int, end_ms: int, device: str = DEVICE) -> List[dict]:
+        return read_rollups(self.db, tier, start_ms, end_ms, device)
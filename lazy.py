@@ -0,0 +1,51 @@
+"""Oggetti creati al primo utilizzo, in modo thread-safe.
+
+``Lazy(factory)`` si comporta come l'oggetto restituito da ``factory``, che
+però viene chiamata solo al primo accesso a un attributo. L'accesso per
+indice resta differito: ``Lazy(client)["nightscout"]["entries"]`` è a sua
+volta un ``Lazy``, così database e collection possono essere definiti
+all'import senza aprire connessioni (con un URI ``mongodb+srv://`` anche la
+sola costruzione di ``MongoClient`` interroga il DNS).
+"""
+
+import threading
+from typing import Any, Callable
+
+_UNSET = object()
+
+
+class Lazy:
+    __slots__ = ("_factory", "_value", "_lock", "_name")
+
+    def __init__(self, factory: Callable[[], Any], name: str = ""):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_value", _UNSET)
+        object.__setattr__(self, "_lock", threading.Lock())
+        object.__setattr__(self, "_name", name or getattr(factory, "__name__", "lazy"))
+
+    def resolve(self) -> Any:
+        value = object.__getattribute__(self, "_value")
+        if value is _UNSET:
+            with object.__getattribute__(self, "_lock"):
+                value = object.__getattribute__(self, "_value")
+                if value is _UNSET:
+                    value = object.__getattribute__(self, "_factory")()
+                    object.__setattr__(self, "_value", value)
+        return value
+
+    @property
+    def initialized(self) -> bool:
+        return object.__getattribute__(self, "_value") is not _UNSET
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.resolve(), name)
+
+    def __setattr__(self, name: str, value: Any):
+        setattr(self.resolve(), name, value)
+
+    def __getitem__(self, key) -> "Lazy":
+        return Lazy(lambda: self.resolve()[key], f"{object.__getattribute__(self, '_name')}[{key!r}]")
+
+    def __repr__(self) -> str:
+        state = "creato" if self.initialized else "non ancora creato"
+        return f"<Lazy {object.__getattribute__(self, '_name')} ({state})>"
@@ -0,0 +1,168 @@
+"""Lease su MongoDB per eleggere un solo processo leader.
+
+Tutti i worker (e tutte le istanze) servono le route di lettura, ma solo il
+titolare del lease esegue sincronizzazione, allarmi e ping post-pasto. Il
+lease è un documento ``{_id, owner, expires_at}``: il titolare lo rinnova ogni
+``renew_every`` secondi, gli altri provano a prenderlo con lo stesso update
+condizionato e ci riescono solo quando è scaduto. Alla chiusura il titolare
+lo cancella, così il passaggio di consegne è immediato; se invece il processo
+muore, un altro subentra entro ``ttl + renew_every`` secondi. Un indice TTL su
+``expires_at`` ripulisce i lease abbandonati.
+"""
+
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+DEFAULT_NAME = "sync"
+DEFAULT_TTL = 60
+TTL_INDEX = "expires_at_ttl"
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class LeaderLease:
+    """Lease rinnovato da un thread di heartbeat, con callback sui cambi di ruolo."""
+
+    def __init__(
+        self,
+        collection,
+        name: str = DEFAULT_NAME,
+        owner: Optional[str] = None,
+        ttl: float = DEFAULT_TTL,
+        renew_every: Optional[float] = None,
+        on_acquired: Optional[Callable[[], None]] = None,
+        on_lost: Optional[Callable[[], None]] = None,
+        on_standby: Optional[Callable[[], None]] = None,
+        clock: Callable[[], datetime] = _utcnow,
+    ):
+        self.collection = collection
+        self.name = name
+        self.owner = owner or default_owner()
+        self.ttl = ttl
+        self.renew_every = renew_every or ttl / 3
+        self._on_acquired = on_acquired
+        self._on_lost = on_lost
+        self._on_standby = on_standby
+        self._clock = clock
+        self._leader = False
+        self._expires_at: Optional[datetime] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.acquisitions = 0
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leader
+
+    def ensure_indexes(self):
+        self.collection.create_index("expires_at", name=TTL_INDEX, expireAfterSeconds=0)
+
+    def _set_leader(self, leader: bool):
+        if leader == self._leader:
+            return
+        self._leader = leader
+        callback = self._on_acquired if leader else self._on_lost
+        if leader:
+            self.acquisitions += 1
+        print(f"[LEASE] {self.owner} {'è leader' if leader else 'non è più leader'} ({self.name})")
+        if callback is not None:
+            try:
+                callback()
+            except Exception as e:
+                print(f"❌ Errore cambio di ruolo: {e}")
+
+    def try_acquire(self) -> bool:
+        """Rinnova il lease se è nostro o lo prende se è scaduto; True se siamo leader."""
+
+        with self._lock:
+            now = self._clock()
+            expires_at = now + timedelta(seconds=self.ttl)
+            try:
+                self.collection.find_one_and_update(
+                    {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                    {"$set": {"owner": self.owner, "expires_at": expires_at, "renewed_at": now}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+            except DuplicateKeyError:
+                # Il documento esiste, è di un altro ed è ancora valido
+                self._expires_at = None
+                self._set_leader(False)
+                return False
+            except PyMongoError as e:
+                # Senza conferma si resta leader solo finché il lease già ottenuto è valido
+                print(f"❌ Errore rinnovo lease: {e}")
+                if self._leader and (self._expires_at is None or now >= self._expires_at):
+                    self._set_leader(False)
+                return self._leader
+            self._expires_at = expires_at
+            self._set_leader(True)
+            return True
+
+    def release(self):
+        """Cede il lease (passaggio di consegne immediato a un altro processo)."""
+
+        with self._lock:
+            if not self._leader:
+                return
+            try:
+                self.collection.delete_one({"_id": self.name, "owner": self.owner})
+            except PyMongoError as e:
+                print(f"❌ Errore rilascio lease: {e}")
+            self._expires_at = None
+            self._set_leader(False)
+
+    def holder(self) -> Optional[dict]:
+        return self.collection.find_one({"_id": self.name})
+
+    def tick(self):
+        if not self.try_acquire() and self._on_standby is not None:
+            try:
+                self._on_standby()
+            except Exception as e:
+                print(f"❌ Errore in attesa del lease: {e}")
+
+    def _run(self):
+        try:
+            self.ensure_indexes()
+        except PyMongoError as e:
+            print(f"❌ Errore creazione indice lease: {e}")
+        self.tick()
+        while not self._stop.wait(self.renew_every):
+            self.tick()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=f"lease-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self, release: bool = True):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(5)
+        if release:
+            self.release()
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "owner": self.owner,
+            "leader": self._leader,
+            "expires_at": self._expires_at.isoformat() if self._expires_at else None,
+            "acquisitions": self.acquisitions,
+        }
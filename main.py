@@ -1,14 +1,37 @@
 
-from flask import Flask, jsonify, request
-from dexcom_g7 import get_g7_reading
+from flask import Flask, Response, jsonify, request
+from dexcom_g7 import get_cached_g7_reading, get_fresh_g7_reading, get_g7_readings
 from dotenv import load_dotenv
 from flask_cors import CORS
 import os
-import requests
-from threading import Timer
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.mongodb import MongoDBJobStore
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+from nightscout_entries import DUPLICATE_KEY_CODE, RANGE_FIELDS, EntryWriter, build_entry, ensure_indexes, iter_range
+from glucose_history import GlucoseHistory
+from daily_stats import ensure_stats_indexes, read_range, rebuild_daily_stats, summarize, update_daily_stats
+from alert_rules import RuleEngine, lead_times, load_config, replay
+from telegram_notifier import TelegramNotifier
+from reading_hub import DEFAULT_MAX_SUBSCRIBERS, HubFull, ReadingHub, max_subscribers_for, sse_stream
+from account_sync import DEFAULT_WORKERS, AccountSync, SyncEngine, load_accounts
+from leader_lease import DEFAULT_TTL, LeaderLease
+from adaptive_polling import PublishSchedule
+from outbox import Outbox, SupabaseSink
+from glucose_store import (ROLLUP_COLLECTIONS, GlucoseStore, read_rollups, rebuild_rollups, retention_boundary,
+                           update_rollups)
+from lazy import Lazy
+import atexit
+import metrics
+from metrics import timed
+import json
+import math
 import time
+import pytz
+import threading
 
 # --- Carica variabili ambiente ---
 load_dotenv()
@@ -19,22 +42,76 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 MONGO_URI = os.getenv("MONGO_URI")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 CHAT_IDS = [cid.strip() for cid in os.getenv("TELEGRAM_CHAT_IDS", "").split(",") if cid.strip()]
+TIMEZONE = os.getenv("TIMEZONE", "Europe/Rome")
 
 # --- Flask App ---
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
-# --- Headers per Supabase ---
-headers = {
-    "apikey": SUPABASE_KEY,
-    "Authorization": f"Bearer {SUPABASE_KEY}",
-    "Content-Type": "application/json",
-}
-
 # --- Connessione a MongoDB ---
-mongo_client = MongoClient(MONGO_URI)
+# Il client nasce al primo utilizzo: /health risponde prima di qualsiasi
+# connessione (con mongodb+srv:// anche la costruzione interroga il DNS).
+mongo_client = Lazy(lambda: MongoClient(MONGO_URI), "mongo_client")
 mongo_db = mongo_client["nightscout"]
-entries_collection = mongo_db.entries
+daily_stats_collection = mongo_db["daily_stats"]
+
+# --- Archivio: collection Nightscout "entries" oppure time-series "glucose" ---
+# Con GLUCOSE_STORAGE=timeseries (dopo migrate_timeseries.py) le stesse query
+# passano da NightscoutView; RAW_RETENTION_DAYS elimina i dati grezzi più vecchi.
+ARCHIVIO_TIMESERIES = os.getenv("GLUCOSE_STORAGE", "entries").strip().lower() == "timeseries"
+if ARCHIVIO_TIMESERIES:
+    archivio = GlucoseStore(mongo_db, TIMEZONE, float(os.getenv("RAW_RETENTION_DAYS", "0")) or None)
+    entries_collection = archivio.entries
+    entries_writer = archivio.writer
+else:
+    archivio = None
+    entries_collection = mongo_db["entries"]
+    entries_writer = EntryWriter(entries_collection)
+
+# --- Scheduler: un solo thread a heap, job dei pasti salvati su Mongo ---
+# I ping post-pasto sopravvivono ai riavvii; se il servizio era spento
+# all'orario previsto vengono eseguiti alla ripartenza (entro 6 ore).
+scheduler = BackgroundScheduler(
+    jobstores={
+        "default": MongoDBJobStore(database="nightscout", collection="scheduled_jobs", client=mongo_client),
+        "memoria": MemoryJobStore(),
+    },
+    executors={
+        "default": ThreadPoolExecutor(2),
+        # Letture degli account aggiuntivi: pochi thread anche con centinaia di account
+        "account": ThreadPoolExecutor(int(os.getenv("SYNC_WORKERS", DEFAULT_WORKERS))),
+    },
+    job_defaults={"coalesce": True, "misfire_grace_time": 6 * 3600, "max_instances": 1},
+    timezone=timezone.utc,
+)
+PING_PASTO = (("t1", 60), ("t2", 90), ("t3", 180))
+INTERVALLO_SYNC = 300
+
+# --- Storico in memoria per le regole di allarme ---
+storico = GlucoseHistory()
+
+# --- Client in ascolto su /glicemia/stream ---
+# Ogni client occupa un thread gunicorn: il limite resta sotto GUNICORN_THREADS
+# così /health e le API hanno sempre thread liberi
+THREAD_GUNICORN = int(os.getenv("GUNICORN_THREADS", "8"))
+hub_letture = ReadingHub(max_subscribers=max_subscribers_for(
+    THREAD_GUNICORN, int(os.getenv("SSE_MAX_CLIENT", DEFAULT_MAX_SUBSCRIBERS))))
+CAMPI_EVENTO = ("sgv", "date", "dateString", "direction")
+
+# --- Regole di allarme (ALERT_RULES_FILE per sostituire quelle predefinite) ---
+regole_allarme = RuleEngine(load_config())
+
+# --- Metriche (METRICS_ENABLED=0 per disattivarle) ---
+DURATA_MONGO = metrics.histogram("mongo_operation_seconds", "Durata di scritture e letture MongoDB",
+                                 labels=("operation",))
+DURATA_REGOLE = metrics.histogram("alert_rules_evaluation_seconds", "Durata di monitor_loop",
+                                  buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1))
+ETA_LETTURA = metrics.gauge("glucose_reading_age_at_ingest_seconds",
+                            "Età dell'ultima glicemia nuova quando è stata acquisita")
+LETTURA_ALLARME = metrics.gauge("glucose_reading_to_alert_seconds",
+                                "Tempo tra l'ultima glicemia e l'ultimo allarme inviato")
+metrics.gauge("process_active_threads", "Thread attivi nel processo", threading.active_count)
+metrics.gauge("sse_subscribers", "Client collegati a /glicemia/stream", lambda: hub_letture.subscribers)
 
 
 @app.route("/health", methods=["GET"])
@@ -42,36 +119,145 @@ def health():
     """Health check che non dipende dai servizi esterni."""
     return jsonify({"status": "ok", "device": "dexcom-g7"})
 
+def aggiorna_statistiche(report):
+    """Somma alle statistiche giornaliere e ai rollup solo le entries davvero nuove."""
+    try:
+        if report.inserted_entries:
+            tz = pytz.timezone(TIMEZONE)
+            update_daily_stats(daily_stats_collection, report.inserted_entries, tz)
+            update_rollups(mongo_db, report.inserted_entries, tz)
+    except Exception as e:
+        print(f"❌ Errore aggiornamento statistiche: {e}")
+
+@timed(DURATA_MONGO, "write")
 def scrivi_glicemia_su_mongo(valore, timestamp, direction="Flat"):
     try:
-        entry = {
-            "type": "sgv",
-            "sgv": valore,
-            "dateString": timestamp.strftime("%Y-%m-%dT%H:%M:%S"),
-            "date": int(timestamp.timestamp() * 1000),
-            "direction": direction,
-            "device": "dexcom-g7"
-        }
-        result = entries_collection.insert_one(entry)
-        print(f"[MONGO] Scritta glicemia {valore} - ID: {result.inserted_id}")
+        entries_writer.add(build_entry(valore, timestamp, direction))
+        report = entries_writer.flush()
+        aggiorna_statistiche(report)
+        if report.inserted:
+            print(f"[MONGO] Scritta glicemia {valore}")
+        else:
+            print(f"[MONGO] Glicemia {valore} già presente, nessuna scrittura")
     except Exception as e:
         print(f"❌ Errore scrittura Mongo: {e}")
 
+def prepara_indici():
+    try:
+        ensure_stats_indexes(daily_stats_collection)
+        if archivio is not None:
+            if archivio.ensure():
+                print("[MONGO] Creata la time-series collection glucose")
+            return
+        ensure_indexes(entries_collection)
+    except OperationFailure as e:
+        if e.code != DUPLICATE_KEY_CODE:
+            print(f"❌ Errore creazione indici Mongo: {e}")
+        else:
+            print("⚠️ entries contiene duplicati: indice univoco non creato, "
+                  "lanciare flask --app main rimuovi-duplicati")
+    except Exception as e:
+        print(f"❌ Errore creazione indici Mongo: {e}")
+
+@app.cli.command("rimuovi-duplicati")
+def rimuovi_duplicati_command():
+    """Cancella le entries duplicate (resta quella con _id minore) e crea l'indice univoco."""
+    if archivio is not None:
+        print("[MONGO] Con GLUCOSE_STORAGE=timeseries non c'è un indice univoco da creare")
+        return
+    rimossi = ensure_indexes(entries_collection, remove_duplicates=True)
+    print(f"[MONGO] Rimossi {rimossi} duplicati, indice univoco creato")
+
+# Share conserva al massimo 24 ore / 288 letture
+BACKFILL_MINUTI = 1440
+BACKFILL_MAX_LETTURE = 288
+
+def backfill_glicemie(minuti=BACKFILL_MINUTI):
+    """Recupera in una sola chiamata Share le letture mancanti dopo l'ultima salvata."""
+    try:
+        with timed(DURATA_MONGO, "query"):
+            ultimo = entries_collection.find_one({"type": "sgv"}, {"date": 1}, sort=[("date", -1)])
+        ultimo_ms = ultimo["date"] if ultimo else 0
+        if ultimo:
+            mancanti = math.ceil((time.time() * 1000 - ultimo_ms) / 60000)
+            minuti = min(minuti, mancanti)
+        minuti = max(1, min(minuti, BACKFILL_MINUTI))
+        max_letture = max(1, min(BACKFILL_MAX_LETTURE, minuti // 5 + 1))
+
+        letture = get_g7_readings(minutes=minuti, max_count=max_letture)
+        entries_writer.add_many([
+            build_entry(r.value, r.time, r.trend_arrow or "Flat")
+            for r in reversed(letture)
+            if int(r.time.timestamp() * 1000) > ultimo_ms
+        ])
+        report = entries_writer.flush()
+        aggiorna_statistiche(report)
+        print(f"[BACKFILL] {report.inserted} glicemie recuperate, {report.deduped} già presenti "
+              f"(finestra {minuti} min)")
+        return report.inserted
+    except Exception as e:
+        print(f"❌ Errore backfill: {e}")
+        return 0
+
+# --- Outbox: le scritture su Supabase partono da un thread, a lotti e con ritentativi ---
+outbox = Outbox(mongo_db["outbox"], {
+    "supabase": SupabaseSink(SUPABASE_URL, SUPABASE_KEY, "analisi_dati"),
+})
+metrics.gauge("outbox_backlog", "Voci dell'outbox in attesa di consegna", lambda: outbox.pending)
+
+def aggiorna_valori_pasto(id_pasto, valori):
+    """Accoda i campi del pasto: i valori dello stesso pasto partono in un unico PATCH Supabase."""
+    outbox.append("supabase", id_pasto, valori)
+    print(f"[SUPABASE] {valori} accodati per il pasto {id_pasto}")
+
 def aggiorna_valore_tempo(id_pasto, campo, valore):
+    aggiorna_valori_pasto(id_pasto, {campo: valore})
+
+# Una lettura ogni 5 minuti: entro 5 minuti c'è sempre la più vicina, anche se ne manca una
+TOLLERANZA_PING_MS = 5 * 60 * 1000
+
+def lettura_vicina(obiettivo_ms, tolleranza_ms=TOLLERANZA_PING_MS):
+    """Glicemia già acquisita più vicina all'orario obiettivo; Share solo se manca."""
+    indice = storico.nearest(obiettivo_ms, tolleranza_ms)
+    if indice is not None:
+        return storico.value(indice)
+
     try:
-        url = f"{SUPABASE_URL}/rest/v1/analisi_dati?id=eq.{id_pasto}"
-        payload = {campo: valore}
-        res = requests.patch(url, headers=headers, json=payload)
-        print(f"[SUPABASE] {campo}: {valore} -> {res.status_code}")
+        with timed(DURATA_MONGO, "query"):
+            candidati = [
+                entries_collection.find_one(
+                    {"type": "sgv", "date": {"$lte": obiettivo_ms, "$gte": obiettivo_ms - tolleranza_ms}},
+                    {"sgv": 1, "date": 1}, sort=[("date", -1)]),
+                entries_collection.find_one(
+                    {"type": "sgv", "date": {"$gt": obiettivo_ms, "$lte": obiettivo_ms + tolleranza_ms}},
+                    {"sgv": 1, "date": 1}, sort=[("date", 1)]),
+            ]
+        candidati = [c for c in candidati if c]
+        if candidati:
+            return float(min(candidati, key=lambda c: abs(c["date"] - obiettivo_ms))["sgv"])
     except Exception as e:
-        print(f"Errore PATCH Supabase: {e}")
+        print(f"❌ Errore ricerca glicemia su Mongo: {e}")
+
+    # L'ultima lettura di Share vale solo se cade nella finestra dell'obiettivo:
+    # un ping recuperato dopo un riavvio non deve prendere il valore di adesso
+    reading = get_cached_g7_reading().reading
+    if reading is None or abs(_ms(reading.time) - obiettivo_ms) > tolleranza_ms:
+        return None
+    return float(reading.value)
+
+def _ms(istante):
+    return int(istante.timestamp() * 1000)
 
-def invia_ping(id_pasto, campo):
+def invia_ping(id_pasto, campo, obiettivo=None):
+    """Salva su Supabase la glicemia più vicina all'istante del ping.
+
+    Dopo un riavvio più ping dello stesso pasto possono scattare insieme:
+    l'outbox unisce i valori per pasto, quindi finiscono di norma in un solo PATCH.
+    """
     try:
-        reading = get_g7_reading()
-        if reading:
-            valore = float(reading.value)
-            aggiorna_valore_tempo(id_pasto, campo, valore)
+        valore = lettura_vicina(_ms(obiettivo or datetime.now(timezone.utc)))
+        if valore is not None:
+            aggiorna_valori_pasto(id_pasto, {campo: valore})
     except Exception as e:
         print(f"Errore ping {campo}: {e}")
 
@@ -83,102 +269,390 @@ def pianifica_ping():
         if not id_pasto:
             return jsonify({"errore": "ID del pasto mancante"}), 400
 
-        Timer(60 * 60, invia_ping, args=[id_pasto, "t1"]).start()
-        Timer(90 * 60, invia_ping, args=[id_pasto, "t2"]).start()
-        Timer(180 * 60, invia_ping, args=[id_pasto, "t3"]).start()
+        adesso = datetime.now(timezone.utc)
+        for campo, minuti in PING_PASTO:
+            obiettivo = adesso + timedelta(minutes=minuti)
+            scheduler.add_job(
+                invia_ping, "date",
+                run_date=obiettivo,
+                args=[id_pasto, campo, obiettivo],
+                id=f"ping-{id_pasto}-{campo}",
+                replace_existing=True,
+            )
+
+        return jsonify({"messaggio": "Ping pianificati"})
+    except Exception as e:
+        return jsonify({"errore": str(e)}), 500
 
-        return jsonify({"messaggio": "Ping pianificati (via Timer)"})
+@app.route("/ping-pianificati", methods=["GET"])
+def ping_pianificati():
+    try:
+        return jsonify([{
+            "id": job.id,
+            "pasto": job.args[0] if job.args else None,
+            "campo": job.args[1] if len(job.args) > 1 else None,
+            "esecuzione": job.next_run_time.isoformat() if job.next_run_time else None,
+        } for job in scheduler.get_jobs(jobstore="default")])
     except Exception as e:
         return jsonify({"errore": str(e)}), 500
 
+@app.route("/backfill", methods=["POST"])
+def backfill():
+    try:
+        minuti = int(request.args.get("minuti", BACKFILL_MINUTI))
+    except ValueError as e:
+        return jsonify({"errore": f"Parametri non validi: {e}"}), 400
+    try:
+        return jsonify({"recuperate": backfill_glicemie(minuti)})
+    except Exception as e:
+        return jsonify({"errore": str(e)}), 500
+
+@app.cli.command("backfill")
+def backfill_command():
+    """Recupera da Dexcom Share le glicemie mancanti in MongoDB."""
+    backfill_glicemie()
+
 @app.route("/glicemia", methods=["GET"])
 def ottieni_glicemia():
     try:
-        reading = get_g7_reading()
+        cached = get_cached_g7_reading()
+        reading = cached.reading
         if reading:
             return jsonify({
                 "glicemia": float(reading.value),
                 "trend": reading.trend_description,
-            })
+            }), 200, cached.headers()
         else:
-            return jsonify({"errore": "Nessuna lettura disponibile"}), 404
+            return jsonify({"errore": "Nessuna lettura disponibile"}), 404, cached.headers()
     except Exception as e:
         return jsonify({"errore": str(e)}), 500
 
+def _inizio_giorno_ms(giorno, tz):
+    return int(tz.localize(datetime.combine(giorno, datetime.min.time())).timestamp() * 1000)
+
+def _istante_ms(valore, tz):
+    """Epoch ms da un numero di millisecondi o da una data/ora ISO nel fuso ``tz``."""
+    if valore.isdigit():
+        return int(valore)
+    istante = datetime.fromisoformat(valore)
+    if istante.tzinfo is None:
+        istante = tz.localize(istante)
+    return int(istante.timestamp() * 1000)
+
+def _stream_json(righe, formato, limite):
+    """Serializza le entries una alla volta: in memoria resta solo il blocco corrente del cursore."""
+    ultimo = None
+    primo = True
+    contate = 0
+    if formato == "json":
+        yield '{"entries":['
+    for data, doc in righe:
+        ultimo = data
+        contate += 1
+        if formato == "ndjson":
+            yield json.dumps(doc, ensure_ascii=False) + "\n"
+        else:
+            yield ("" if primo else ",") + json.dumps(doc, ensure_ascii=False)
+        primo = False
+    # Una pagina incompleta è l'ultima: nessun cursore successivo
+    prossimo = ultimo if contate >= limite else None
+    if formato == "json":
+        yield '],"next":' + json.dumps(prossimo) + "}"
+    elif prossimo is not None:
+        yield json.dumps({"next": prossimo}) + "\n"
+
+MAX_LIMITE_GLICEMIE = 10000
+
+@app.route("/glicemie", methods=["GET"])
+def glicemie():
+    """Glicemie in un intervallo, in streaming.
+
+    Parametri: ``from``/``to`` (data ISO nel fuso ``tz`` oppure epoch ms),
+    ``fields`` (campi separati da virgola), ``after`` (cursore: ``date``
+    dell'ultima entry ricevuta), ``limit``, ``step`` (minuti di
+    campionamento) e ``format`` (``json`` oppure ``ndjson``). L'ultima riga o
+    la chiave ``next`` contiene il cursore per la pagina successiva.
+    """
+    try:
+        tz = pytz.timezone(request.args.get("tz", TIMEZONE))
+        oggi = datetime.now(tz).date()
+        inizio = _istante_ms(request.args["from"], tz) if "from" in request.args else _inizio_giorno_ms(oggi, tz)
+        fine = _istante_ms(request.args["to"], tz) if "to" in request.args else inizio + 24 * 3600 * 1000
+
+        campi = [c.strip() for c in request.args.get("fields", "sgv,date,direction").split(",") if c.strip()]
+        sconosciuti = set(campi) - RANGE_FIELDS
+        if sconosciuti:
+            return jsonify({"errore": f"Campi non validi: {', '.join(sorted(sconosciuti))}"}), 400
+
+        after = int(request.args["after"]) if "after" in request.args else None
+        limite = min(int(request.args.get("limit", 1000)), MAX_LIMITE_GLICEMIE)
+        if limite < 1:
+            raise ValueError("limit deve essere almeno 1")
+        passo_ms = int(float(request.args.get("step", 0)) * 60 * 1000)
+        formato = request.args.get("format", "json")
+        if formato not in ("json", "ndjson"):
+            return jsonify({"errore": "Parametro 'format' non valido. Usa json oppure ndjson."}), 400
+    except (KeyError, ValueError, pytz.UnknownTimeZoneError) as e:
+        return jsonify({"errore": f"Parametri non validi: {e}"}), 400
+
+    righe = iter_range(entries_collection, inizio, fine, campi, after, limite, passo_ms)
+    mimetype = "application/x-ndjson" if formato == "ndjson" else "application/json"
+    return Response(_stream_json(righe, formato, limite), mimetype=mimetype)
+
+@app.route("/statistiche", methods=["GET"])
+def statistiche():
+    """Statistiche di un intervallo di giorni dai documenti di ``daily_stats``."""
+    try:
+        oggi = datetime.now(pytz.timezone(TIMEZONE)).date()
+        inizio = request.args.get("from", (oggi - timedelta(days=13)).isoformat())
+        fine = request.args.get("to", oggi.isoformat())
+        datetime.strptime(inizio, "%Y-%m-%d")
+        datetime.strptime(fine, "%Y-%m-%d")
+    except ValueError as e:
+        return jsonify({"errore": f"Parametri non validi: {e}"}), 400
+
+    try:
+        with timed(DURATA_MONGO, "query"):
+            giorni = read_range(daily_stats_collection, inizio, fine)
+        return jsonify({
+            "from": inizio,
+            "to": fine,
+            "totale": summarize(giorni),
+            "giorni": [dict(summarize([g]), day=g["day"]) for g in giorni],
+        })
+    except Exception as e:
+        return jsonify({"errore": str(e)}), 500
+
+@app.route("/glicemie/rollup", methods=["GET"])
+def glicemie_rollup():
+    """Media, deviazione standard, minimo e massimo per ora (``livello=1h``) o giorno (``1d``)."""
+    try:
+        livello = request.args.get("livello", "1h")
+        if livello not in ROLLUP_COLLECTIONS:
+            raise ValueError("livello deve essere 1h oppure 1d")
+        tz = pytz.timezone(request.args.get("tz", TIMEZONE))
+        oggi = datetime.now(tz).date()
+        dal = datetime.strptime(request.args.get("dal", (oggi - timedelta(days=6)).isoformat()), "%Y-%m-%d").date()
+        al = datetime.strptime(request.args.get("al", oggi.isoformat()), "%Y-%m-%d").date()
+    except (ValueError, pytz.UnknownTimeZoneError) as e:
+        return jsonify({"errore": f"Parametri non validi: {e}"}), 400
+
+    try:
+        with timed(DURATA_MONGO, "query"):
+            bucket = read_rollups(mongo_db, livello, _inizio_giorno_ms(dal, tz),
+                                  _inizio_giorno_ms(al + timedelta(days=1), tz))
+        return jsonify({"livello": livello, "dal": dal.isoformat(), "al": al.isoformat(), "bucket": bucket})
+    except Exception as e:
+        return jsonify({"errore": str(e)}), 500
+
+def ricalcola_statistiche():
+    # Con RAW_RETENTION_DAYS il giorno più vecchio è solo in parte nei dati grezzi: resta com'è
+    inizio = retention_boundary(archivio.retention_days, archivio.tz) if archivio is not None else None
+    giorni = rebuild_daily_stats(entries_collection, daily_stats_collection, TIMEZONE, start_ms=inizio or 0)
+    print(f"[STATISTICHE] Ricalcolati {giorni} giorni")
+    return giorni
+
+@app.cli.command("ricalcola-statistiche")
+def ricalcola_statistiche_command():
+    """Ricostruisce daily_stats dalle entries salvate (con RAW_RETENTION_DAYS solo i giorni completi)."""
+    ricalcola_statistiche()
+
+@app.cli.command("ricalcola-rollup")
+def ricalcola_rollup_command():
+    """Ricostruisce i rollup orari e giornalieri da tutte le glicemie salvate."""
+    if archivio is not None:
+        # Con RAW_RETENTION_DAYS i rollup più vecchi dei dati grezzi restano come sono
+        letture = archivio.rebuild_rollups()
+    else:
+        letture = rebuild_rollups(mongo_db, entries_collection, pytz.timezone(TIMEZONE))
+    print(f"[ROLLUP] Ricalcolati i rollup da {letture} letture")
+
+# Il profilo cambia solo quando arriva una nuova glicemia: la chiave include l'ultima date salvata
+cache_agp = {}
+cache_agp_lock = threading.Lock()
+MAX_CACHE_AGP = 16
+
+def ultima_data_salvata():
+    if len(storico):
+        return storico.date(-1)
+    ultimo = entries_collection.find_one({"type": "sgv"}, {"date": 1}, sort=[("date", -1)])
+    return ultimo["date"] if ultimo else 0
+
+@app.route("/agp", methods=["GET"])
+def profilo_agp():
+    """Ambulatory Glucose Profile degli ultimi ``giorni`` (14-90) fino all'ultima glicemia."""
+    # numpy pesa sull'avvio: si importa solo alla prima richiesta del profilo
+    from agp_report import DEFAULT_BIN_MINUTES, agp, load_series
+    try:
+        giorni = int(request.args.get("giorni", 14))
+        fascia = int(request.args.get("bin", DEFAULT_BIN_MINUTES))
+        fuso = request.args.get("tz", TIMEZONE)
+        tz = pytz.timezone(fuso)
+        if not 14 <= giorni <= 90 or fascia not in (5, 10, 15, 20, 30, 60):
+            raise ValueError("giorni deve essere tra 14 e 90, bin uno tra 5, 10, 15, 20, 30, 60")
+    except (ValueError, pytz.UnknownTimeZoneError) as e:
+        return jsonify({"errore": f"Parametri non validi: {e}"}), 400
+
+    try:
+        ultima = ultima_data_salvata()
+        chiave = (giorni, fascia, fuso, ultima)
+        with cache_agp_lock:
+            risultato = cache_agp.get(chiave)
+        if risultato is None:
+            fine = ultima + 1
+            with timed(DURATA_MONGO, "query"):
+                date, valori = load_series(entries_collection, fine - giorni * 86_400_000, fine)
+            risultato = agp(date, valori, tz, fascia)
+            with cache_agp_lock:
+                if len(cache_agp) >= MAX_CACHE_AGP:
+                    cache_agp.clear()
+                cache_agp[chiave] = risultato
+        return jsonify(risultato)
+    except Exception as e:
+        return jsonify({"errore": str(e)}), 500
+
+@app.route("/glicemia/stream", methods=["GET"])
+def glicemia_stream():
+    """Server-Sent Events: una notifica per ogni nuova glicemia acquisita.
+
+    Con ``Last-Event-ID`` (la ``date`` dell'ultima lettura ricevuta) il client
+    riceve prima le letture perse, dalla memoria o da MongoDB.
+    """
+    try:
+        ultimo = request.headers.get("Last-Event-ID") or request.args.get("lastEventId")
+        ultimo = int(ultimo) if ultimo else None
+    except ValueError:
+        return jsonify({"errore": "Last-Event-ID non valido"}), 400
+
+    try:
+        hub_letture.subscribe()
+    except HubFull as e:
+        return jsonify({"errore": str(e)}), 503, {"Retry-After": "60"}
+
+    recupero = ()
+    piu_vecchio = hub_letture.oldest_id()
+    if ultimo is not None and (piu_vecchio is None or ultimo < piu_vecchio):
+        recupero = iter_range(entries_collection, ultimo + 1, 2 ** 62, CAMPI_EVENTO, limit=BACKFILL_MAX_LETTURE)
+
+    risposta = Response(sse_stream(hub_letture, ultimo, recupero), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # Il posto si libera alla chiusura della connessione, anche se lo stream non è mai partito
+    risposta.call_on_close(hub_letture.unsubscribe)
+    return risposta
+
 @app.route("/glicemie-oggi", methods=["GET"])
 def glicemie_oggi():
     try:
+        tz = pytz.timezone(request.args.get("tz", TIMEZONE))
         data_param = request.args.get("data")
-        giorno = datetime.strptime(data_param, "%Y-%m-%d").date() if data_param else datetime.utcnow().date()
-        inizio = datetime.combine(giorno, datetime.min.time()) - timedelta(hours=2)
-        fine = datetime.combine(giorno, datetime.max.time()) - timedelta(hours=2)
+        giorno = datetime.strptime(data_param, "%Y-%m-%d").date() if data_param else datetime.now(tz).date()
+        inizio = _inizio_giorno_ms(giorno, tz)
+        fine = _inizio_giorno_ms(giorno + timedelta(days=1), tz)
 
-        timestamp_inizio = int(inizio.timestamp() * 1000)
-        timestamp_fine = int(fine.timestamp() * 1000)
+        righe = iter_range(entries_collection, inizio, fine)
 
-        risultati = list(entries_collection.find({
-            "date": {
-                "$gte": timestamp_inizio,
-                "$lte": timestamp_fine
-            }
-        }).sort("date", 1))
+        def corpo():
+            yield "["
+            for i, (_, doc) in enumerate(righe):
+                yield ("," if i else "") + json.dumps(doc, ensure_ascii=False)
+            yield "]"
 
-        for r in risultati:
-            r["_id"] = str(r["_id"])
+        return Response(corpo(), mimetype="application/json")
+    except Exception as e:
+        return jsonify({"errore": str(e)}), 500
 
-        return jsonify(risultati)
+def _entries_da_rigiocare(data_param, giorni=1):
+    tz = pytz.timezone(TIMEZONE)
+    giorno = datetime.strptime(data_param, "%Y-%m-%d").date() if data_param else datetime.now(tz).date()
+    return entries_collection.find({
+        "type": "sgv",
+        "date": {"$gte": _inizio_giorno_ms(giorno, tz),
+                 "$lt": _inizio_giorno_ms(giorno + timedelta(days=giorni), tz)}
+    }, {"_id": 0, "sgv": 1, "direction": 1, "date": 1}).sort("date", 1)
+
+@app.route("/regole/replay", methods=["GET"])
+def replay_regole():
+    """Rigioca le regole di allarme sulle glicemie salvate di un giorno."""
+    try:
+        docs = _entries_da_rigiocare(request.args.get("data"))
+        return jsonify([allarme.as_dict() for allarme in replay(docs, RuleEngine(load_config()))])
     except Exception as e:
         return jsonify({"errore": str(e)}), 500
 
-def manda_telegram(messaggio):
-    for chat_id in CHAT_IDS:
-        try:
-            url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-            data = {"chat_id": chat_id.strip(), "text": messaggio}
-            requests.post(url, json=data)
-        except Exception as e:
-            print(f"[ERRORE TELEGRAM] {e}")
+@app.route("/regole/anticipo", methods=["GET"])
+def anticipo_regole():
+    """Di quanti minuti l'allarme di ipo prevista anticipa le regole classiche.
+
+    Parametri: ``dal`` (YYYY-MM-DD) e ``giorni`` (default 14, al massimo 90);
+    senza ``dal`` vengono rigiocati gli ultimi ``giorni`` giorni.
+    """
+    try:
+        giorni = min(max(int(request.args.get("giorni", 14)), 1), 90)
+        oggi = datetime.now(pytz.timezone(TIMEZONE)).date()
+        dal = request.args.get("dal") or (oggi - timedelta(days=giorni - 1)).isoformat()
+        docs = _entries_da_rigiocare(dal, giorni)
+        allarmi = replay(docs, RuleEngine(load_config()), predicted=True)
+        return jsonify(lead_times(allarmi))
+    except ValueError as e:
+        return jsonify({"errore": str(e)}), 400
+    except Exception as e:
+        return jsonify({"errore": str(e)}), 500
+
+notificatore = TelegramNotifier(TELEGRAM_TOKEN, CHAT_IDS)
+
+def manda_telegram(messaggio, chat_ids=None):
+    """Accoda il messaggio: l'invio a tutte le chat avviene in background."""
+    notificatore.send(messaggio, chat_ids)
+
+@app.route("/notifiche/stato", methods=["GET"])
+def stato_notifiche():
+    return jsonify(notificatore.stats())
+
+metrics.gauge("telegram_queue_length", "Notifiche in attesa di consegna", lambda: notificatore.stats()["queued"])
+metrics.gauge("scheduler_pending_jobs", "Job pianificati (ping post-pasto e sincronizzazione)",
+              lambda: len(scheduler.get_jobs()))
+
+@app.route("/metrics", methods=["GET"])
+def esponi_metriche():
+    """Metriche in formato Prometheus."""
+    if not metrics.ENABLED:
+        return jsonify({"errore": "Metriche disattivate (METRICS_ENABLED=0)"}), 404
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 eventi_attivi = {}
-notifiche_inviate = {}
+notifiche_inviate = regole_allarme.new_cooldown()
 
 def reset_evento(codice):
     if codice in eventi_attivi:
         print(f"✅ Evento {codice} risolto")
         eventi_attivi.pop(codice)
-        notifiche_inviate.pop(codice, None)
-
-def manda_notifica(codice, titolo, messaggio):
-    adesso = time.time()
-    numero, ultimo = notifiche_inviate.get(codice, (0, 0))
-
-    if numero >= 2 and (adesso - ultimo) < 1800:
-        print(f"[SKIP] {codice} già inviato {numero} volte. Aspetto prima dei 30 minuti.")
-        return
+        notifiche_inviate.reset(codice)
 
 def manda_notifica(codice, titolo, messaggio):
     adesso = time.time()
-    numero, ultimo = notifiche_inviate.get(codice, (0, 0))
 
-    if numero >= 2 and (adesso - ultimo) < 1800:
-        print(f"[SKIP] {codice} già inviato {numero} volte. Aspetto prima dei 30 minuti.")
+    if not notifiche_inviate.allow(codice, adesso):
+        limite, finestra = notifiche_inviate.limits(codice)
+        print(f"[SKIP] {codice} già inviato {notifiche_inviate.sent(codice)} volte. "
+              f"Aspetto prima dei {finestra // 60:.0f} minuti.")
         return
 
     print(f"[ALERT] {titolo} - {messaggio}")
     manda_telegram(f"🚨 {titolo}\n{messaggio}")
-    notifiche_inviate[codice] = (numero + 1, adesso)
-    eventi_attivi[codice] = True
+    notifiche_inviate.record(codice, adesso)
+    if len(storico):
+        LETTURA_ALLARME.set(adesso - storico.date(-1) / 1000)
     eventi_attivi[codice] = True
 
 
 evento_stabile = {}
 
-def gestisci_discesa_stabile(cronologia, evento_stabile):
+def gestisci_discesa_stabile(storico, evento_stabile):
     try:
         ora = datetime.utcnow()
-        valore = cronologia[-1]["valore"]
-        trend = cronologia[-1]["trend"]
-        timestamp = cronologia[-1]["timestamp"]
+        valore = storico.value(-1)
+        trend = storico.trend(-1)
+        timestamp = storico.date(-1)
 
         # 🔕 Pausa attiva
         if evento_stabile.get("pausa_fino") and ora < evento_stabile["pausa_fino"]:
@@ -205,12 +679,12 @@ def gestisci_discesa_stabile(cronologia, evento_stabile):
 
         # 🚦 Avvio evento: 3 glicemie con discesa coerente da ≥90, tutte trend →
         if not evento_stabile.get("attivo"):
-            ultimi_3 = cronologia[-3:]
             if (
-                ultimi_3[0]["valore"] >= 90 and
-                ultimi_3[0]["valore"] > ultimi_3[1]["valore"] > ultimi_3[2]["valore"] and
-                all(x["valore"] < 85 for x in ultimi_3) and
-                all(x["trend"] == "→" for x in ultimi_3)
+                len(storico) >= 3 and
+                storico.value(-3) >= 90 and
+                storico.strictly_decreasing(3) and
+                storico.max_value(3) < 85 and
+                storico.all_trend(3, "→")
             ):
                 manda_telegram("📉 Discesa glicemica stabile confermata\nMonitora con attenzione.")
                 return {
@@ -240,59 +714,56 @@ def gestisci_discesa_stabile(cronologia, evento_stabile):
         return evento_stabile
 
 
+def carica_storico():
+    """Popola lo storico in memoria con le ultime entries salvate su Mongo."""
+    try:
+        with timed(DURATA_MONGO, "query"):
+            docs = entries_collection.find(
+                {"type": "sgv"}, {"sgv": 1, "direction": 1, "date": 1}
+            ).sort("date", -1).limit(storico.capacity)
+            caricate = storico.seed(docs)
+        print(f"[STORICO] Caricate {caricate} glicemie")
+        if len(storico):
+            # I client che si collegano ricevono subito l'ultima lettura nota
+            data_ms = storico.date(-1)
+            hub_letture.publish(data_ms, {
+                "sgv": storico.value(-1),
+                "date": data_ms,
+                "dateString": datetime.fromtimestamp(data_ms / 1000).strftime("%Y-%m-%dT%H:%M:%S"),
+                "direction": storico.trend(-1),
+            })
+    except Exception as e:
+        print(f"❌ Errore caricamento storico: {e}")
+
+
+@timed(DURATA_REGOLE)
 def monitor_loop():
     global evento_stabile
     try:
-        docs = list(entries_collection.find().sort("date", -1).limit(5))
-        if len(docs) < 3:
+        if len(storico) < 3:
             print("⚠️ Dati insufficienti")
             return
 
-        cronologia = [{
-            "valore": d["sgv"],
-            "trend": d.get("direction", "→"),
-            "timestamp": d["date"]
-        } for d in reversed(docs)]
-
-        ultimo = cronologia[-1]
-        valore = ultimo["valore"]
-        trend = ultimo["trend"]
+        valore = storico.value(-1)
+        trend = storico.trend(-1)
 
         print(f"📈 Ultima glicemia: {valore} - Trend: {trend}")
 
-        if valore >= 85 and trend in ["→", "↑", "↗", "↑↑"]:
+        esito = regole_allarme.evaluate(storico)
+        if esito.reset:
             for codice in list(eventi_attivi):
                 reset_evento(codice)
 
-        if valore < 90 and trend in ["↓", "↓↓"]:
-            manda_notifica("rapida", "Discesa rapida",
-                "Correggi subito con un succo o 3 bustine di zucchero o 3 caramelle zuccherate.")
-
-        if all(x["trend"] == "→" for x in cronologia[-3:]) and 70 < cronologia[-1]["valore"] <= 86:
-            manda_notifica("stabile_86", "Glicemia stabile ma in calo",
-                "Monitora attentamente.\nSe continua a scendere, interverremo.")
-
-        if valore == 70 and trend == "→":
-            manda_notifica("stabile_70", "Glicemia a 70",
-                "Se non hai corretto, fallo ora.\nPrendi mezzo succo o 2 bustine di zucchero.")
-
-        if valore < 70 and trend == "→":
-            manda_notifica("stabile_sotto70", "Glicemia ancora in discesa",
-                "Prendi subito un succo intero.\nSe hai già corretto, attendi e monitora.")
-
-        if trend == "↘" and cronologia[-1]["valore"] <= 86 and cronologia[-2]["valore"] >= 90:
-            manda_notifica("lenta_salto", "Discesa glicemica lenta",
-                "Correggi subito con un succo intero o 3 bustine di zucchero.")
-
-        if all(x["trend"] == "↘" for x in cronologia[-3:]) and all(x["valore"] < 90 for x in cronologia[-3:]):
-            manda_notifica("lenta_graduale", "Discesa lenta confermata",
-                "Correggi con un succo intero o 3 bustine di zucchero.")
+        for regola in esito.alerts:
+            manda_notifica(regola.code, regola.title, regola.message)
+        if esito.predicted:
+            manda_notifica(esito.predicted.code, esito.predicted.title, esito.predicted.message)
     except Exception as e:
         print(f"❌ Errore loop monitor: {e}")
 
-def invia_a_mongo():
+def invia_a_mongo(reading=None):
     try:
-        reading = get_g7_reading()
+        reading = reading or get_cached_g7_reading().reading
         if not reading:
             print("⚠️ Nessuna lettura disponibile da Dexcom")
             return
@@ -302,24 +773,185 @@ def invia_a_mongo():
         trend = reading.trend_arrow or "Flat"
 
         scrivi_glicemia_su_mongo(valore, timestamp, trend)
+        data_ms = int(timestamp.timestamp() * 1000)
+        if storico.append(valore, trend, data_ms):
+            ETA_LETTURA.set(time.time() - data_ms / 1000)
+            evento = build_entry(valore, timestamp, trend)
+            hub_letture.publish(data_ms, {campo: evento[campo] for campo in CAMPI_EVENTO})
         monitor_loop()
 
     except Exception as e:
         print(f"❌ Errore lettura/scrittura Dexcom: {e}")
-    finally:
-        Timer(300, invia_a_mongo).start()
+
+# --- Lettura allineata alla pubblicazione del sensore ---
+# Invece di un intervallo fisso (in media 2,5 minuti di ritardo sul G7) ogni
+# lettura programma la successiva subito dopo la pubblicazione attesa.
+pubblicazione = PublishSchedule()
+
+def sincronizza_g7():
+    """Legge Share, salva la glicemia e programma la lettura successiva."""
+    try:
+        reading = get_fresh_g7_reading().reading
+    except Exception as e:
+        print(f"❌ Errore lettura Dexcom: {e}")
+        piano = pubblicazione.on_error(time.time())
+    else:
+        if reading:
+            invia_a_mongo(reading)
+        else:
+            print("⚠️ Nessuna lettura disponibile da Dexcom")
+        piano = pubblicazione.on_reading(reading.time.timestamp() if reading else None, time.time())
+    scheduler.add_job(sincronizza_g7, "date",
+                      run_date=datetime.now(timezone.utc) + timedelta(seconds=piano.delay),
+                      id="sync-dexcom", jobstore="memoria", replace_existing=True)
+
+@app.route("/outbox/stato", methods=["GET"])
+def stato_outbox():
+    return jsonify(outbox.stats())
+
+@app.route("/sync/stato", methods=["GET"])
+def stato_sync():
+    return jsonify(pubblicazione.status())
+
+# --- Account aggiuntivi (ACCOUNTS_FILE o collection nightscout.accounts) ---
+# L'account principale resta quello delle variabili DEXCOM_*; gli altri hanno
+# un database Mongo, uno storico e un cooldown propri.
+INTERVALLO_RICARICA_ACCOUNT = 600
+
+def crea_sync_account(account):
+    return AccountSync(account, mongo_client, manda_telegram, pytz.timezone(TIMEZONE), load_config())
+
+motore_account = SyncEngine(scheduler, crea_sync_account, INTERVALLO_SYNC)
+
+def ricarica_account():
+    """Allinea i job di lettura all'elenco degli account."""
+    try:
+        aggiunti, rimossi = motore_account.update(load_accounts(collection=mongo_db["accounts"]))
+        if aggiunti or rimossi:
+            print(f"[ACCOUNT] {aggiunti} aggiunti, {rimossi} rimossi, {len(motore_account)} attivi")
+    except Exception as e:
+        print(f"❌ Errore caricamento account: {e}")
+
+@app.route("/account/stato", methods=["GET"])
+def stato_account():
+    return jsonify(motore_account.status())
+
+def avvia_sincronizzazione():
+    prepara_indici()
+    backfill_glicemie()
+    carica_storico()
+    sincronizza_g7()
 
 @app.after_request
 def after_request(response):
     response.headers.add("Access-Control-Allow-Origin", "*")
     response.headers.add("Access-Control-Allow-Headers", "Content-Type,Authorization")
     response.headers.add("Access-Control-Allow-Methods", "GET,POST,OPTIONS")
+    response.headers.add("Access-Control-Expose-Headers", "X-Cache,X-Reading-Age")
+    if avvio_in_attesa.is_set():
+        # Dopo l'invio della risposta: la prima richiesta non aspetta Mongo né lo scheduler
+        response.call_on_close(avvia_sync_una_volta)
     return response
 
+# --- Leader: un solo processo sincronizza, manda allarmi ed esegue i ping ---
+# Gli altri worker servono solo le letture e seguono le nuove glicemie da Mongo.
+# Con LEADER_LEASE=0 ogni processo sincronizza (un solo worker in render.yaml).
+LEASE_ATTIVO = os.getenv("LEADER_LEASE", "1").strip().lower() not in {"0", "false", "no"}
+
+def diventa_leader():
+    """Riparte dallo stato salvato su Mongo e riattiva i job.
+
+    I ping aggiunti su Mongo dagli altri worker vengono visti al risveglio
+    successivo dello scheduler, al più ogni INTERVALLO_RICARICA_ACCOUNT secondi: molto
+    prima della loro scadenza (almeno 60 minuti).
+    """
+    scheduler.add_job(avvia_sincronizzazione, "date", run_date=datetime.now(timezone.utc),
+                      id="avvio-sync", jobstore="memoria", replace_existing=True)
+    scheduler.resume()
+
+def perde_leadership():
+    scheduler.pause()
+
+def segui_leader():
+    """Nei worker in attesa: storico e client SSE aggiornati con le glicemie scritte dal leader."""
+    dopo = storico.date(-1) if len(storico) else 0
+    with timed(DURATA_MONGO, "query"):
+        docs = list(entries_collection.find(
+            {"type": "sgv", "date": {"$gt": dopo}}, {"_id": 0, "sgv": 1, "direction": 1, "date": 1}
+        ).sort("date", -1).limit(storico.capacity))
+    for doc in reversed(docs):
+        if storico.append(float(doc["sgv"]), doc.get("direction", "Flat"), doc["date"]):
+            hub_letture.publish(doc["date"], {
+                "sgv": doc["sgv"],
+                "date": doc["date"],
+                "dateString": datetime.fromtimestamp(doc["date"] / 1000).strftime("%Y-%m-%dT%H:%M:%S"),
+                "direction": doc.get("direction", "Flat"),
+            })
+
+lease = LeaderLease(
+    mongo_db["leases"],
+    ttl=float(os.getenv("LEADER_TTL", DEFAULT_TTL)),
+    on_acquired=diventa_leader,
+    on_lost=perde_leadership,
+    on_standby=segui_leader,
+)
+metrics.gauge("leader", "1 se questo processo detiene il lease di sincronizzazione",
+              lambda: 1 if lease.is_leader or not LEASE_ATTIVO else 0)
+
+@app.route("/leader", methods=["GET"])
+def stato_leader():
+    return jsonify(dict(lease.status(), attivo=LEASE_ATTIVO))
+
 # --- Avvio ---
 def start_background_sync():
     """Avvia la sincronizzazione G7 senza bloccare l'import WSGI."""
-    Timer(0, invia_a_mongo).start()
+    # Ogni worker smaltisce l'outbox, comprese le voci rimaste da prima del riavvio
+    outbox.start()
+    atexit.register(outbox.stop)
+    # Il job "sync-dexcom" nasce dalla prima lettura di avvia_sincronizzazione e si ripianifica da solo
+    adesso = datetime.now(timezone.utc)
+    scheduler.add_job(ricarica_account, "interval", seconds=INTERVALLO_RICARICA_ACCOUNT, next_run_time=adesso,
+                      id="ricarica-account", jobstore="memoria", replace_existing=True)
+    if not LEASE_ATTIVO:
+        scheduler.add_job(avvia_sincronizzazione, "date", run_date=adesso,
+                          id="avvio-sync", jobstore="memoria", replace_existing=True)
+        if not scheduler.running:
+            scheduler.start()
+        return
+
+    # In pausa lo scheduler accetta i job (i ping finiscono su Mongo) ma non li esegue
+    if not scheduler.running:
+        scheduler.start(paused=True)
+    lease.start()
+    atexit.register(lease.stop)
+
+# Con avvio_differito la sincronizzazione parte alla prima richiesta servita
+# (di solito l'health check della piattaforma) o dopo SYNC_START_DELAY secondi:
+# il worker accetta connessioni prima di aver toccato Mongo o Dexcom.
+RITARDO_AVVIO_SYNC = float(os.getenv("SYNC_START_DELAY", "10"))
+avvio_in_attesa = threading.Event()
+_avvio_lock = threading.Lock()
+_avvio_eseguito = False
+
+def avvia_sync_una_volta():
+    global _avvio_eseguito
+    with _avvio_lock:
+        if _avvio_eseguito:
+            return
+        _avvio_eseguito = True
+        avvio_in_attesa.clear()
+    try:
+        start_background_sync()
+    except Exception as e:
+        print(f"❌ Errore avvio sincronizzazione: {e}")
+
+def avvio_differito(ritardo=RITARDO_AVVIO_SYNC):
+    """Rimanda start_background_sync alla prima richiesta o a ``ritardo`` secondi, se prima."""
+    avvio_in_attesa.set()
+    timer = threading.Timer(ritardo, avvia_sync_una_volta)
+    timer.daemon = True
+    timer.start()
+    return timer
 
 
 if __name__ == "__main__":
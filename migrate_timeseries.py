@@ -0,0 +1,147 @@
+"""Copia le glicemie della collection ``entries`` nella time-series ``glucose``.
+
+Le entries vengono lette in ordine di data a lotti di ``--batch`` documenti e
+inserite con un solo ``insert_many`` per lotto; l'ultima data copiata viene
+salvata in ``migrations``, quindi il comando si può interrompere e rilanciare
+e le letture già presenti nella time-series non vengono duplicate. Alla fine
+i rollup orari e giornalieri vengono ricostruiti dalla time-series; con
+``--retention-days`` i giorni più vecchi della retention vengono ricalcolati
+dalla collection di origine, o lasciati come sono se lì non ci sono più.
+
+Sequenza consigliata::
+
+    python migrate_timeseries.py                 # copia lo storico
+    # deploy con GLUCOSE_STORAGE=timeseries
+    python migrate_timeseries.py --swap          # copia le ultime letture e crea la vista
+
+Con ``--swap`` la collection ``entries`` diventa ``entries_legacy`` e al suo
+posto nasce una vista in formato Nightscout sopra ``glucose``, così i lettori
+esterni continuano a funzionare.
+"""
+
+import argparse
+import os
+import time
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, MongoClient
+
+from glucose_store import GlucoseStore, create_entries_view, rebuild_rollups, retention_boundary
+from nightscout_entries import DEVICE
+
+BATCH_SIZE = 5000
+CHECKPOINT_ID = "entries->glucose"
+LEGACY_COLLECTION = "entries_legacy"
+
+
+def _entry(doc: dict) -> Optional[dict]:
+    sgv, date = doc.get("sgv"), doc.get("date")
+    if not isinstance(sgv, (int, float)) or not isinstance(date, (int, float)):
+        return None
+    return {
+        "sgv": sgv,
+        "date": int(date),
+        "direction": doc.get("direction") or "Flat",
+        "device": doc.get("device") or DEVICE,
+    }
+
+
+def migrate(db, tz_name: str, batch_size: int = BATCH_SIZE, source: str = "entries",
+            retention_days: Optional[float] = None, rollups: bool = True,
+            log: Callable[[str], None] = print) -> dict:
+    """Copia ``source`` nella time-series riprendendo dall'ultimo lotto completato."""
+
+    store = GlucoseStore(db, tz_name, retention_days)
+    store.ensure()
+    checkpoint = db.migrations.find_one({"_id": CHECKPOINT_ID}) or {}
+    after = checkpoint.get("last_date", -1)
+    copied = skipped = invalid = batches = 0
+    started = time.perf_counter()
+
+    while True:
+        docs = list(db[source].find(
+            {"type": "sgv", "date": {"$gt": after}},
+            {"_id": 0, "sgv": 1, "date": 1, "direction": 1, "device": 1},
+        ).sort("date", ASCENDING).limit(batch_size))
+        if not docs:
+            break
+        entries = [entry for entry in map(_entry, docs) if entry is not None]
+        invalid += len(docs) - len(entries)
+        store.writer.add_many(entries)
+        report = store.writer.flush()
+        copied += report.inserted
+        skipped += report.deduped
+        batches += 1
+        after = docs[-1]["date"]
+        db.migrations.update_one({"_id": CHECKPOINT_ID}, {"$set": {"last_date": after, "updated_at": time.time()}},
+                                 upsert=True)
+        elapsed = time.perf_counter() - started
+        log(f"[MIGRAZIONE] lotto {batches}: {report.inserted} copiate, {report.deduped} già presenti "
+            f"({copied / elapsed if elapsed else 0:.0f} letture/s)")
+
+    rebuilt = _rebuild_rollups(db, store, source) if rollups else None
+    seconds = time.perf_counter() - started
+    return {
+        "copied": copied,
+        "skipped": skipped,
+        "invalid": invalid,
+        "batches": batches,
+        "rollup_readings": rebuilt,
+        "seconds": round(seconds, 1),
+        "per_second": round(copied / seconds) if seconds else None,
+    }
+
+
+def _rebuild_rollups(db, store: GlucoseStore, source: str) -> int:
+    """Rollup dalla time-series, e dalla collection di origine per i giorni già oltre la retention."""
+
+    boundary = retention_boundary(store.retention_days, store.tz)
+    if boundary is None:
+        return rebuild_rollups(db, store.entries, store.tz)
+    # Prima del limite le letture grezze possono essere già scadute: si usa
+    # l'origine. Dopo uno --swap è entries_legacy (entries è la vista sulla
+    # time-series), ferma al momento dello swap: i bucket successivi alla sua
+    # ultima lettura restano come sono.
+    end = boundary
+    if LEGACY_COLLECTION in db.list_collection_names():
+        source = LEGACY_COLLECTION
+        newest = db[source].find_one({"type": "sgv"}, {"date": 1}, sort=[("date", DESCENDING)])
+        end = min(boundary, newest["date"]) if newest else None
+    history = rebuild_rollups(db, db[source], store.tz, end_ms=end) if end is not None else 0
+    return history + rebuild_rollups(db, store.entries, store.tz, start_ms=boundary)
+
+
+def swap_to_view(db, tz_name: str, source: str = "entries", legacy: str = LEGACY_COLLECTION):
+    """Rinomina ``source`` in ``legacy`` e crea al suo posto la vista Nightscout."""
+
+    db[source].rename(legacy)
+    create_entries_view(db, tz_name, source)
+
+
+def main_cli():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI"))
+    parser.add_argument("--database", default="nightscout")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE)
+    parser.add_argument("--timezone", default=os.getenv("TIMEZONE", "Europe/Rome"))
+    parser.add_argument("--retention-days", type=float, default=float(os.getenv("RAW_RETENTION_DAYS", "0")) or None,
+                        help="giorni di dati grezzi da conservare (0 = tutti)")
+    parser.add_argument("--no-rollups", action="store_true", help="non ricostruire i rollup")
+    parser.add_argument("--swap", action="store_true",
+                        help=f"rinomina entries in {LEGACY_COLLECTION} e crea la vista Nightscout")
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo_uri)[args.database]
+    report = migrate(db, args.timezone, args.batch, retention_days=args.retention_days,
+                     rollups=not args.no_rollups)
+    print(f"[MIGRAZIONE] {report['copied']} letture copiate in {report['batches']} lotti "
+          f"({report['skipped']} già presenti, {report['invalid']} non valide) in {report['seconds']} s")
+    if args.swap:
+        swap_to_view(db, args.timezone)
+        print(f"[MIGRAZIONE] entries rinominata in {LEGACY_COLLECTION}, creata la vista entries")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,213 @@
+"""Scrittura idempotente delle glicemie nella collection Nightscout ``entries``.
+
+Dexcom Share restituisce la stessa lettura finché il telefono non pubblica un
+valore nuovo, quindi ogni scrittura è un upsert sulla chiave (device, date):
+una lettura già presente viene contata come duplicato invece di essere
+inserita di nuovo.
+"""
+
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, DeleteMany, UpdateOne
+from pymongo.errors import OperationFailure
+
+DEVICE = "dexcom-g7"
+UNIQUE_INDEX = "device_date_unique"
+DATE_INDEX = "date_desc"
+DUPLICATE_KEY_CODE = 11000
+RANGE_FIELDS = frozenset({"_id", "type", "sgv", "date", "dateString", "direction", "device"})
+RANGE_BATCH_SIZE = 500
+
+
+def build_entry(value, timestamp: datetime, direction: str = "Flat", device: str = DEVICE) -> dict:
+    return {
+        "type": "sgv",
+        "sgv": value,
+        "dateString": timestamp.strftime("%Y-%m-%dT%H:%M:%S"),
+        "date": int(timestamp.timestamp() * 1000),
+        "direction": direction,
+        "device": device,
+    }
+
+
+def _remove_duplicates(collection) -> int:
+    """Tiene il documento con ``_id`` minore per ogni (device, date) e cancella gli altri."""
+
+    groups = collection.aggregate([
+        {"$group": {"_id": {"device": "$device", "date": "$date"},
+                    "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+    extra_ids = [doc_id for group in groups for doc_id in sorted(group["ids"])[1:]]
+    if not extra_ids:
+        return 0
+    return collection.bulk_write([DeleteMany({"_id": {"$in": extra_ids}})]).deleted_count
+
+
+def ensure_indexes(collection, remove_duplicates: bool = False) -> int:
+    """Crea l'indice univoco (device, date) e quello per gli ordinamenti su date.
+
+    Se la collection contiene già duplicati l'indice univoco non può essere
+    creato: con ``remove_duplicates`` vengono cancellati (resta la copia con
+    ``_id`` minore) e l'indice viene creato, altrimenti l'``OperationFailure``
+    di MongoDB risale al chiamante. Restituisce il numero di documenti
+    cancellati.
+    """
+
+    collection.create_index([("date", DESCENDING)], name=DATE_INDEX)
+    removed = 0
+    try:
+        collection.create_index(
+            [("device", ASCENDING), ("date", ASCENDING)], name=UNIQUE_INDEX, unique=True
+        )
+    except OperationFailure as e:
+        if e.code != DUPLICATE_KEY_CODE or not remove_duplicates:
+            raise
+        removed = _remove_duplicates(collection)
+        collection.create_index(
+            [("device", ASCENDING), ("date", ASCENDING)], name=UNIQUE_INDEX, unique=True
+        )
+    return removed
+
+
+@dataclass(frozen=True)
+class FlushReport:
+    inserted: int
+    deduped: int
+    inserted_entries: Tuple[dict, ...] = field(default=(), repr=False)
+
+    @property
+    def written(self) -> int:
+        return self.inserted + self.deduped
+
+
+class EntryWriter:
+    """Buffer di entries scritte con un solo ``bulk_write`` di upsert."""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self._lock = threading.Lock()
+        self._buffer: Dict[Tuple[str, int], dict] = {}
+        self.inserted = 0
+        self.deduped = 0
+        self.flushes = 0
+
+    def add(self, entry: dict):
+        key = (entry["device"], entry["date"])
+        with self._lock:
+            if key in self._buffer:
+                self.deduped += 1
+            self._buffer[key] = entry
+
+    def add_many(self, entries: List[dict]):
+        for entry in entries:
+            self.add(entry)
+
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def _restore(self, entries: List[dict]):
+        """Rimette nel buffer le entries di un flush fallito, senza coprire quelle arrivate nel frattempo."""
+
+        with self._lock:
+            for entry in entries:
+                self._buffer.setdefault((entry["device"], entry["date"]), entry)
+
+    def flush(self) -> FlushReport:
+        with self._lock:
+            if not self._buffer:
+                return FlushReport(0, 0)
+            entries = sorted(self._buffer.values(), key=lambda e: e["date"])
+            self._buffer = {}
+
+        try:
+            result = self._collection.bulk_write([
+                UpdateOne(
+                    {"device": entry["device"], "date": entry["date"]},
+                    {"$setOnInsert": entry},
+                    upsert=True,
+                )
+                for entry in entries
+            ], ordered=True)
+        except Exception:
+            self._restore(entries)
+            raise
+
+        upserted = result.upserted_ids or {}
+        report = FlushReport(
+            result.upserted_count,
+            len(entries) - result.upserted_count,
+            tuple(entries[index] for index in sorted(upserted)),
+        )
+        with self._lock:
+            self.inserted += report.inserted
+            self.deduped += report.deduped
+            self.flushes += 1
+        return report
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "inserted": self.inserted,
+            "deduped": self.deduped,
+            "flushes": self.flushes,
+            "pending": self.pending(),
+        }
+
+
+def iter_range(
+    collection,
+    start_ms: int,
+    end_ms: int,
+    fields: Optional[Iterable[str]] = None,
+    after: Optional[int] = None,
+    limit: Optional[int] = None,
+    step_ms: int = 0,
+) -> Iterator[Tuple[int, dict]]:
+    """Scorre le entries in ``[start_ms, end_ms)`` in ordine di data, a blocchi dal cursore.
+
+    Restituisce coppie ``(date, documento)`` così che il chiamante possa
+    costruire il cursore di paginazione anche quando ``date`` non è tra i
+    campi richiesti. ``after`` riprende dalla data successiva all'ultima già
+    letta; con ``step_ms`` viene tenuta solo la prima lettura di ogni
+    intervallo. ``fields=None`` restituisce il documento completo.
+    """
+
+    date_filter = {"$gte": start_ms, "$lt": end_ms}
+    if after is not None:
+        date_filter["$gt"] = after
+
+    projection = None
+    if fields is not None:
+        fields = set(fields)
+        projection = {field: 1 for field in fields | {"date"}}
+        if "_id" not in fields:
+            projection["_id"] = 0
+
+    cursor = collection.find({"type": "sgv", "date": date_filter}, projection)
+    cursor = cursor.sort("date", ASCENDING).batch_size(RANGE_BATCH_SIZE)
+    if limit and not step_ms:
+        cursor = cursor.limit(limit)
+
+    emitted = 0
+    # la pagina precedente si è fermata su ``after``: il suo intervallo è già stato restituito
+    bucket = after // step_ms if step_ms and after is not None else None
+    try:
+        for doc in cursor:
+            date = doc["date"]
+            if step_ms:
+                if date // step_ms == bucket:
+                    continue
+                bucket = date // step_ms
+            if "_id" in doc:
+                doc["_id"] = str(doc["_id"])
+            if fields is not None and "date" not in fields:
+                del doc["date"]
+            yield date, doc
+            emitted += 1
+            if limit and emitted >= limit:
+                break
+    finally:
+        cursor.close()
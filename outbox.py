@@ -0,0 +1,366 @@
+"""Outbox su MongoDB per le scritture verso servizi esterni (Supabase, Google Sheet).
+
+Chi produce un dato chiama ``append``: un upsert nella collection ``outbox``
+e nessuna chiamata HTTP, quindi la richiesta o il job ritornano subito e il
+dato sopravvive a riavvii e interruzioni dei servizi. Ogni voce ha una chiave
+(``sink:key``): appendere di nuovo la stessa chiave unisce i campi invece di
+creare un duplicato, così più ping dello stesso pasto diventano un'unica riga.
+
+Un thread di consegna, avviato con ``start`` all'avvio del processo, prende
+le voci scadute a lotti di ``batch_size`` per sink e le passa al sink in una
+sola chiamata; in caso di errore le riprova con backoff esponenziale fino a
+``max_attempts``, poi le lascia marcate come fallite per un controllo manuale. Le voci vengono riservate con un lease
+(``claimed_until``), quindi più processi possono consegnare dalla stessa
+collection senza inviare due volte lo stesso lotto. ``version`` distingue i
+dati arrivati durante l'invio: quelle voci non vengono cancellate e partono
+nel giro successivo.
+"""
+
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+import requests
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+import metrics
+
+BATCH_SIZE = 50
+DRAIN_INTERVAL = 5.0
+CLAIM_SECONDS = 60.0
+MAX_ATTEMPTS = 10
+BACKOFF_BASE = 5.0
+BACKOFF_MAX = 1800.0
+REQUEST_TIMEOUT = 10
+THROUGHPUT_WINDOW = 300
+
+ITEMS = metrics.counter("outbox_items_total", "Voci dell'outbox per sink ed esito", labels=("sink", "outcome"))
+BATCH_SECONDS = metrics.histogram("outbox_batch_seconds", "Durata della consegna di un lotto dell'outbox",
+                                  labels=("sink",))
+
+
+@dataclass(frozen=True)
+class OutboxItem:
+    key: str
+    payload: dict
+    attempts: int = 0
+
+
+class SupabaseSink:
+    """Aggiornamento di righe esistenti di una tabella Supabase (PostgREST ``PATCH``).
+
+    Come la scrittura diretta, il sink modifica solo le righe già presenti e
+    non ne crea di nuove. Le voci del lotto con lo stesso payload partono in
+    un solo ``PATCH ?id=in.(...)``, le altre con un ``PATCH ?id=eq.X`` ciascuna.
+    """
+
+    def __init__(self, url: str, key: str, table: str, key_column: str = "id",
+                 session: Optional[requests.Session] = None, batch_size: int = BATCH_SIZE):
+        self.url = f"{(url or '').rstrip('/')}/rest/v1/{table}"
+        self.key_column = key_column
+        self.batch_size = batch_size
+        self.session = session or _pooled_session()
+        self.headers = {
+            "apikey": key,
+            "Authorization": f"Bearer {key}",
+            "Content-Type": "application/json",
+            "Prefer": "return=minimal",
+        }
+
+    def send(self, items: Sequence[OutboxItem]):
+        groups: Dict[tuple, List[str]] = {}
+        for item in items:
+            groups.setdefault(tuple(sorted(item.payload.items())), []).append(item.key)
+        for payload, keys in groups.items():
+            condition = f"eq.{keys[0]}" if len(keys) == 1 else f"in.({','.join(keys)})"
+            response = self.session.patch(self.url, params={self.key_column: condition},
+                                          headers=self.headers, json=dict(payload), timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+
+
+class SheetSink:
+    """Righe per un Google Sheet tramite la web app Apps Script.
+
+    Di default ogni riga parte in un POST con un solo oggetto JSON, il formato
+    che lo script ha sempre ricevuto. Con ``batch_size`` maggiore di 1 un
+    lotto parte come lista in un solo POST: va abilitato solo dopo aver
+    aggiornato lo script perché accetti le liste (vedi README), altrimenti le
+    righe andrebbero perse con una risposta 200.
+    """
+
+    def __init__(self, url: str, session: Optional[requests.Session] = None, batch_size: int = 1):
+        self.url = url
+        self.batch_size = batch_size
+        self.session = session or _pooled_session()
+
+    def send(self, items: Sequence[OutboxItem]):
+        bodies = [[item.payload for item in items]] if self.batch_size > 1 else [item.payload for item in items]
+        for body in bodies:
+            response = self.session.post(self.url, json=body, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+
+
+def _pooled_session() -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class Outbox:
+    """Coda persistente con un thread di consegna per i ``sinks`` di questo processo.
+
+    Con ``collection=None`` (MongoDB non configurato) non c'è coda: ``append``
+    invia subito, come quando MongoDB non risponde.
+    """
+
+    def __init__(
+        self,
+        collection,
+        sinks: Dict[str, object],
+        interval: float = DRAIN_INTERVAL,
+        max_attempts: int = MAX_ATTEMPTS,
+        backoff_base: float = BACKOFF_BASE,
+        backoff_max: float = BACKOFF_MAX,
+        claim_seconds: float = CLAIM_SECONDS,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.collection = collection
+        self.sinks = dict(sinks)
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.claim_seconds = claim_seconds
+        self.owner = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._clock = clock
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._idle = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._generation_lock = threading.Lock()
+        self._delivered: deque = deque()
+        self._generation = 0
+        # Aggiornato dal thread di consegna a ogni giro: le metriche lo leggono senza interrogare Mongo
+        self.pending: Optional[int] = None
+        self.sent = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed = 0
+        self.direct = 0
+
+    def ensure_indexes(self):
+        self.collection.create_index([("sink", ASCENDING), ("next_attempt", ASCENDING)], name="sink_next_attempt")
+
+    def start(self):
+        """Avvia il thread di consegna, che smaltisce anche le voci rimaste da un avvio precedente."""
+
+        self._ensure_started()
+        self._wake.set()
+
+    def _ensure_started(self):
+        if self._thread is not None or self.collection is None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+                self._thread.start()
+
+    def append(self, sink: str, key, payload: dict) -> bool:
+        """Accoda ``payload`` per ``sink``; i campi si uniscono a quelli già in coda con la stessa chiave.
+
+        Restituisce False se MongoDB non è raggiungibile: in quel caso il dato
+        viene inviato subito, senza ritentativi.
+        """
+
+        if sink not in self.sinks:
+            raise KeyError(f"Sink sconosciuto: {sink}")
+        key = str(key)
+        if self.collection is None:
+            self._send_direct(sink, key, payload)
+            return False
+        now = self._clock()
+        fields = {f"payload.{name}": value for name, value in payload.items()}
+        try:
+            self.collection.update_one(
+                {"_id": f"{sink}:{key}"},
+                {
+                    # campi nuovi su una voce fallita: ripartono con tutti i tentativi
+                    "$set": dict(fields, next_attempt=now, failed=False, attempts=0, updated_at=now),
+                    "$inc": {"version": 1},
+                    "$setOnInsert": {"sink": sink, "key": key, "created_at": now, "claimed_until": 0},
+                },
+                upsert=True,
+            )
+        except PyMongoError as e:
+            print(f"❌ Outbox non disponibile, invio diretto a {sink}: {e}")
+            self._send_direct(sink, key, payload)
+            return False
+        ITEMS.inc(sink, "queued")
+        with self._generation_lock:
+            self._generation += 1
+            self._idle.clear()
+        self._ensure_started()
+        self._wake.set()
+        return True
+
+    def _send_direct(self, sink: str, key: str, payload: dict):
+        with self._stats_lock:
+            self.direct += 1
+        try:
+            self.sinks[sink].send([OutboxItem(key, dict(payload))])
+            ITEMS.inc(sink, "sent")
+        except Exception as e:
+            ITEMS.inc(sink, "failed")
+            print(f"❌ Invio diretto a {sink} fallito: {e}")
+
+    def _claim(self, sink: str, batch_size: int, now: float) -> List[dict]:
+        due = {"sink": sink, "failed": {"$ne": True}, "next_attempt": {"$lte": now}, "claimed_until": {"$lt": now}}
+        ids = [doc["_id"] for doc in self.collection.find(due, {"_id": 1}).sort("created_at", ASCENDING)
+               .limit(batch_size)]
+        if not ids:
+            return []
+        until = now + self.claim_seconds
+        self.collection.update_many(dict(due, _id={"$in": ids}),
+                                    {"$set": {"claimed_until": until, "claimed_by": self.owner}})
+        return list(self.collection.find({"_id": {"$in": ids}, "claimed_by": self.owner, "claimed_until": until})
+                    .sort("created_at", ASCENDING))
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.backoff_max, self.backoff_base * 2 ** max(0, attempts - 1))
+
+    def _deliver(self, sink_name: str, sink, docs: List[dict], now: float) -> int:
+        items = [OutboxItem(doc["key"], doc.get("payload", {}), doc.get("attempts", 0)) for doc in docs]
+        ids = [doc["_id"] for doc in docs]
+        started = time.perf_counter()
+        try:
+            sink.send(items)
+        except Exception as e:
+            error = str(e)[:500]
+            print(f"❌ Outbox {sink_name}: lotto di {len(docs)} non consegnato: {error}")
+            for doc in docs:
+                attempts = doc.get("attempts", 0) + 1
+                failed = attempts >= self.max_attempts
+                self.collection.update_one({"_id": doc["_id"]}, {"$set": {
+                    "attempts": attempts, "failed": failed, "last_error": error, "claimed_until": 0,
+                    "next_attempt": now + self._backoff(attempts),
+                }})
+                ITEMS.inc(sink_name, "failed" if failed else "retry")
+                with self._stats_lock:
+                    if failed:
+                        self.failed += 1
+                    else:
+                        self.retries += 1
+            return 0
+        BATCH_SECONDS.observe(time.perf_counter() - started, sink_name)
+
+        # Cancella solo le versioni inviate: i campi arrivati nel frattempo partono al giro successivo
+        for doc in docs:
+            self.collection.delete_one({"_id": doc["_id"], "version": doc.get("version")})
+        self.collection.update_many({"_id": {"$in": ids}}, {"$set": {"claimed_until": 0, "attempts": 0}})
+        ITEMS.inc(sink_name, "sent", amount=len(docs))
+        with self._stats_lock:
+            self.sent += len(docs)
+            self.batches += 1
+            self._delivered.append((self._clock(), len(docs)))
+        return len(docs)
+
+    def drain_once(self) -> int:
+        """Consegna tutte le voci scadute, lotto per lotto; restituisce quante sono partite."""
+
+        delivered = 0
+        for name, sink in self.sinks.items():
+            batch_size = getattr(sink, "batch_size", BATCH_SIZE)
+            while not self._stop.is_set():
+                now = self._clock()
+                docs = self._claim(name, batch_size, now)
+                if not docs:
+                    break
+                sent = self._deliver(name, sink, docs, now)
+                delivered += sent
+                if not sent or len(docs) < batch_size:
+                    break
+        return delivered
+
+    def _run(self):
+        try:
+            self.ensure_indexes()
+        except PyMongoError as e:
+            print(f"❌ Errore creazione indice outbox: {e}")
+        while not self._stop.is_set():
+            self._wake.clear()
+            with self._generation_lock:
+                generation = self._generation
+            try:
+                self.drain_once()
+                self.pending = sum(sink["pending"] for sink in self.backlog().values())
+            except Exception as e:
+                print(f"❌ Errore consegna outbox: {e}")
+            # Un append durante il giro ha già risvegliato il thread: non è ancora inattivo
+            with self._generation_lock:
+                if generation == self._generation:
+                    self._idle.set()
+            self._wake.wait(self.interval)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Aspetta un giro di consegna completo dopo l'ultimo ``append``."""
+
+        if self._thread is None:
+            return True
+        self._wake.set()
+        return self._idle.wait(timeout)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(REQUEST_TIMEOUT)
+
+    def backlog(self) -> Dict[str, dict]:
+        """Voci in attesa e fallite per sink, con l'età della più vecchia in attesa."""
+
+        now = self._clock()
+        result = {name: {"pending": 0, "failed": 0, "oldest_seconds": None} for name in self.sinks}
+        for row in self.collection.aggregate([
+            {"$match": {"sink": {"$in": list(self.sinks)}}},
+            {"$group": {"_id": {"sink": "$sink", "failed": "$failed"}, "count": {"$sum": 1},
+                        "oldest": {"$min": "$created_at"}}},
+        ]):
+            entry = result[row["_id"]["sink"]]
+            if row["_id"].get("failed"):
+                entry["failed"] += row["count"]
+            else:
+                entry["pending"] += row["count"]
+                entry["oldest_seconds"] = round(now - row["oldest"], 1)
+        return result
+
+    def stats(self) -> dict:
+        now = self._clock()
+        with self._stats_lock:
+            while self._delivered and self._delivered[0][0] < now - THROUGHPUT_WINDOW:
+                self._delivered.popleft()
+            recent = sum(n for _, n in self._delivered)
+            stats = {
+                "sent": self.sent,
+                "batches": self.batches,
+                "retries": self.retries,
+                "failed": self.failed,
+                "direct": self.direct,
+                "sent_per_minute": round(recent * 60 / THROUGHPUT_WINDOW, 2),
+            }
+        if self.collection is None:
+            stats["backlog"] = None
+            return stats
+        try:
+            stats["backlog"] = self.backlog()
+        except PyMongoError as e:
+            stats["backlog_error"] = str(e)
+        return stats
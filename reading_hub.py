@@ -0,0 +1,125 @@
+"""Pubblicazione delle nuove glicemie verso i client in ascolto (Server-Sent Events).
+
+Il ciclo di sincronizzazione chiama ``publish`` una volta per ogni lettura
+nuova; gli iscritti aspettano su una ``threading.Condition`` condivisa e si
+svegliano solo quando c'è un evento o quando scade l'intervallo di
+heartbeat. Gli ultimi eventi restano in memoria per riprendere da
+``Last-Event-ID`` senza interrogare MongoDB.
+"""
+
+import json
+import threading
+from collections import deque
+from typing import Iterator, List, Optional, Tuple
+
+DEFAULT_MAX_SUBSCRIBERS = 10
+# Thread del worker lasciati liberi per /health e le altre richieste
+RESERVED_THREADS = 2
+DEFAULT_BACKLOG = 64
+HEARTBEAT_SECONDS = 15
+RETRY_MS = 5000
+
+
+def max_subscribers_for(threads: int, requested: Optional[int] = None,
+                        reserved: int = RESERVED_THREADS) -> int:
+    """Client SSE ammessi da un worker con ``threads`` thread.
+
+    Ogni client occupa un thread finché resta collegato: il limite richiesto
+    (``DEFAULT_MAX_SUBSCRIBERS`` se assente) viene ridotto in modo da lasciare
+    ``reserved`` thread alle altre richieste, e vale almeno 1.
+    """
+
+    limit = DEFAULT_MAX_SUBSCRIBERS if requested is None else requested
+    return max(1, min(limit, threads - reserved))
+
+
+class HubFull(Exception):
+    """Raggiunto il numero massimo di iscritti."""
+
+
+class ReadingHub:
+    def __init__(self, max_subscribers: int = DEFAULT_MAX_SUBSCRIBERS, backlog: int = DEFAULT_BACKLOG):
+        self.max_subscribers = max_subscribers
+        self._condition = threading.Condition()
+        self._events: deque = deque(maxlen=backlog)
+        self._subscribers = 0
+        self.published = 0
+
+    @property
+    def subscribers(self) -> int:
+        return self._subscribers
+
+    def publish(self, event_id: int, data: dict):
+        """Pubblica un evento; ``event_id`` (la ``date`` della lettura) deve crescere."""
+
+        with self._condition:
+            if self._events and event_id <= self._events[-1][0]:
+                return
+            self._events.append((event_id, data))
+            self.published += 1
+            self._condition.notify_all()
+
+    def oldest_id(self) -> Optional[int]:
+        with self._condition:
+            return self._events[0][0] if self._events else None
+
+    def latest_id(self) -> Optional[int]:
+        with self._condition:
+            return self._events[-1][0] if self._events else None
+
+    def _after(self, last_id: Optional[int]) -> List[Tuple[int, dict]]:
+        if last_id is None:
+            return []
+        return [event for event in self._events if event[0] > last_id]
+
+    def wait(self, last_id: Optional[int], timeout: float) -> List[Tuple[int, dict]]:
+        """Eventi successivi a ``last_id``; lista vuota se nessuno arriva entro ``timeout``."""
+
+        with self._condition:
+            events = self._after(last_id)
+            if not events:
+                self._condition.wait(timeout)
+                events = self._after(last_id)
+            return events
+
+    def subscribe(self):
+        """Riserva un posto; va rilasciato con ``unsubscribe`` quando il client si disconnette."""
+
+        with self._condition:
+            if self._subscribers >= self.max_subscribers:
+                raise HubFull(f"Massimo {self.max_subscribers} client in ascolto")
+            self._subscribers += 1
+
+    def unsubscribe(self):
+        with self._condition:
+            self._subscribers = max(0, self._subscribers - 1)
+
+
+def format_event(event_id: int, data: dict, event: str = "reading") -> str:
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def sse_stream(hub: ReadingHub, last_id: Optional[int], backfill: Iterator[Tuple[int, dict]] = (),
+               heartbeat: float = HEARTBEAT_SECONDS, stop: Optional[threading.Event] = None) -> Iterator[str]:
+    """Genera il flusso SSE: prima ``backfill`` (recupero da Mongo), poi gli eventi dal vivo.
+
+    Se il client non manda ``Last-Event-ID`` parte dall'ultimo evento pubblicato.
+    """
+
+    yield f"retry: {RETRY_MS}\n\n"
+    for event_id, data in backfill:
+        last_id = event_id
+        yield format_event(event_id, data)
+
+    if last_id is None:
+        latest = hub.latest_id()
+        last_id = latest - 1 if latest is not None else 0
+
+    while stop is None or not stop.is_set():
+        events = hub.wait(last_id, heartbeat)
+        if not events:
+            yield ": heartbeat\n\n"
+            continue
+        for event_id, data in events:
+            last_id = event_id
+            yield format_event(event_id, data)
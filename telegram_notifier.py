@@ -0,0 +1,203 @@
+"""Invio delle notifiche Telegram fuori dal thread di sincronizzazione.
+
+``send`` mette il messaggio in una coda limitata e ritorna subito; un thread
+dedicato lo consegna a tutte le chat in parallelo usando una sola
+``requests.Session`` con keep-alive. Le risposte 429 rispettano il
+``retry_after`` di Telegram, gli errori 5xx e di rete vengono ritentati con
+backoff esponenziale.
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import requests
+
+import metrics
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+REQUEST_TIMEOUT = 10
+MAX_QUEUE = 100
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+LATENCY_SAMPLES = 200
+
+DELIVERY_SECONDS = metrics.histogram("telegram_delivery_seconds",
+                                     "Tempo dall'accodamento alla consegna di una notifica Telegram")
+MESSAGES = metrics.counter("telegram_messages_total", "Notifiche Telegram per esito", labels=("outcome",))
+
+
+@dataclass(frozen=True)
+class _Message:
+    text: str
+    enqueued_at: float
+    chat_ids: Tuple[str, ...]
+
+
+class TelegramNotifier:
+    """Coda di notifiche consegnate in parallelo a tutte le ``chat_ids``."""
+
+    def __init__(
+        self,
+        token: Optional[str],
+        chat_ids: List[str],
+        api_url: Optional[str] = None,
+        timeout: float = REQUEST_TIMEOUT,
+        max_queue: int = MAX_QUEUE,
+        max_attempts: int = MAX_ATTEMPTS,
+        backoff_base: float = BACKOFF_BASE,
+        backoff_max: float = BACKOFF_MAX,
+    ):
+        self._token = token
+        self.chat_ids = [cid.strip() for cid in chat_ids if cid.strip()]
+        self._api_url = (api_url or os.getenv("TELEGRAM_API_URL") or TELEGRAM_API_URL).rstrip("/")
+        self._timeout = timeout
+        self._max_attempts = max_attempts
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._queue: "queue.Queue[_Message]" = queue.Queue(maxsize=max_queue)
+        self._session = requests.Session()
+        self._session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=max(4, len(self.chat_ids))))
+        self._pool = ThreadPoolExecutor(max_workers=max(1, min(8, len(self.chat_ids))),
+                                        thread_name_prefix="telegram")
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._latencies: deque = deque(maxlen=LATENCY_SAMPLES)
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.dropped = 0
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="telegram-dispatcher", daemon=True)
+                self._thread.start()
+
+    def send(self, text: str, chat_ids: Optional[Iterable[str]] = None) -> bool:
+        """Accoda ``text``; restituisce False se la coda è piena e il messaggio è scartato.
+
+        ``chat_ids`` sostituisce i destinatari predefiniti (per esempio quelli di
+        un altro account sincronizzato).
+        """
+
+        targets = tuple(cid.strip() for cid in chat_ids if cid.strip()) if chat_ids is not None \
+            else tuple(self.chat_ids)
+        if not self._token or not targets:
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(_Message(text, time.monotonic(), targets))
+            return True
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += 1
+            MESSAGES.inc("dropped")
+            print(f"[ERRORE TELEGRAM] Coda piena, notifica scartata: {text[:40]}")
+            return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                message = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if message is None:
+                self._queue.task_done()
+                break
+            try:
+                futures = [self._pool.submit(self._deliver, chat_id, message) for chat_id in message.chat_ids]
+                for future in futures:
+                    future.result()
+            finally:
+                self._queue.task_done()
+
+    def _retry_delay(self, response: Optional[requests.Response], attempt: int) -> float:
+        if response is not None and response.status_code == 429:
+            try:
+                retry_after = response.json().get("parameters", {}).get("retry_after")
+            except ValueError:
+                retry_after = None
+            if retry_after is not None:
+                # un retry_after enorme bloccherebbe il worker e tutte le notifiche in coda
+                return min(float(retry_after), self._backoff_max)
+        return min(self._backoff_max, self._backoff_base * (2 ** attempt))
+
+    def _deliver(self, chat_id: str, message: _Message):
+        url = f"{self._api_url}/bot{self._token}/sendMessage"
+        for attempt in range(self._max_attempts):
+            response = None
+            try:
+                response = self._session.post(
+                    url, json={"chat_id": chat_id, "text": message.text}, timeout=self._timeout
+                )
+                if response.status_code < 400:
+                    latency = time.monotonic() - message.enqueued_at
+                    with self._stats_lock:
+                        self.sent += 1
+                        self._latencies.append(latency)
+                    DELIVERY_SECONDS.observe(latency)
+                    MESSAGES.inc("sent")
+                    return
+                if response.status_code != 429 and response.status_code < 500:
+                    print(f"[ERRORE TELEGRAM] Chat {chat_id} → {response.status_code} - {response.text}")
+                    break
+            except requests.RequestException as e:
+                print(f"[ERRORE TELEGRAM] Chat {chat_id} → {e}")
+
+            if attempt + 1 < self._max_attempts:
+                with self._stats_lock:
+                    self.retries += 1
+                if self._stop.wait(self._retry_delay(response, attempt)):
+                    break
+
+        with self._stats_lock:
+            self.failed += 1
+        MESSAGES.inc("failed")
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Aspetta che la coda si svuoti; restituisce False allo scadere del timeout."""
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            try:
+                self._queue.put_nowait(None)  # sveglia il dispatcher in attesa sulla coda
+            except queue.Full:
+                pass
+            self._thread.join(self._timeout)
+        self._pool.shutdown(wait=False)
+        self._session.close()
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            stats = {
+                "sent": self.sent,
+                "failed": self.failed,
+                "retries": self.retries,
+                "dropped": self.dropped,
+                "queued": self._queue.qsize(),
+            }
+        if latencies:
+            stats["latency_avg_ms"] = round(1000 * sum(latencies) / len(latencies), 1)
+            stats["latency_p95_ms"] = round(1000 * latencies[int(0.95 * (len(latencies) - 1))], 1)
+            stats["latency_max_ms"] = round(1000 * latencies[-1], 1)
+        return stats
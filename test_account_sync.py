@@ -0,0 +1,146 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, Mock
+
+import pytz
+
+from account_sync import JOB_PREFIX, Account, AccountSync, SyncEngine, load_accounts
+from dexcom_g7 import CachedReading, G7Reading
+
+ROME = pytz.timezone("Europe/Rome")
+
+
+def _account(account_id="anna", **extra):
+    return Account.from_dict(dict({"id": account_id, "username": f"{account_id}@x", "password": "pw"}, **extra))
+
+
+def _database():
+    database = MagicMock()
+    database.entries.find.return_value.sort.return_value.limit.return_value = []
+    database.entries.bulk_write.return_value.upserted_count = 1
+    database.entries.bulk_write.return_value.upserted_ids = {0: "id"}
+    return database
+
+
+class AccountRegistryTest(unittest.TestCase):
+    def test_loads_accounts_from_a_json_file_with_defaults(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump([{"id": "anna", "username": "a", "password": "p", "chat_ids": "1, 2"},
+                       {"id": "luca", "username": "l", "password": "p", "region": "US", "name": "Luca"}], f)
+        self.addCleanup(os.unlink, f.name)
+
+        anna, luca = load_accounts(f.name)
+
+        self.assertEqual(anna.chat_ids, ("1", "2"))
+        self.assertEqual(anna.database, "nightscout_anna")
+        self.assertEqual((luca.region, luca.name), ("US", "Luca"))
+        self.assertNotIn("p", repr(anna).replace("password", ""))
+
+    def test_mongo_registry_skips_disabled_accounts(self):
+        collection = Mock()
+        collection.find.return_value = [{"_id": "anna", "username": "a", "password": "p"}]
+
+        self.assertEqual([a.id for a in load_accounts(collection=collection)], ["anna"])
+        collection.find.assert_called_once_with({"enabled": {"$ne": False}})
+
+    def test_invalid_accounts_are_skipped_without_dropping_the_others(self):
+        collection = Mock()
+        collection.find.return_value = [
+            {"_id": "anna", "username": "a"},
+            "non un oggetto",
+            {"username": "x", "password": "p"},
+            {"_id": "luca", "username": "l", "password": "p"},
+        ]
+
+        self.assertEqual([a.id for a in load_accounts(collection=collection)], ["luca"])
+
+
+class AccountSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.databases = {"nightscout_anna": _database()}
+        self.notify = Mock()
+        self.client = Mock()
+        self.sync = AccountSync(_account(chat_ids=["7"]), self.databases, self.notify, ROME,
+                                client_factory=lambda account: self.client)
+
+    def _serve(self, value, minute, arrow="↘"):
+        reading = G7Reading(value, "falling slightly", arrow, datetime(2025, 5, 1, 12, minute))
+        self.client.cache.get.return_value = CachedReading(reading, False, 0, 0)
+
+    def test_writes_to_the_account_database_and_alerts_its_own_chats(self):
+        for minute, value in ((0, 89), (5, 87), (10, 84)):
+            self._serve(value, minute)
+            self.assertTrue(self.sync.poll())
+
+        self.assertFalse(self.sync.poll())
+        entries = self.databases["nightscout_anna"].entries
+        self.assertEqual(entries.bulk_write.call_count, 4)
+        entries.find.assert_called_once()
+        self.notify.assert_called_once()
+        text, chat_ids = self.notify.call_args.args
+        self.assertTrue(text.startswith("🚨 anna: Discesa lenta confermata"))
+        self.assertEqual(chat_ids, ("7",))
+        self.assertEqual(self.sync.status()["active_alerts"], ["lenta_graduale"])
+
+    def test_accounts_without_chats_alert_the_default_chats(self):
+        sync = AccountSync(_account(), self.databases, self.notify, ROME, client_factory=lambda account: self.client)
+        for minute, value in ((0, 89), (5, 87), (10, 84)):
+            self._serve(value, minute)
+            sync.poll()
+
+        self.notify.assert_called_once()
+        self.assertIsNone(self.notify.call_args.args[1])
+
+    def test_errors_are_counted_without_raising(self):
+        self.client.cache.get.side_effect = RuntimeError("Share non raggiungibile")
+
+        self.assertFalse(self.sync.poll())
+        self.assertEqual(self.sync.status()["errors"], 1)
+        self.assertEqual(self.sync.status()["last_error"], "Share non raggiungibile")
+
+
+class SyncEngineTest(unittest.TestCase):
+    def test_staggers_jobs_and_follows_registry_changes(self):
+        scheduler = Mock()
+        engine = SyncEngine(scheduler, lambda account: Mock(account=account), interval=300)
+        now = datetime(2025, 5, 1, 12, 0, tzinfo=timezone.utc)
+        accounts = [_account(f"paziente-{i}") for i in range(200)]
+
+        self.assertEqual(engine.update(accounts, now), (200, 0))
+
+        delays = sorted((c.kwargs["next_run_time"] - now).total_seconds() for c in scheduler.add_job.call_args_list)
+        self.assertTrue(all(0 <= d < 300 for d in delays))
+        # Distribuite sull'intervallo: nessun minuto con più di un quarto degli account
+        per_minute = [sum(1 for d in delays if m * 60 <= d < (m + 1) * 60) for m in range(5)]
+        self.assertLess(max(per_minute), 50)
+        self.assertEqual({c.kwargs["executor"] for c in scheduler.add_job.call_args_list}, {"account"})
+
+        scheduler.reset_mock()
+        changed = [_account("paziente-0", chat_ids=["9"])] + accounts[1:150]
+        self.assertEqual(engine.update(changed, now), (1, 51))
+        self.assertEqual(len(engine), 150)
+        scheduler.remove_job.assert_any_call(JOB_PREFIX + "paziente-199", jobstore="memoria")
+
+    def test_a_failing_account_does_not_block_the_others(self):
+        scheduler = Mock()
+
+        def factory(account):
+            if account.region not in ("US", "OUS"):
+                raise ValueError(f"Regione sconosciuta: {account.region}")
+            return Mock(account=account)
+
+        engine = SyncEngine(scheduler, factory, interval=300)
+        accounts = [_account("anna"), _account("luca", region="XX"), _account("sara")]
+
+        self.assertEqual(engine.update(accounts), (2, 0))
+        self.assertIsNone(engine.get("luca"))
+        self.assertEqual(scheduler.add_job.call_count, 2)
+        # Al ricaricamento successivo l'account corretto viene aggiunto
+        self.assertEqual(engine.update(accounts[:1] + [_account("luca")] + accounts[2:]), (1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
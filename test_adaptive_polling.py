@@ -0,0 +1,126 @@
+import random
+import statistics
+import unittest
+
+from adaptive_polling import PublishSchedule
+
+
+def _schedule(**kwargs):
+    return PublishSchedule(interval=300, publish_delay=20, retry_delays=(10, 15, 30), max_skip=6,
+                           error_backoff=30, error_backoff_max=900, **kwargs)
+
+
+class PublishScheduleTest(unittest.TestCase):
+    def test_polls_just_after_the_next_expected_publish(self):
+        schedule = _schedule()
+
+        plan = schedule.on_reading(1000.0, 1100.0)
+
+        self.assertEqual(plan.reason, "new")
+        self.assertEqual(plan.delay, 1000 + 300 + 20 - 1100)
+
+    def test_learns_the_publish_delay_only_from_aligned_polls(self):
+        schedule = _schedule()
+        schedule.on_reading(1000.0, 1250.0)
+        self.assertEqual(schedule.publish_delay, 20)
+
+        schedule.on_reading(1300.0, 1312.0)
+
+        self.assertEqual(schedule.publish_delay, 12)
+        self.assertEqual(schedule.expected_publish(1312.0), 1612.0)
+
+    def test_retries_quickly_then_skips_to_later_slots(self):
+        schedule = _schedule()
+        schedule.on_reading(1000.0, 1020.0)
+
+        now, reasons, delays = 1320.0, [], []
+        for _ in range(7):
+            plan = schedule.on_reading(1000.0, now)
+            reasons.append(plan.reason)
+            delays.append(plan.delay)
+            now += plan.delay
+
+        self.assertEqual(reasons, ["retry"] * 5 + ["missed", "retry"])
+        self.assertEqual(delays[:5], [10, 15, 30, 30, 30])
+        # Metà slot senza valore: si riprova alla pubblicazione successiva (1000 + 2 * 300 + 20)
+        self.assertEqual(1320 + sum(delays[:6]), 1620)
+
+    def test_learns_a_share_delay_longer_than_the_estimate(self):
+        schedule = _schedule()
+        schedule.on_reading(1000.0, 1020.0)
+
+        now = 1320.0
+        while (plan := schedule.on_reading(1300.0 if now >= 1390 else 1000.0, now)).reason == "retry":
+            now += plan.delay
+
+        self.assertEqual(plan.reason, "new")
+        self.assertEqual(schedule.publish_delay, 105)
+        self.assertEqual(now + plan.delay, 1705)
+
+    def test_missed_slots_back_off_exponentially(self):
+        schedule = _schedule()
+        schedule.on_reading(0.0, 20.0)
+        schedule.retry_delays = ()
+
+        now, gaps = 320.0, []
+        for _ in range(5):
+            plan = schedule.on_reading(0.0, now)
+            gaps.append(round((now + plan.delay - 20) / 300))
+            now += plan.delay
+
+        self.assertEqual(gaps, [2, 4, 8, 14, 20])
+
+    def test_polling_early_waits_for_the_expected_publish(self):
+        schedule = _schedule()
+        schedule.on_reading(1000.0, 1020.0)
+
+        plan = schedule.on_reading(1000.0, 1200.0)
+
+        self.assertEqual((plan.reason, plan.delay), ("early", 120.0))
+
+    def test_errors_back_off_exponentially_without_losing_the_phase(self):
+        schedule = _schedule()
+        schedule.on_reading(1000.0, 1020.0)
+
+        delays = [schedule.on_error(1320.0).delay for _ in range(7)]
+        plan = schedule.on_reading(1900.0, 2000.0)
+
+        self.assertEqual(delays, [30, 60, 120, 240, 480, 900, 900])
+        self.assertEqual(plan.delay, 1900 + 300 + 20 - 2000)
+        self.assertEqual(schedule.publish_delay, 20)
+
+    def test_no_data_during_warm_up_backs_off(self):
+        schedule = _schedule()
+
+        delays = [schedule.on_reading(None, 0.0).delay for _ in range(5)]
+
+        self.assertEqual(delays, [300, 600, 1200, 1800, 1800])
+
+    def test_ingest_lag_beats_a_fixed_interval_on_a_simulated_day(self):
+        rng = random.Random(7)
+        phase, share_delay = 137.0, 40.0
+
+        def latest(now):
+            k = (now - share_delay - phase) // 300
+            return phase + k * 300
+
+        def simulate(next_delay):
+            now, seen, lags, calls = rng.uniform(0, 300), None, [], 0
+            while now < 86_400:
+                calls += 1
+                reading = latest(now)
+                if reading != seen:
+                    lags.append(now - reading)
+                    seen = reading
+                now += next_delay(reading, now)
+            return statistics.fmean(lags[1:]), calls / len(lags)
+
+        schedule = _schedule()
+        adaptive_lag, adaptive_calls = simulate(lambda r, now: schedule.on_reading(r, now).delay)
+        fixed_lag, _ = simulate(lambda r, now: 300)
+
+        self.assertLess(adaptive_lag, share_delay + 10)
+        self.assertGreater(fixed_lag, adaptive_lag + 60)
+        self.assertLess(adaptive_calls, 1.1)
+        self.assertAlmostEqual(schedule.publish_delay, 45)
+        self.assertLess(schedule.status()["ingest_lag_median"], share_delay + 10)
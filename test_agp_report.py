@@ -0,0 +1,75 @@
+import unittest
+from datetime import datetime
+from unittest.mock import Mock
+
+import numpy as np
+import pytz
+
+from agp_report import agp, bin_percentiles, episodes, load_series, local_minutes
+
+ROME = pytz.timezone("Europe/Rome")
+FIVE_MIN = 5 * 60 * 1000
+
+
+def _ms(*args):
+    return int(ROME.localize(datetime(*args)).timestamp() * 1000)
+
+
+class AgpReportTest(unittest.TestCase):
+    def test_bin_percentiles_match_numpy_percentile(self):
+        rng = np.random.default_rng(7)
+        bins = rng.integers(0, 4, size=500)
+        values = rng.normal(130, 30, size=500)
+
+        table, counts = bin_percentiles(bins, values, 5)
+
+        for index in range(4):
+            expected = np.percentile(values[bins == index], [5, 25, 50, 75, 95])
+            np.testing.assert_allclose(table[:, index], expected)
+        self.assertTrue(np.isnan(table[:, 4]).all())
+        self.assertEqual(counts.sum(), 500)
+
+    def test_local_minutes_follow_daylight_saving_time(self):
+        dates = np.array([_ms(2025, 1, 15, 8, 30), _ms(2025, 7, 15, 8, 30)], dtype=np.int64)
+        np.testing.assert_array_equal(local_minutes(dates, ROME), [510, 510])
+
+    def test_episodes_need_fifteen_minutes_and_break_on_gaps(self):
+        start = _ms(2025, 5, 1, 3, 0)
+        dates = start + FIVE_MIN * np.array([0, 1, 2, 3, 4, 5, 6, 7, 12, 13, 14, 15], dtype=np.int64)
+        values = np.array([90, 68, 62, 60, 66, 80, 65, 90, 64, 63, 61, 62], dtype=np.float64)
+
+        hypo = episodes(dates, values, below=70)
+
+        self.assertEqual([(e["minutes"], e["nadir"]) for e in hypo], [(15, 60.0), (15, 61.0)])
+        self.assertEqual(hypo[0]["start"], int(dates[1]))
+
+    def test_builds_a_profile_from_batched_cursor_columns(self):
+        cursor = Mock()
+        cursor.sort.return_value = cursor
+        cursor.batch_size.return_value = cursor
+        cursor.__iter__ = Mock(return_value=iter([
+            {"date": _ms(2025, 5, 1, 0, 5), "sgv": 100},
+            {"date": _ms(2025, 5, 2, 0, 10), "sgv": 200},
+            {"date": _ms(2025, 5, 1, 12, 0), "sgv": 60},
+        ]))
+        collection = Mock()
+        collection.find.return_value = cursor
+
+        dates, values = load_series(collection, 0, 2 ** 62)
+        report = agp(dates, values, ROME, bin_minutes=60)
+
+        self.assertEqual(collection.find.call_args.args[1], {"_id": 0, "date": 1, "sgv": 1})
+        self.assertEqual(len(report["bins"]), 24)
+        self.assertEqual(report["bins"][0], {"time": "00:00", "count": 2, "p5": 105.0, "p25": 125.0,
+                                             "p50": 150.0, "p75": 175.0, "p95": 195.0})
+        self.assertIsNone(report["bins"][1]["p50"])
+        self.assertEqual(report["tir"]["below_70"], 33.3)
+        cursor.close.assert_called_once()
+
+    def test_empty_history(self):
+        report = agp(np.zeros(0, dtype=np.int64), np.zeros(0), ROME)
+        self.assertEqual(report["count"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
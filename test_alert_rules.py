@@ -0,0 +1,118 @@
+import json
+import os
+import tempfile
+import unittest
+
+from alert_rules import CooldownTracker, RuleEngine, lead_times, load_config, replay
+from glucose_history import GlucoseHistory
+
+
+def _history(*readings):
+    history = GlucoseHistory()
+    history.seed([{"sgv": v, "direction": t, "date": i * 300_000} for i, (v, t) in enumerate(readings)])
+    return history
+
+
+def _codes(history, engine=None):
+    return [rule.code for rule in (engine or RuleEngine()).evaluate(history).alerts]
+
+
+class DefaultRulesTest(unittest.TestCase):
+    def test_fast_descent(self):
+        self.assertEqual(_codes(_history((120, "↘"), (100, "↓"), (88, "↓"))), ["rapida"])
+
+    def test_stable_but_low(self):
+        self.assertEqual(_codes(_history((90, "→"), (88, "→"), (86, "→"))), ["stabile_86"])
+
+    def test_stable_at_seventy_and_below(self):
+        self.assertEqual(_codes(_history((74, "↘"), (72, "→"), (70, "→"))), ["stabile_70"])
+        self.assertEqual(_codes(_history((74, "↘"), (72, "↘"), (68, "→"))), ["stabile_sotto70"])
+
+    def test_slow_descent_after_a_jump_and_gradual(self):
+        self.assertEqual(_codes(_history((95, "→"), (92, "→"), (85, "↘"))), ["lenta_salto"])
+        self.assertEqual(_codes(_history((89, "↘"), (87, "↘"), (84, "↘"))), ["lenta_graduale"])
+
+    def test_rising_value_resets_and_fires_nothing(self):
+        evaluation = RuleEngine().evaluate(_history((80, "↗"), (84, "↗"), (90, "↑")))
+        self.assertTrue(evaluation.reset)
+        self.assertEqual(evaluation.alerts, ())
+
+    def test_needs_three_readings(self):
+        self.assertEqual(_codes(_history((88, "↓"), (80, "↓"))), [])
+
+
+class ConfiguredRulesTest(unittest.TestCase):
+    def test_rules_and_cooldowns_come_from_a_json_file(self):
+        config = {
+            "cooldown": {"max_notifications": 1, "seconds": 600},
+            "rules": [{"code": "discesa_4", "title": "Discesa", "window": 4, "window_decreasing": True,
+                       "window_min_at_least": 60, "cooldown_seconds": 60}],
+        }
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(config, f)
+        self.addCleanup(os.unlink, f.name)
+
+        engine = RuleEngine(load_config(f.name))
+
+        self.assertEqual(_codes(_history((110, "→"), (100, "→"), (95, "→"), (92, "→")), engine), ["discesa_4"])
+        self.assertEqual(_codes(_history((110, "→"), (100, "→"), (101, "→"), (92, "→")), engine), [])
+        self.assertEqual(engine.new_cooldown().limits("discesa_4"), (1, 60))
+        self.assertIsNone(engine.reset_rule)
+
+
+class CooldownTrackerTest(unittest.TestCase):
+    def test_allows_two_notifications_per_thirty_minutes(self):
+        cooldown = CooldownTracker()
+        for now in (0, 300):
+            self.assertTrue(cooldown.allow("rapida", now))
+            cooldown.record("rapida", now)
+
+        self.assertFalse(cooldown.allow("rapida", 600))
+        self.assertTrue(cooldown.allow("rapida", 300 + 1800))
+        cooldown.reset("rapida")
+        self.assertTrue(cooldown.allow("rapida", 700))
+
+
+class ReplayTest(unittest.TestCase):
+    def test_replays_a_day_with_cooldown_on_reading_time(self):
+        values = [100, 95, 91, 85, 84, 82, 80, 79]
+        entries = [{"sgv": v, "direction": "↘", "date": i * 300_000} for i, v in enumerate(values)]
+
+        alerts = replay(reversed(entries))
+
+        self.assertEqual([a.code for a in alerts], ["lenta_salto", "lenta_graduale", "lenta_graduale"])
+        self.assertEqual(alerts[0].as_dict()["sgv"], 85)
+        self.assertEqual(alerts[-1].date, 6 * 300_000)
+
+
+class PredictedLowTest(unittest.TestCase):
+    def test_projects_a_steady_fall_below_seventy(self):
+        engine = RuleEngine()
+        evaluation = engine.evaluate(_history((110, "↘"), (103, "↘"), (96, "↘"), (89, "↘")))
+
+        self.assertEqual(evaluation.alerts, ())
+        self.assertEqual(evaluation.predicted.code, "prevista_ipo")
+        self.assertIn("20 minuti", evaluation.predicted.message)
+
+    def test_quiet_when_flat_or_when_a_classic_rule_already_fired(self):
+        self.assertIsNone(RuleEngine().evaluate(_history((100, "→"), (99, "→"), (100, "→"))).predicted)
+        evaluation = RuleEngine().evaluate(_history((120, "↘"), (100, "↓"), (88, "↓")))
+        self.assertEqual([r.code for r in evaluation.alerts], ["rapida"])
+        self.assertIsNone(evaluation.predicted)
+
+    def test_replay_reports_how_much_earlier_the_prediction_fires(self):
+        values = [140, 132, 124, 116, 108, 100, 93, 85, 84, 82]
+        entries = [{"sgv": v, "direction": "↘", "date": i * 300_000} for i, v in enumerate(values)]
+
+        alerts = replay(entries, predicted=True)
+        report = lead_times(alerts)
+
+        self.assertEqual([a.code for a in alerts][:3], ["prevista_ipo", "prevista_ipo", "lenta_salto"])
+        self.assertEqual(report["episodes"], 1)
+        self.assertEqual(report["details"][0]["code"], "lenta_salto")
+        self.assertEqual(report["mean_lead_minutes"], 10)
+        self.assertNotIn("prevista_ipo", [a.code for a in replay(entries)])
+
+
+if __name__ == "__main__":
+    unittest.main()
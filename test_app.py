@@ -1,6 +1,17 @@
 import os
+import time
 import unittest
-from unittest.mock import patch
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock, patch
+
+import pytz
+from pymongo import UpdateOne
+
+from dexcom_g7 import G7Reading
+from glucose_history import GlucoseHistory
+from glucose_store import retention_boundary
+from nightscout_entries import EntryWriter
+from reading_hub import ReadingHub
 
 
 class AppTest(unittest.TestCase):
@@ -16,5 +27,495 @@ class AppTest(unittest.TestCase):
         self.assertEqual(response.get_json(), {"status": "ok", "device": "dexcom-g7"})
 
 
+@patch.dict(os.environ, {"MONGO_URI": "mongodb://localhost:27017"})
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+        self.now = time.time()
+
+    def _reading(self, minutes_ago, value):
+        return G7Reading(value, "steady", "→", datetime.fromtimestamp(self.now - minutes_ago * 60))
+
+    def test_fetches_only_the_missing_window_and_writes_one_ordered_batch(self):
+        stored_ms = int((self.now - 21 * 60) * 1000)
+        readings = [self._reading(1, 101), self._reading(6, 102), self._reading(11, 103),
+                    self._reading(16, 104), self._reading(21, 105)]
+
+        entries = Mock()
+        entries.find_one.return_value = {"date": stored_ms}
+        entries.bulk_write.return_value.upserted_count = 4
+        entries.bulk_write.return_value.upserted_ids = {i: i for i in range(4)}
+        with patch.object(self.main, "entries_collection", entries), \
+                patch.object(self.main, "entries_writer", EntryWriter(entries)), \
+                patch.object(self.main, "get_g7_readings", return_value=readings) as fetch, \
+                patch.object(self.main, "daily_stats_collection") as daily_stats, \
+                patch.object(self.main, "update_rollups") as update_rollups:
+            written = self.main.backfill_glicemie()
+
+        self.assertEqual(written, 4)
+        minutes = fetch.call_args.kwargs["minutes"]
+        self.assertTrue(21 <= minutes <= 22)
+        entries.bulk_write.assert_called_once()
+        inserted = update_rollups.call_args.args[1]
+        self.assertEqual([e["sgv"] for e in inserted], [104, 103, 102, 101])
+        self.assertEqual(entries.bulk_write.call_args.args[0], [
+            UpdateOne({"device": e["device"], "date": e["date"]}, {"$setOnInsert": e}, upsert=True)
+            for e in inserted
+        ])
+        self.assertTrue(entries.bulk_write.call_args.kwargs["ordered"])
+        daily_stats.bulk_write.assert_called_once()
+
+    def test_empty_collection_pulls_the_full_share_history(self):
+        entries = Mock()
+        entries.find_one.return_value = None
+        with patch.object(self.main, "entries_collection", entries), \
+                patch.object(self.main, "entries_writer", EntryWriter(entries)), \
+                patch.object(self.main, "get_g7_readings", return_value=[]) as fetch:
+            self.assertEqual(self.main.backfill_glicemie(), 0)
+
+        fetch.assert_called_once_with(minutes=1440, max_count=288)
+        entries.bulk_write.assert_not_called()
+
+    def test_invalid_minutes_are_rejected(self):
+        with patch.object(self.main, "backfill_glicemie") as backfill:
+            response = self.main.app.test_client().post("/backfill?minuti=dieci")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Parametri non validi", response.get_json()["errore"])
+        backfill.assert_not_called()
+
+
+@patch.dict(os.environ, {"MONGO_URI": "mongodb://localhost:27017"})
+class MonitorLoopTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+        self.history = GlucoseHistory()
+
+    def test_alerts_from_the_in_memory_history_without_querying_mongo(self):
+        self.history.seed([{"sgv": v, "direction": "↘", "date": i} for i, v in enumerate([89, 86, 84])])
+
+        with patch.object(self.main, "storico", self.history), \
+                patch.object(self.main, "entries_collection") as entries, \
+                patch.object(self.main, "manda_notifica") as notifica:
+            self.main.monitor_loop()
+
+        entries.find.assert_not_called()
+        notifica.assert_called_once()
+        self.assertEqual(notifica.call_args.args[0], "lenta_graduale")
+
+
+@patch.dict(os.environ, {"MONGO_URI": "mongodb://localhost:27017"})
+class PianificaPingTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+        self.client = main.app.test_client()
+
+    def test_schedules_three_persistent_jobs_without_starting_threads(self):
+        with patch.object(self.main, "scheduler") as scheduler:
+            response = self.client.post("/pianifica-ping", json={"id": 42})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([c.kwargs["id"] for c in scheduler.add_job.call_args_list],
+                         ["ping-42-t1", "ping-42-t2", "ping-42-t3"])
+        self.assertTrue(all(c.kwargs["replace_existing"] for c in scheduler.add_job.call_args_list))
+        delays = [c.kwargs["run_date"] for c in scheduler.add_job.call_args_list]
+        self.assertEqual((delays[2] - delays[0]).total_seconds(), 120 * 60)
+
+    def test_lists_pending_jobs(self):
+        job = Mock(id="ping-42-t2", args=[42, "t2"], next_run_time=datetime(2025, 5, 1, 13, 30))
+        with patch.object(self.main, "scheduler") as scheduler:
+            scheduler.get_jobs.return_value = [job]
+            response = self.client.get("/ping-pianificati")
+
+        self.assertEqual(response.get_json(), [
+            {"id": "ping-42-t2", "pasto": 42, "campo": "t2", "esecuzione": "2025-05-01T13:30:00"}
+        ])
+
+
+@patch.dict(os.environ, {"MONGO_URI": "mongodb://localhost:27017"})
+class InviaPingTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+        self.history = GlucoseHistory()
+        self.base = datetime(2025, 5, 1, 12, 0, tzinfo=timezone.utc)
+        self.history.seed([{"sgv": 100 + i, "date": int(self.base.timestamp() * 1000) + i * 300_000}
+                           for i in range(40)])
+
+    def test_uses_the_nearest_ingested_reading_without_calling_share(self):
+        obiettivo = self.base + timedelta(minutes=181)
+        with patch.object(self.main, "storico", self.history), \
+                patch.object(self.main, "get_cached_g7_reading") as share, \
+                patch.object(self.main, "aggiorna_valori_pasto") as patch_supabase:
+            self.main.invia_ping(7, "t3", obiettivo)
+
+        share.assert_not_called()
+        patch_supabase.assert_called_once_with(7, {"t3": 136.0})
+
+    def test_overdue_pings_after_a_restart_each_record_their_own_target(self):
+        from apscheduler.schedulers.background import BackgroundScheduler
+
+        chiamate = []
+        scheduler = BackgroundScheduler(timezone="UTC",
+                                        job_defaults={"coalesce": True, "misfire_grace_time": 6 * 3600})
+        adesso = datetime.now(timezone.utc)
+        for campo, minuti in (("t1", 30), ("t2", 20), ("t3", 10)):
+            scheduler.add_job(self.main.invia_ping, "date", run_date=adesso - timedelta(minutes=minuti),
+                              args=[7, campo, self.base + timedelta(minutes=150 + minuti)],
+                              id=f"ping-7-{campo}")
+        with patch.object(self.main, "storico", self.history), \
+                patch.object(self.main, "aggiorna_valori_pasto", side_effect=lambda *a: chiamate.append(a)):
+            scheduler.start()
+            self.addCleanup(scheduler.shutdown, wait=False)
+            scadenza = time.monotonic() + 5
+            while len(chiamate) < 3 and time.monotonic() < scadenza:
+                time.sleep(0.01)
+
+        self.assertEqual(scheduler.get_jobs(), [])
+        self.assertEqual(sorted(chiamate, key=lambda c: list(c[1])),
+                         [(7, {"t1": 136.0}), (7, {"t2": 134.0}), (7, {"t3": 132.0})])
+
+    def test_meal_values_are_queued_in_the_outbox(self):
+        with patch.object(self.main, "outbox") as outbox:
+            self.main.aggiorna_valore_tempo(7, "t1", 130.0)
+
+        outbox.append.assert_called_once_with("supabase", 7, {"t1": 130.0})
+
+    def test_falls_back_to_share_when_nothing_was_ingested(self):
+        with patch.object(self.main, "storico", GlucoseHistory()), \
+                patch.object(self.main, "entries_collection") as entries, \
+                patch.object(self.main, "get_cached_g7_reading") as share:
+            entries.find_one.return_value = None
+            share.return_value.reading = G7Reading(97.0, "steady", "→", datetime.now())
+            self.assertEqual(self.main.lettura_vicina(int(time.time() * 1000)), 97.0)
+
+    def test_ignores_a_share_reading_far_from_the_target(self):
+        with patch.object(self.main, "storico", GlucoseHistory()), \
+                patch.object(self.main, "entries_collection") as entries, \
+                patch.object(self.main, "get_cached_g7_reading") as share:
+            entries.find_one.return_value = None
+            share.return_value.reading = G7Reading(97.0, "steady", "→", datetime.now())
+            tre_ore_fa = int((time.time() - 3 * 3600) * 1000)
+            self.assertIsNone(self.main.lettura_vicina(tre_ore_fa))
+
+
+@patch.dict(os.environ, {"MONGO_URI": "mongodb://localhost:27017"})
+class GlicemieRangeTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+        self.client = main.app.test_client()
+
+    def _rows(self, count):
+        return iter([(i * 300_000, {"sgv": 100 + i}) for i in range(count)])
+
+    def test_streams_ndjson_with_a_cursor_for_the_next_page(self):
+        with patch.object(self.main, "iter_range", return_value=self._rows(2)) as iter_range:
+            response = self.client.get("/glicemie?from=2025-05-01&to=2025-05-02&tz=Europe/Rome"
+                                       "&fields=sgv&limit=2&format=ndjson")
+
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertEqual(lines, ['{"sgv": 100}', '{"sgv": 101}', '{"next": 300000}'])
+        _, inizio, fine, campi, after, limite, passo = iter_range.call_args.args
+        self.assertEqual(inizio, int(datetime(2025, 4, 30, 22, 0, tzinfo=timezone.utc).timestamp() * 1000))
+        self.assertEqual(fine - inizio, 24 * 3600 * 1000)
+        self.assertEqual((campi, after, limite, passo), (["sgv"], None, 2, 0))
+
+    def test_last_page_of_a_json_array_has_no_cursor(self):
+        with patch.object(self.main, "iter_range", return_value=self._rows(1)):
+            response = self.client.get("/glicemie?from=0&to=1000&limit=5&step=15")
+
+        self.assertEqual(response.get_json(), {"entries": [{"sgv": 100}], "next": None})
+
+    def test_rejects_unknown_fields(self):
+        response = self.client.get("/glicemie?fields=sgv,password")
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_limits_below_one(self):
+        with patch.object(self.main, "iter_range") as iter_range:
+            for limite in ("0", "-5"):
+                self.assertEqual(self.client.get(f"/glicemie?limit={limite}").status_code, 400)
+
+        iter_range.assert_not_called()
+
+    def test_day_bounds_follow_the_timezone(self):
+        with patch.object(self.main, "iter_range", return_value=iter([])) as iter_range:
+            response = self.client.get("/glicemie-oggi?data=2025-01-15")
+
+        self.assertEqual(response.get_json(), [])
+        _, inizio, fine = iter_range.call_args.args
+        self.assertEqual(inizio, int(datetime(2025, 1, 14, 23, 0, tzinfo=timezone.utc).timestamp() * 1000))
+        self.assertEqual(fine - inizio, 24 * 3600 * 1000)
+
+
+class RollupEndpointTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+        self.client = main.app.test_client()
+
+    def test_reads_daily_buckets_within_local_day_bounds(self):
+        bucket = [{"start": 0, "count": 288, "mean": 120.0, "sd": 30.0, "min": 60, "max": 210}]
+        with patch.object(self.main, "read_rollups", return_value=bucket) as read:
+            response = self.client.get("/glicemie/rollup?livello=1d&dal=2025-01-01&al=2025-01-31")
+
+        self.assertEqual(response.get_json()["bucket"], bucket)
+        _, livello, inizio, fine = read.call_args.args
+        self.assertEqual(livello, "1d")
+        self.assertEqual(inizio, int(datetime(2024, 12, 31, 23, 0, tzinfo=timezone.utc).timestamp() * 1000))
+        self.assertEqual(fine - inizio, 31 * 24 * 3600 * 1000)
+
+    def test_rejects_unknown_levels(self):
+        self.assertEqual(self.client.get("/glicemie/rollup?livello=5m").status_code, 400)
+
+
+class RicalcolaStatisticheTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+        self.tz = pytz.timezone(main.TIMEZONE)
+
+    def _entries(self, docs):
+        """Aggregazione per giorno locale che rispetta il $match sulle date, come MongoDB."""
+
+        def aggregate(pipeline, **kwargs):
+            window = pipeline[0]["$match"]["date"]
+            days = {}
+            for doc in docs:
+                if window["$gte"] <= doc["date"] < window["$lt"]:
+                    day = datetime.fromtimestamp(doc["date"] / 1000, self.tz).strftime("%Y-%m-%d")
+                    days.setdefault(day, []).append(doc["sgv"])
+            return [{"_id": {"device": "dexcom-g7", "day": day}, "count": len(values), "sum": sum(values),
+                     "sum_sq": sum(v * v for v in values), "min": min(values), "max": max(values),
+                     **{f"band_{name}": 0 for name in ("very_low", "low", "in_range", "high", "very_high")}}
+                    for day, values in days.items()]
+
+        entries = Mock()
+        entries.aggregate.side_effect = aggregate
+        return entries
+
+    def test_keeps_the_partly_expired_day_with_raw_retention(self):
+        adesso = datetime.now(timezone.utc)
+        confine = retention_boundary(2, self.tz)
+        # Metà del giorno più vecchio è già stata eliminata dalla time-series
+        docs = [{"sgv": 100, "date": int((adesso - timedelta(days=2) + timedelta(minutes=5 * i)).timestamp() * 1000)}
+                for i in range(24 * 12 * 2)]
+        self.assertTrue(any(d["date"] < confine for d in docs))
+        stats = Mock()
+        archivio = Mock(retention_days=2, tz=self.tz)
+        with patch.object(self.main, "archivio", archivio), \
+                patch.object(self.main, "entries_collection", self._entries(docs)), \
+                patch.object(self.main, "daily_stats_collection", stats):
+            self.main.ricalcola_statistiche()
+
+        giorni = [op._doc["day"] for op in stats.bulk_write.call_args.args[0]]
+        primo = datetime.fromtimestamp(confine / 1000, self.tz).strftime("%Y-%m-%d")
+        self.assertEqual(min(giorni), primo)
+
+    def test_rebuilds_every_day_without_retention(self):
+        stats = Mock()
+        docs = [{"sgv": 100, "date": 0}]
+        with patch.object(self.main, "archivio", None), \
+                patch.object(self.main, "entries_collection", self._entries(docs)), \
+                patch.object(self.main, "daily_stats_collection", stats):
+            self.assertEqual(self.main.ricalcola_statistiche(), 1)
+
+
+class ReplayRegoleTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+        self.client = main.app.test_client()
+
+    def test_replay_day_bounds_follow_the_timezone(self):
+        entries = Mock()
+        entries.find.return_value.sort.return_value = []
+        with patch.object(self.main, "entries_collection", entries):
+            response = self.client.get("/regole/replay?data=2025-03-30")
+
+        self.assertEqual(response.get_json(), [])
+        date_filter = entries.find.call_args.args[0]["date"]
+        self.assertEqual(date_filter["$gte"], int(datetime(2025, 3, 29, 23, 0, tzinfo=timezone.utc).timestamp() * 1000))
+        # Passaggio all'ora legale: il giorno dura 23 ore
+        self.assertEqual(date_filter["$lt"] - date_filter["$gte"], 23 * 3600 * 1000)
+
+
+@patch.dict(os.environ, {"MONGO_URI": "mongodb://localhost:27017"})
+class AgpEndpointTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+        self.client = main.app.test_client()
+        main.cache_agp.clear()
+
+    def test_profile_is_cached_until_a_new_reading_is_ingested(self):
+        import numpy as np
+
+        series = (np.array([0], dtype=np.int64), np.array([100.0]))
+        with patch.object(self.main, "ultima_data_salvata", side_effect=[1000, 1000, 2000]), \
+                patch("agp_report.load_series", return_value=series) as load:
+            for _ in range(3):
+                self.assertEqual(self.client.get("/agp?giorni=14").status_code, 200)
+
+        self.assertEqual(load.call_count, 2)
+        self.assertEqual(load.call_args.args[1:], (2001 - 14 * 86_400_000, 2001))
+
+    def test_rejects_out_of_range_days(self):
+        self.assertEqual(self.client.get("/agp?giorni=365").status_code, 400)
+        self.assertEqual(self.client.get("/agp?giorni=7").status_code, 400)
+
+
+@patch.dict(os.environ, {"MONGO_URI": "mongodb://localhost:27017"})
+class GlicemiaStreamTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+        self.client = main.app.test_client()
+
+    def test_resumes_from_mongo_when_the_last_event_is_older_than_memory(self):
+        hub = ReadingHub()
+        hub.publish(900_000, {"sgv": 110})
+        with patch.object(self.main, "hub_letture", hub), \
+                patch.object(self.main, "iter_range", return_value=iter([(600_000, {"sgv": 108})])) as iter_range:
+            response = self.client.get("/glicemia/stream", headers={"Last-Event-ID": "300000"}, buffered=False)
+            chunks = response.response
+            first = [next(chunks) for _ in range(3)]
+            response.close()
+
+        self.assertEqual(response.mimetype, "text/event-stream")
+        self.assertEqual(iter_range.call_args.args[1], 300_001)
+        self.assertIn(b"id: 600000", first[1])
+        self.assertIn(b"id: 900000", first[2])
+        self.assertEqual(hub.subscribers, 0)
+
+    def test_refuses_clients_over_the_cap(self):
+        with patch.object(self.main, "hub_letture", ReadingHub(max_subscribers=0)):
+            response = self.client.get("/glicemia/stream")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "60")
+
+
+@patch.dict(os.environ, {"MONGO_URI": "mongodb://localhost:27017"})
+class MetricsEndpointTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+        self.client = main.app.test_client()
+
+    def test_exposes_mongo_rules_and_gauges_in_prometheus_format(self):
+        history = GlucoseHistory()
+        history.seed([{"sgv": v, "direction": "→", "date": i * 300_000} for i, v in enumerate([120, 118, 119])])
+        writer = Mock()
+        writer.flush.return_value = Mock(inserted=1, inserted_entries=[])
+        scheduler = Mock()
+        scheduler.get_jobs.return_value = [Mock(), Mock()]
+        with patch.object(self.main, "storico", history), \
+                patch.object(self.main, "entries_writer", writer), \
+                patch.object(self.main, "scheduler", scheduler):
+            self.main.scrivi_glicemia_su_mongo(119, datetime(2025, 5, 1, 12, 0))
+            self.main.monitor_loop()
+            response = self.client.get("/metrics")
+
+        text = response.get_data(as_text=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain; version=0.0.4"))
+        self.assertIn('mongo_operation_seconds_count{operation="write"}', text)
+        self.assertIn("alert_rules_evaluation_seconds_count", text)
+        self.assertIn("scheduler_pending_jobs 2\n", text)
+        self.assertIn("process_active_threads ", text)
+
+    def test_disabled_metrics_answer_404(self):
+        with patch.object(self.main.metrics, "ENABLED", False):
+            self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+
+@patch.dict(os.environ, {"MONGO_URI": "mongodb://localhost:27017"})
+class LeaderTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+
+    def test_standby_worker_follows_entries_written_by_the_leader(self):
+        history = GlucoseHistory()
+        history.seed([{"sgv": 120, "direction": "→", "date": 300_000}])
+        entries = Mock()
+        entries.find.return_value.sort.return_value.limit.return_value = [
+            {"sgv": 118, "direction": "↘", "date": 900_000},
+            {"sgv": 119, "direction": "→", "date": 600_000},
+        ]
+        hub = ReadingHub()
+        with patch.object(self.main, "storico", history), \
+                patch.object(self.main, "entries_collection", entries), \
+                patch.object(self.main, "hub_letture", hub):
+            self.main.segui_leader()
+
+        self.assertEqual(entries.find.call_args.args[0]["date"], {"$gt": 300_000})
+        self.assertEqual([history.value(i) for i in (-2, -1)], [119, 118])
+        self.assertEqual(hub.latest_id(), 900_000)
+
+    def test_leadership_resumes_and_pauses_the_scheduler(self):
+        with patch.object(self.main, "scheduler") as scheduler:
+            self.main.diventa_leader()
+            self.main.perde_leadership()
+
+        self.assertEqual(scheduler.add_job.call_args.kwargs["id"], "avvio-sync")
+        scheduler.resume.assert_called_once()
+        scheduler.pause.assert_called_once()
+
+
+@patch.dict(os.environ, {"MONGO_URI": "mongodb://localhost:27017"})
+class AdaptiveSyncTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+
+    def test_reschedules_itself_after_the_next_expected_publish(self):
+        from adaptive_polling import PublishSchedule
+
+        letta = datetime.now(timezone.utc) - timedelta(seconds=60)
+        schedule = PublishSchedule(publish_delay=20)
+        with patch.object(self.main, "pubblicazione", schedule), \
+                patch.object(self.main, "scheduler") as scheduler, \
+                patch.object(self.main, "invia_a_mongo") as invia, \
+                patch.object(self.main, "get_fresh_g7_reading") as share:
+            share.return_value.reading = G7Reading(120.0, "steady", "→", letta)
+            self.main.sincronizza_g7()
+
+        invia.assert_called_once_with(share.return_value.reading)
+        job = scheduler.add_job.call_args
+        self.assertEqual(job.kwargs["id"], "sync-dexcom")
+        prevista = letta + timedelta(seconds=320)
+        self.assertLess(abs((job.kwargs["run_date"] - prevista).total_seconds()), 2)
+
+    def test_share_errors_still_reschedule_with_backoff(self):
+        from adaptive_polling import PublishSchedule
+
+        with patch.object(self.main, "pubblicazione", PublishSchedule(error_backoff=30)), \
+                patch.object(self.main, "scheduler") as scheduler, \
+                patch.object(self.main, "get_fresh_g7_reading", side_effect=ConnectionError("down")):
+            self.main.sincronizza_g7()
+
+        attesa = scheduler.add_job.call_args.kwargs["run_date"] - datetime.now(timezone.utc)
+        self.assertAlmostEqual(attesa.total_seconds(), 30, delta=2)
+
+
 if __name__ == "__main__":
     unittest.main()
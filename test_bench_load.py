@@ -0,0 +1,45 @@
+import os
+import unittest
+from unittest.mock import patch
+
+from bench_load import FakeShare, compare
+from dexcom_g7 import DexcomG7Client
+
+
+class FakeShareTest(unittest.TestCase):
+    def test_pydexcom_logs_in_and_reads_from_the_fake_server(self):
+        with FakeShare() as share, patch.dict(os.environ, {"DEXCOM_SHARE_URL": share.url}):
+            client = DexcomG7Client("bench", "bench")
+            reading = client.get_current_reading()
+            share.expire_session()
+            history = client.get_readings(minutes=60, max_count=12)
+
+        self.assertEqual(reading.value, FakeShare.value_at(int(reading.time.timestamp() * 1000)))
+        self.assertEqual(len(history), 12)
+        self.assertEqual(client.stats()["logins"], 2)
+        self.assertEqual(share.calls["General/AuthenticatePublisherAccount"], 2)
+
+
+class CompareTest(unittest.TestCase):
+    BASELINE = {
+        "endpoints": {"/glicemia": {"p99_ms": 20.0, "errors": 0}},
+        "upstream": {"share_reads": 4},
+        "threads": {"max_active": 40},
+    }
+
+    def _report(self, p99, reads, threads=40):
+        return {
+            "endpoints": {"/glicemia": {"p99_ms": p99, "errors": 0}},
+            "upstream": {"share_reads": reads},
+            "threads": {"max_active": threads},
+        }
+
+    def test_flags_slower_p99_and_extra_upstream_calls(self):
+        self.assertEqual(compare(self._report(34.0, 5), self.BASELINE), [])
+        problems = compare(self._report(36.0, 9, threads=80), self.BASELINE)
+        self.assertEqual(len(problems), 3)
+        self.assertTrue(problems[0].startswith("/glicemia: p99"))
+
+
+if __name__ == "__main__":
+    unittest.main()
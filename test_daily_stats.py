@@ -0,0 +1,79 @@
+import unittest
+from datetime import datetime
+from unittest.mock import Mock
+
+import pytz
+
+from daily_stats import band, rebuild_daily_stats, summarize, update_daily_stats
+
+ROME = pytz.timezone("Europe/Rome")
+
+
+def _ms(*args):
+    return int(ROME.localize(datetime(*args)).timestamp() * 1000)
+
+
+class DailyStatsTest(unittest.TestCase):
+    def test_bands_follow_the_consensus_thresholds(self):
+        self.assertEqual([band(v) for v in (50, 54, 69, 70, 180, 181, 250, 251)],
+                         ["very_low", "low", "low", "in_range", "in_range", "high", "high", "very_high"])
+
+    def test_groups_new_entries_into_one_increment_per_local_day(self):
+        collection = Mock()
+        entries = [
+            {"sgv": 100, "date": _ms(2025, 5, 1, 23, 55), "device": "dexcom-g7"},
+            {"sgv": 60, "date": _ms(2025, 5, 1, 23, 50), "device": "dexcom-g7"},
+            {"sgv": 200, "date": _ms(2025, 5, 2, 0, 0), "device": "dexcom-g7"},
+        ]
+
+        self.assertEqual(update_daily_stats(collection, entries, ROME), 2)
+
+        operations = {op._filter["_id"]: op._doc for op in collection.bulk_write.call_args.args[0]}
+        first = operations["dexcom-g7:2025-05-01"]
+        self.assertEqual(first["$inc"], {"count": 2, "sum": 160, "sum_sq": 13600,
+                                         "bands.in_range": 1, "bands.low": 1})
+        self.assertEqual((first["$min"], first["$max"]), ({"min": 60}, {"max": 100}))
+        self.assertEqual(operations["dexcom-g7:2025-05-02"]["$inc"]["bands.high"], 1)
+
+    def test_nothing_to_write_without_entries(self):
+        collection = Mock()
+        self.assertEqual(update_daily_stats(collection, [], ROME), 0)
+        collection.bulk_write.assert_not_called()
+
+    def test_summarizes_a_range_from_daily_documents(self):
+        days = [
+            {"count": 2, "sum": 200.0, "sum_sq": 20200.0, "min": 90, "max": 110,
+             "bands": {"in_range": 2}},
+            {"count": 2, "sum": 300.0, "sum_sq": 45200.0, "min": 140, "max": 160,
+             "bands": {"in_range": 2}},
+        ]
+
+        summary = summarize(days)
+
+        self.assertEqual(summary["count"], 4)
+        self.assertEqual(summary["mean"], 125.0)
+        self.assertEqual(summary["sd"], 26.9)
+        self.assertEqual(summary["cv"], 21.5)
+        self.assertEqual(summary["gmi"], 6.30)
+        self.assertEqual((summary["min"], summary["max"]), (90, 160))
+        self.assertEqual(summary["tir"]["in_range"], 100.0)
+        self.assertEqual(summarize([]), {"count": 0})
+
+    def test_rebuild_replaces_each_aggregated_day(self):
+        entries, stats = Mock(), Mock()
+        entries.aggregate.return_value = [{
+            "_id": {"device": "dexcom-g7", "day": "2025-05-01"}, "count": 1, "sum": 95, "sum_sq": 9025,
+            "min": 95, "max": 95, "band_very_low": 0, "band_low": 0, "band_in_range": 1,
+            "band_high": 0, "band_very_high": 0,
+        }]
+
+        self.assertEqual(rebuild_daily_stats(entries, stats, "Europe/Rome"), 1)
+
+        pipeline = entries.aggregate.call_args.args[0]
+        self.assertEqual(pipeline[1]["$group"]["_id"]["day"]["$dateToString"]["timezone"], "Europe/Rome")
+        replacement = stats.bulk_write.call_args.args[0][0]._doc
+        self.assertEqual(replacement["bands"]["in_range"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,17 +1,32 @@
 import os
+import threading
 import unittest
+from datetime import datetime
 from unittest.mock import Mock, patch
 
-from dexcom_g7 import DexcomG7Client
+import dexcom_g7
+from dexcom_g7 import DexcomG7Client, G7Reading, ReadingCache, _PooledDexcom, get_shared_client
+
+
+def _share_response(status, body):
+    response = Mock(status_code=status)
+    response.json.return_value = body
+    if status >= 400:
+        response.raise_for_status.side_effect = Exception(f"HTTP {status}")
+    return response
+
+
+def _share_value(value):
+    return {"Value": value, "Trend": "Flat", "WT": "Date(1700000000000)"}
 
 
 class DexcomG7ClientTest(unittest.TestCase):
-    @patch("dexcom_g7.Dexcom")
+    @patch("dexcom_g7._PooledDexcom")
     def test_uses_international_share_server_for_italy(self, dexcom):
         DexcomG7Client("utente", "segreto", "OUS")
         dexcom.assert_called_once_with("utente", "segreto", ous=True)
 
-    @patch("dexcom_g7.Dexcom")
+    @patch("dexcom_g7._PooledDexcom")
     def test_normalizes_a_g7_reading(self, dexcom):
         raw = Mock(value=123, trend_description="steady", trend_arrow="→")
         raw.time = Mock()
@@ -33,5 +48,139 @@ class DexcomG7ClientTest(unittest.TestCase):
             DexcomG7Client.from_environment()
 
 
+class SharedSessionTest(unittest.TestCase):
+    def setUp(self):
+        dexcom_g7.reset_shared_clients()
+        self.addCleanup(dexcom_g7.reset_shared_clients)
+
+    @patch("dexcom_g7._PooledDexcom")
+    def test_registry_reuses_one_client_per_account_and_region(self, dexcom):
+        first = get_shared_client("utente", "segreto", "ous")
+        second = get_shared_client("utente", "segreto", "OUS")
+        other_region = get_shared_client("utente", "segreto", "US")
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other_region)
+        self.assertEqual(dexcom.call_count, 2)
+
+    @patch("dexcom_g7._shared_http_session")
+    def test_logs_in_once_and_reuses_the_session_id(self, http):
+        http.return_value.request.side_effect = [
+            _share_response(200, "account-id"),
+            _share_response(200, "session-1"),
+            _share_response(200, [_share_value(110)]),
+            _share_response(200, [_share_value(112)]),
+        ]
+        client = DexcomG7Client("utente", "segreto", "OUS")
+
+        self.assertEqual(client.get_current_reading().value, 110.0)
+        self.assertEqual(client.get_current_reading().value, 112.0)
+        self.assertEqual((client.stats()["logins"], client.stats()["reads"]), (1, 2))
+
+    @patch("dexcom_g7._shared_http_session")
+    def test_refreshes_the_session_only_after_session_error(self, http):
+        http.return_value.request.side_effect = [
+            _share_response(200, "account-id"),
+            _share_response(200, "session-1"),
+            _share_response(500, {"Code": "SessionNotValid", "Message": "scaduta"}),
+            _share_response(200, "account-id"),
+            _share_response(200, "session-2"),
+            _share_response(200, [_share_value(95)]),
+        ]
+        dexcom = _PooledDexcom("utente", "segreto", ous=True)
+        dexcom.ensure_session()
+
+        reading = dexcom.get_current_glucose_reading()
+
+        self.assertEqual(reading.value, 95)
+        self.assertEqual(dexcom.session_id, "session-2")
+        self.assertEqual((dexcom.logins, dexcom.reads), (2, 2))
+
+
+def _reading_at(epoch, value=100.0):
+    return G7Reading(value, "steady", "→", datetime.fromtimestamp(epoch))
+
+
+class ReadingCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1_000_000.0
+
+    def _cache(self, fetch):
+        return ReadingCache(fetch, interval=300, grace=20, min_refresh=30, clock=lambda: self.now)
+
+    def test_serves_the_cached_reading_until_the_next_expected_publish(self):
+        fetch = Mock(side_effect=[_reading_at(self.now - 60, 110), _reading_at(self.now + 250, 105)])
+        cache = self._cache(fetch)
+
+        first = cache.get()
+        self.now += 200
+        second = cache.get()
+        self.now += 61
+        third = cache.get()
+
+        self.assertFalse(first.hit)
+        self.assertTrue(second.hit)
+        self.assertEqual(second.reading.value, 110)
+        self.assertEqual(third.reading.value, 105)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_retries_a_late_reading_after_the_minimum_refresh(self):
+        fetch = Mock(return_value=_reading_at(self.now - 400))
+        cache = self._cache(fetch)
+
+        cache.get()
+        self.now += 29
+        cache.get()
+        self.now += 2
+        cache.get()
+
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_refresh_bypasses_a_valid_entry_and_updates_it(self):
+        fetch = Mock(side_effect=[_reading_at(self.now - 60, 110), _reading_at(self.now - 5, 104)])
+        cache = self._cache(fetch)
+
+        cache.get()
+        fresh = cache.refresh()
+
+        self.assertFalse(fresh.hit)
+        self.assertEqual(cache.get().reading.value, 104)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_headers_report_hit_age_and_remaining_validity(self):
+        cache = self._cache(Mock(return_value=_reading_at(self.now - 100)))
+        cache.get()
+
+        headers = cache.get().headers(now=self.now)
+
+        self.assertEqual(headers["X-Cache"], "HIT")
+        self.assertEqual(headers["X-Reading-Age"], "100")
+        self.assertEqual(headers["Cache-Control"], "max-age=220")
+
+    def test_concurrent_misses_share_a_single_upstream_call(self):
+        release = threading.Event()
+        calls = []
+
+        def slow_fetch():
+            calls.append(1)
+            release.wait(5)
+            return _reading_at(self.now)
+
+        cache = ReadingCache(slow_fetch)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get())) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while cache.coalesced < 3:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(sum(1 for r in results if not r.hit), 1)
+
+
 if __name__ == "__main__":
     unittest.main()
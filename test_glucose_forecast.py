@@ -0,0 +1,49 @@
+import unittest
+
+from glucose_forecast import PredictiveLow, SlopeEstimator
+
+MINUTE = 60_000
+
+
+class SlopeEstimatorTest(unittest.TestCase):
+    def test_sliding_fit_matches_the_last_window(self):
+        estimator = SlopeEstimator(window=3)
+        for i, value in enumerate([100, 100, 100, 95, 90]):
+            estimator.update(i * 5 * MINUTE, value)
+
+        # Restano 100, 95, 90: -1 mg/dL al minuto
+        self.assertEqual(len(estimator), 3)
+        self.assertAlmostEqual(estimator.slope, -1.0)
+        self.assertAlmostEqual(estimator.projected(20), 70.0)
+
+    def test_ignores_stale_readings_and_restarts_after_a_gap(self):
+        estimator = SlopeEstimator(window=4)
+        estimator.update(0, 120)
+        estimator.update(5 * MINUTE, 110)
+        self.assertFalse(estimator.update(5 * MINUTE, 50))
+        self.assertAlmostEqual(estimator.slope, -2.0)
+
+        estimator.update(60 * MINUTE, 90)
+        self.assertEqual(len(estimator), 1)
+        self.assertIsNone(estimator.slope)
+
+
+class PredictiveLowTest(unittest.TestCase):
+    def test_fires_only_above_threshold_with_a_falling_projection(self):
+        predictor = PredictiveLow(horizon_minutes=20, threshold=70)
+        for i, value in enumerate([100, 96, 92]):
+            predictor.update(i * 5 * MINUTE, value)
+        # Proiezione a 76: ancora sopra soglia
+        self.assertAlmostEqual(predictor.estimator.projected(20), 76.0)
+        self.assertIsNone(predictor.check())
+
+        predictor.update(15 * MINUTE, 86)
+        self.assertLess(predictor.check(), 70)
+
+        for i, value in enumerate([75, 71, 67], start=4):
+            predictor.update(i * 5 * MINUTE, value)
+        self.assertIsNone(predictor.check())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+from glucose_history import GlucoseHistory
+
+
+class GlucoseHistoryTest(unittest.TestCase):
+    def test_keeps_only_the_most_recent_readings_in_order(self):
+        history = GlucoseHistory(capacity=3)
+        for minute, value in enumerate([120, 115, 110, 104, 99]):
+            history.append(value, "↘", minute * 300_000)
+
+        self.assertEqual(len(history), 3)
+        self.assertEqual([history.value(i) for i in range(3)], [110, 104, 99])
+        self.assertEqual(history.value(-1), 99)
+        self.assertEqual(history.date(0), 600_000)
+        with self.assertRaises(IndexError):
+            history.value(3)
+
+    def test_ignores_a_repeated_or_older_share_reading(self):
+        history = GlucoseHistory()
+        self.assertTrue(history.append(100, "→", 1_000))
+        self.assertFalse(history.append(100, "→", 1_000))
+        self.assertFalse(history.append(98, "→", 500))
+        self.assertEqual(len(history), 1)
+
+    def test_seeds_from_mongo_documents_newest_first(self):
+        history = GlucoseHistory()
+        history.seed([
+            {"sgv": 88, "direction": "↘", "date": 3},
+            {"sgv": 92, "direction": "FortyFiveDown", "date": 2},
+            {"sgv": 95, "date": 1},
+        ])
+
+        self.assertEqual([history.value(i) for i in range(3)], [95, 92, 88])
+        self.assertEqual([history.trend(i) for i in range(3)], ["→", "↘", "↘"])
+
+    def test_window_helpers(self):
+        history = GlucoseHistory()
+        history.seed([{"sgv": v, "direction": "→", "date": i} for i, v in enumerate([100, 95, 90, 86])])
+
+        self.assertTrue(history.all_trend(3, "→"))
+        self.assertFalse(history.all_trend(5, "→"))
+        self.assertEqual(history.max_value(3), 95)
+        self.assertEqual(history.min_value(2), 86)
+        self.assertTrue(history.strictly_decreasing(4))
+
+    def test_nearest_reading_within_tolerance(self):
+        history = GlucoseHistory()
+        history.seed([{"sgv": v, "date": i * 300_000} for i, v in enumerate([100, 110, 120])])
+
+        self.assertEqual(history.nearest(320_000, 60_000), 1)
+        self.assertEqual(history.nearest(560_000, 60_000), 2)
+        self.assertIsNone(history.nearest(1_000_000, 60_000))
+
+
+if __name__ == "__main__":
+    unittest.main()
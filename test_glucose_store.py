@@ -0,0 +1,295 @@
+import threading
+import time
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, Mock, patch
+
+import pytz
+from pymongo.errors import AutoReconnect
+
+from glucose_store import (
+    GlucoseStore,
+    TimeSeriesWriter,
+    create_entries_view,
+    ensure_timeseries,
+    read_rollups,
+    rebuild_rollups,
+    retention_boundary,
+    to_datetime,
+    to_ms,
+    update_rollups,
+)
+from migrate_timeseries import CHECKPOINT_ID, migrate, swap_to_view
+from nightscout_entries import DEVICE, iter_range
+
+try:
+    import mongomock
+except ImportError:  # mongomock è facoltativo, come per bench_load.py
+    mongomock = None
+
+ROME = pytz.timezone("Europe/Rome")
+# 2025-05-10 00:00 a Roma
+START = int(ROME.localize(datetime(2025, 5, 10)).timestamp() * 1000)
+STEP = 5 * 60_000
+
+
+def _entry(index, sgv=100, device=DEVICE):
+    return {"type": "sgv", "sgv": sgv, "date": START + index * STEP, "direction": "Flat",
+            "device": device, "dateString": "2025-05-10T00:00:00"}
+
+
+class ConversionTest(unittest.TestCase):
+    def test_milliseconds_round_trip_through_bson_dates(self):
+        self.assertEqual(to_ms(to_datetime(START)), START)
+        self.assertEqual(to_datetime(START), datetime(2025, 5, 9, 22, 0, tzinfo=timezone.utc))
+        self.assertEqual(to_ms(datetime(2025, 5, 9, 22, 0)), START)
+
+
+@unittest.skipIf(mongomock is None, "mongomock non installato")
+class NightscoutViewTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock.MongoClient().nightscout
+        self.store = GlucoseStore(self.db, "Europe/Rome")
+        self.store.writer.add_many([_entry(i, 100 + i) for i in range(6)])
+        self.store.writer.flush()
+
+    def test_reads_time_series_documents_as_nightscout_entries(self):
+        raw = self.db.glucose.find_one({}, {"_id": 0})
+        self.assertEqual(raw["meta"], {"device": DEVICE})
+        self.assertIsInstance(raw["date"], datetime)
+
+        latest = self.store.entries.find_one({"type": "sgv"}, {"_id": 0}, sort=[("date", -1)])
+
+        self.assertEqual(latest["sgv"], 105)
+        self.assertEqual(latest["date"], START + 5 * STEP)
+        self.assertEqual((latest["type"], latest["device"]), ("sgv", DEVICE))
+
+    def test_range_queries_translate_milliseconds(self):
+        rows = list(iter_range(self.store.entries, START + STEP, START + 4 * STEP, fields=("sgv",)))
+
+        self.assertEqual([(date, doc["sgv"]) for date, doc in rows],
+                         [(START + STEP, 101), (START + 2 * STEP, 102), (START + 3 * STEP, 103)])
+        self.assertEqual(set(rows[0][1]), {"sgv"})
+        self.assertEqual(self.store.entries.count_documents({"type": "sgv", "date": {"$gte": START + 3 * STEP}}), 3)
+        self.assertEqual(self.store.entries.count_documents({"type": "mbg"}), 0)
+
+
+@unittest.skipIf(mongomock is None, "mongomock non installato")
+class TimeSeriesWriterTest(unittest.TestCase):
+    def test_skips_readings_already_stored(self):
+        collection = mongomock.MongoClient().nightscout.glucose
+        writer = TimeSeriesWriter(collection, account="mamma")
+        writer.add_many([_entry(0), _entry(1)])
+        writer.flush()
+
+        writer.add_many([_entry(1), _entry(2), _entry(2)])
+        report = writer.flush()
+
+        self.assertEqual((report.inserted, report.deduped), (1, 1))
+        self.assertEqual([e["date"] for e in report.inserted_entries], [START + 2 * STEP])
+        self.assertEqual(collection.count_documents({}), 3)
+        self.assertEqual(collection.find_one({})["meta"]["account"], "mamma")
+        self.assertEqual(writer.stats()["deduped"], 2)
+
+    def test_concurrent_flushes_do_not_insert_the_same_reading_twice(self):
+        collection = mongomock.MongoClient().nightscout.glucose
+        writer = TimeSeriesWriter(collection)
+        existing = writer._existing
+
+        def slow_existing(entries):
+            found = existing(entries)
+            time.sleep(0.05)  # la sync e /backfill controllano insieme prima di inserire
+            return found
+
+        writer._existing = slow_existing
+
+        def flush_backfill():
+            writer.add(_entry(0))
+            writer.flush()
+
+        backfill = threading.Thread(target=flush_backfill)
+        backfill.start()
+        time.sleep(0.01)
+        writer.add(_entry(0))
+        writer.flush()
+        backfill.join()
+
+        self.assertEqual(collection.count_documents({}), 1)
+
+    def test_failed_insert_keeps_the_readings_for_the_next_flush(self):
+        collection = Mock()
+        collection.find.return_value = []
+        collection.insert_many.side_effect = AutoReconnect("primary cambiato")
+        writer = TimeSeriesWriter(collection)
+        writer.add(_entry(0))
+
+        with self.assertRaises(AutoReconnect):
+            writer.flush()
+
+        self.assertEqual(writer.pending(), 1)
+
+
+@unittest.skipIf(mongomock is None, "mongomock non installato")
+class RollupTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock.MongoClient().nightscout
+
+    def test_incremental_updates_match_the_readings(self):
+        update_rollups(self.db, [_entry(i, 100) for i in range(6)], ROME)
+        update_rollups(self.db, [_entry(i, 200) for i in range(6, 12)], ROME)
+        update_rollups(self.db, [_entry(12, 130)], ROME)
+
+        hours = read_rollups(self.db, "1h", START, START + 86_400_000)
+        self.assertEqual([(h["count"], h["mean"], h["sd"]) for h in hours], [(12, 150.0, 50.0), (1, 130.0, 0.0)])
+        self.assertEqual((hours[0]["min"], hours[0]["max"]), (100, 200))
+        days = read_rollups(self.db, "1d", START, START + 86_400_000)
+        self.assertEqual([(d["start"], d["count"]) for d in days], [(START, 13)])
+
+    def test_daily_buckets_follow_the_local_timezone(self):
+        # 23:55 del 9 maggio a Roma (21:55 UTC): va nel giorno precedente
+        update_rollups(self.db, [_entry(-1), _entry(0)], ROME)
+
+        days = read_rollups(self.db, "1d", START - 86_400_000, START + 86_400_000)
+
+        self.assertEqual([(d["start"], d["count"]) for d in days], [(START - 86_400_000, 1), (START, 1)])
+
+    def test_rebuild_replaces_existing_rollups(self):
+        entries = self.db.entries
+        entries.insert_many([_entry(i, 100 + i) for i in range(30)] + [{"type": "mbg", "date": START}])
+        update_rollups(self.db, [_entry(0, 400)], ROME)
+
+        self.assertEqual(rebuild_rollups(self.db, entries, ROME, batch_size=7), 30)
+
+        hours = read_rollups(self.db, "1h", START, START + 86_400_000)
+        self.assertEqual([h["count"] for h in hours], [12, 12, 6])
+        self.assertEqual(hours[0]["max"], 111)
+
+    def test_rebuild_keeps_buckets_before_the_start(self):
+        day = 86_400_000
+        entries = self.db.entries
+        entries.insert_many([_entry(i, 100) for i in range(0, 576, 12)])
+        update_rollups(self.db, [_entry(0, 300)], ROME)
+
+        rebuild_rollups(self.db, entries, ROME, start_ms=START + day)
+
+        days = read_rollups(self.db, "1d", START, START + 2 * day)
+        self.assertEqual([(d["start"], d["count"], d["max"]) for d in days], [(START, 1, 300), (START + day, 24, 100)])
+        self.assertEqual(read_rollups(self.db, "1h", START, START + day)[0]["max"], 300)
+
+    def test_rebuild_with_retention_does_not_drop_expired_days(self):
+        store = GlucoseStore(self.db, "Europe/Rome", retention_days=30)
+        update_rollups(self.db, [_entry(i, 120) for i in range(12)], ROME)
+
+        # Le glicemie grezze di maggio 2025 sono già scadute: la time-series è vuota
+        self.assertEqual(store.rebuild_rollups(), 0)
+
+        self.assertEqual([d["count"] for d in read_rollups(self.db, "1d", START, START + 86_400_000)], [12])
+
+    def test_retention_boundary_is_the_next_local_midnight(self):
+        now = datetime(2025, 6, 9, 10, 30, tzinfo=timezone.utc)
+
+        self.assertIsNone(retention_boundary(None, ROME, now))
+        self.assertEqual(retention_boundary(30, ROME, now), START + 86_400_000)
+
+
+@unittest.skipIf(mongomock is None, "mongomock non installato")
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock.MongoClient().nightscout
+        self.db.entries.insert_many([_entry(i, 100 + i) for i in range(25)])
+        self.db.entries.insert_one({"type": "sgv", "sgv": "LOW", "date": START + 25 * STEP})
+        # mongomock non crea time-series collection: basta una collection normale
+        self.ensure = patch("glucose_store.ensure_timeseries", return_value=True)
+        self.ensure.start()
+        self.addCleanup(self.ensure.stop)
+
+    def _migrate(self, **kwargs):
+        return migrate(self.db, "Europe/Rome", batch_size=10, log=lambda message: None, **kwargs)
+
+    def test_copies_entries_in_batches_and_builds_rollups(self):
+        report = self._migrate()
+
+        self.assertEqual((report["copied"], report["invalid"], report["batches"]), (25, 1, 3))
+        self.assertEqual(self.db.glucose.count_documents({}), 25)
+        self.assertEqual(self.db.migrations.find_one({"_id": CHECKPOINT_ID})["last_date"], START + 25 * STEP)
+        self.assertEqual(report["rollup_readings"], 25)
+        self.assertEqual(sum(d["count"] for d in read_rollups(self.db, "1d", START, START + 86_400_000)), 25)
+
+    def test_resumes_from_the_checkpoint_without_duplicates(self):
+        self._migrate()
+        self.db.entries.insert_many([_entry(i, 150) for i in range(26, 30)])
+        # Checkpoint perso a metà: le letture già copiate vengono riconosciute
+        self.db.migrations.update_one({"_id": CHECKPOINT_ID}, {"$set": {"last_date": START + 19 * STEP}})
+
+        report = self._migrate()
+
+        self.assertEqual((report["copied"], report["skipped"]), (4, 5))
+        self.assertEqual(self.db.glucose.count_documents({}), 29)
+        self.assertEqual(sum(d["count"] for d in read_rollups(self.db, "1h", START, START + 86_400_000)), 29)
+
+    def test_rollups_beyond_retention_come_from_the_source_collection(self):
+        report = self._migrate(retention_days=30)
+
+        days = read_rollups(self.db, "1d", START - 86_400_000, START + 86_400_000)
+        self.assertEqual([(d["start"], d["count"]) for d in days], [(START, 25)])
+        self.assertEqual(report["rollup_readings"], 25)
+
+    def test_after_swap_days_beyond_retention_are_rebuilt_from_the_legacy_collection(self):
+        self._migrate()
+        self.db.entries.rename("entries_legacy")
+        # Retention attiva: la time-series ha perso le letture di maggio 2025
+        self.db.glucose.delete_many({})
+
+        self._migrate(retention_days=30)
+
+        hours = read_rollups(self.db, "1h", START, START + 86_400_000)
+        # L'ora dell'ultima lettura di entries_legacy resta com'era
+        self.assertEqual([h["count"] for h in hours], [12, 12, 1])
+
+
+class CollectionSetupTest(unittest.TestCase):
+    def test_creates_the_time_series_collection_with_retention(self):
+        db = MagicMock()
+        db.list_collection_names.return_value = []
+
+        self.assertTrue(ensure_timeseries(db, "glucose", retention_days=90))
+
+        kwargs = db.create_collection.call_args.kwargs
+        self.assertEqual(kwargs["timeseries"], {"timeField": "date", "metaField": "meta", "granularity": "minutes"})
+        self.assertEqual(kwargs["expireAfterSeconds"], 90 * 86_400)
+        db["glucose"].create_index.assert_called_once()
+        db.command.assert_not_called()
+
+    def test_updates_the_retention_of_an_existing_collection(self):
+        db = Mock()
+        db.list_collection_names.return_value = ["glucose"]
+
+        self.assertFalse(ensure_timeseries(db, "glucose"))
+
+        db.create_collection.assert_not_called()
+        db.command.assert_called_once_with({"collMod": "glucose", "expireAfterSeconds": "off"})
+
+    def test_swap_renames_entries_and_creates_the_view(self):
+        db = MagicMock()
+
+        swap_to_view(db, "Europe/Rome")
+
+        db["entries"].rename.assert_called_once_with("entries_legacy")
+        args, kwargs = db.create_collection.call_args
+        self.assertEqual(args, ("entries",))
+        self.assertEqual(kwargs["viewOn"], "glucose")
+        projection = kwargs["pipeline"][0]["$project"]
+        self.assertEqual(projection["date"], {"$toLong": "$date"})
+        self.assertEqual(projection["dateString"]["$dateToString"]["timezone"], "Europe/Rome")
+
+    def test_view_targets_the_given_collection(self):
+        db = Mock()
+
+        create_entries_view(db, "UTC", name="entries_ts", source="glucose_test")
+
+        self.assertEqual(db.create_collection.call_args.args, ("entries_ts",))
+        self.assertEqual(db.create_collection.call_args.kwargs["viewOn"], "glucose_test")
+
+
+if __name__ == "__main__":
+    unittest.main()
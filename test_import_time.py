@@ -0,0 +1,99 @@
+import os
+import subprocess
+import sys
+import unittest
+from unittest.mock import patch
+
+from lazy import Lazy
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Margine ampio sui ~350 ms misurati: il test segnala le dipendenze pesanti
+# importate per sbaglio all'avvio, non le variazioni della macchina
+IMPORT_BUDGET_MS = 1500
+
+NO_NETWORK = """
+import socket
+
+def vietato(*args, **kwargs):
+    raise AssertionError(f"connessione durante l'avvio: {args}")
+
+socket.getaddrinfo = vietato
+socket.socket.connect = vietato
+
+import main
+import wsgi
+
+main.start_background_sync = lambda: print("avvio", flush=True)
+response = wsgi.app.test_client().get("/health")
+assert response.status_code == 200, response.status_code
+assert not main.mongo_client.initialized
+print("ok", flush=True)
+response.close()
+"""
+
+
+def _run(args, **env):
+    return subprocess.run([sys.executable, *args], cwd=HERE, capture_output=True, text=True, timeout=60,
+                          env=dict(os.environ, MONGO_URI="mongodb+srv://cluster.invalid", **env))
+
+
+class ImportTimeTest(unittest.TestCase):
+    def test_main_imports_within_budget_without_numpy(self):
+        result = _run(["-X", "importtime", "-c", "import main"])
+        self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                _, total, name = line.split("|")
+                if total.strip().isdigit():
+                    cumulative[name.strip()] = int(total) / 1000
+        self.assertLess(cumulative["main"], IMPORT_BUDGET_MS)
+        self.assertNotIn("numpy", cumulative)
+
+    def test_health_answers_before_any_connection(self):
+        result = _run(["-c", NO_NETWORK], SYNC_START_DELAY="3600")
+
+        self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+        self.assertEqual(result.stdout.split(), ["ok", "avvio"])
+
+
+class LazyTest(unittest.TestCase):
+    def test_creates_the_object_once_on_first_attribute_access(self):
+        calls = []
+        lazy = Lazy(lambda: calls.append(1) or {"nightscout": {"entries": "collection"}}, "client")
+        entries = lazy["nightscout"]["entries"]
+
+        self.assertEqual(calls, [])
+        self.assertEqual(entries.upper(), "COLLECTION")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(lazy.get("nightscout"), {"entries": "collection"})
+        self.assertEqual(len(calls), 1)
+
+
+@patch.dict(os.environ, {"MONGO_URI": "mongodb://localhost:27017"})
+class DeferredStartTest(unittest.TestCase):
+    def setUp(self):
+        import main
+
+        self.main = main
+        self.addCleanup(setattr, main, "_avvio_eseguito", False)
+        self.addCleanup(main.avvio_in_attesa.clear)
+
+    def test_first_request_starts_sync_once_after_responding(self):
+        self.main.avvio_in_attesa.set()
+        with patch.object(self.main, "start_background_sync") as start:
+            client = self.main.app.test_client()
+            for _ in range(2):
+                # Il server WSGI chiude la risposta dopo averla inviata
+                with client.get("/health") as response:
+                    self.assertEqual(response.status_code, 200)
+
+        start.assert_called_once_with()
+        self.assertFalse(self.main.avvio_in_attesa.is_set())
+
+    def test_timer_starts_sync_without_requests(self):
+        with patch.object(self.main, "start_background_sync") as start:
+            self.main.avvio_differito(0).join(5)
+
+        start.assert_called_once_with()
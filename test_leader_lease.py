@@ -0,0 +1,84 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock
+
+from pymongo.errors import AutoReconnect, DuplicateKeyError
+
+from leader_lease import LeaderLease
+
+
+class _Leases:
+    """Collection in memoria con la semantica dell'update condizionato con upsert."""
+
+    def __init__(self):
+        self.docs = {}
+        self.failing = False
+
+    def find_one_and_update(self, query, update, upsert, return_document):
+        if self.failing:
+            raise AutoReconnect("mongo giù")
+        doc = self.docs.get(query["_id"])
+        owner, now = query["$or"][0]["owner"], query["$or"][1]["expires_at"]["$lt"]
+        if doc is None or doc["owner"] == owner or doc["expires_at"] < now:
+            self.docs[query["_id"]] = dict(doc or {}, _id=query["_id"], **update["$set"])
+            return self.docs[query["_id"]]
+        raise DuplicateKeyError("E11000")
+
+    def delete_one(self, query):
+        if self.docs.get(query["_id"], {}).get("owner") == query["owner"]:
+            del self.docs[query["_id"]]
+
+    def find_one(self, query):
+        return self.docs.get(query["_id"])
+
+
+class LeaderLeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2025, 5, 1, 12, 0, tzinfo=timezone.utc)
+        self.leases = _Leases()
+
+    def _lease(self, owner, **callbacks):
+        return LeaderLease(self.leases, owner=owner, ttl=60, clock=lambda: self.now, **callbacks)
+
+    def test_only_one_owner_and_failover_after_expiry(self):
+        acquired, lost = Mock(), Mock()
+        first = self._lease("a", on_lost=lost)
+        standby = Mock()
+        second = self._lease("b", on_acquired=acquired, on_standby=standby)
+
+        self.assertTrue(first.try_acquire())
+        second.tick()
+        self.assertFalse(second.is_leader)
+        standby.assert_called_once()
+
+        # "a" smette di rinnovare: "b" subentra allo scadere del TTL
+        self.now += timedelta(seconds=61)
+        second.tick()
+        self.assertTrue(second.is_leader)
+        acquired.assert_called_once()
+        self.assertFalse(first.try_acquire())
+        lost.assert_called_once()
+        self.assertEqual(self.leases.find_one({"_id": "sync"})["owner"], "b")
+
+    def test_release_hands_over_immediately(self):
+        first, second = self._lease("a"), self._lease("b")
+        first.try_acquire()
+
+        first.release()
+
+        self.assertFalse(first.is_leader)
+        self.assertTrue(second.try_acquire())
+
+    def test_keeps_leadership_through_mongo_errors_until_the_lease_expires(self):
+        lease = self._lease("a")
+        lease.try_acquire()
+        self.leases.failing = True
+
+        self.now += timedelta(seconds=30)
+        self.assertTrue(lease.try_acquire())
+        self.now += timedelta(seconds=31)
+        self.assertFalse(lease.try_acquire())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+from unittest.mock import patch
+
+import metrics
+from metrics import Counter, Gauge, Histogram, Registry, timed
+
+
+class HistogramTest(unittest.TestCase):
+    def test_renders_cumulative_buckets_per_label(self):
+        histogram = Histogram("share_seconds", "Durata", labels=("operation",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 3.0):
+            histogram.observe(value, "fetch")
+        histogram.observe(0.2, "login")
+
+        text = histogram.render()
+
+        self.assertIn('share_seconds_bucket{operation="fetch",le="0.1"} 1', text)
+        self.assertIn('share_seconds_bucket{operation="fetch",le="1"} 2', text)
+        self.assertIn('share_seconds_bucket{operation="fetch",le="+Inf"} 3', text)
+        self.assertIn('share_seconds_count{operation="login"} 1', text)
+        self.assertIn("# TYPE share_seconds histogram", text)
+        with self.assertRaises(ValueError):
+            histogram.observe(1.0)
+
+
+class TimedTest(unittest.TestCase):
+    def test_decorator_and_context_manager_observe_durations(self):
+        histogram = Histogram("work_seconds", "Durata")
+
+        @timed(histogram)
+        def work():
+            raise RuntimeError("boom")
+
+        with self.assertRaises(RuntimeError):
+            work()
+        with timed(histogram):
+            pass
+
+        self.assertEqual(histogram.count(), 2)
+        self.assertEqual(work.__name__, "work")
+
+    def test_disabled_metrics_leave_functions_untouched(self):
+        histogram = Histogram("off_seconds", "Durata")
+
+        def work():
+            return 42
+
+        with patch.object(metrics, "ENABLED", False):
+            self.assertIs(timed(histogram)(work), work)
+            with timed(histogram):
+                pass
+        self.assertEqual(histogram.count(), 0)
+
+    def test_disabled_metrics_record_nothing(self):
+        histogram = Histogram("off_lag_seconds", "Ritardo")
+        counter = Counter("off_total", "Eventi", labels=("outcome",))
+        gauge = Gauge("off_queue", "Coda")
+
+        with patch.object(metrics, "ENABLED", False):
+            histogram.observe(1.5)
+            counter.inc("sent")
+            gauge.set(3)
+
+        self.assertEqual((histogram.count(), counter.value("sent"), gauge.value()), (0, 0, None))
+
+
+class RegistryTest(unittest.TestCase):
+    def test_gauges_read_callbacks_at_scrape_time(self):
+        registry = Registry()
+        threads = registry.register(Gauge("threads", "Thread", lambda: 7))
+        registry.register(Gauge("broken", "Errore", lambda: 1 / 0))
+        sent = registry.register(Counter("sent_total", "Inviate", labels=("outcome",)))
+        sent.inc("sent")
+        sent.inc("sent")
+
+        text = registry.render()
+
+        self.assertIs(registry.register(Gauge("threads", "altro")), threads)
+        self.assertIn("threads 7\n", text)
+        self.assertNotIn("broken ", text.replace("# HELP broken", "").replace("# TYPE broken", ""))
+        self.assertIn('sent_total{outcome="sent"} 2', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+import unittest
+from datetime import datetime
+from unittest.mock import Mock
+
+from pymongo import DeleteMany, UpdateOne
+from pymongo.errors import AutoReconnect, OperationFailure
+
+from nightscout_entries import UNIQUE_INDEX, EntryWriter, build_entry, ensure_indexes, iter_range
+
+
+class FakeCursor:
+    """Cursore pymongo minimale che registra sort/limit e chiusura."""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.calls = {}
+        self.closed = False
+
+    def sort(self, key, direction):
+        self.calls["sort"] = (key, direction)
+        return self
+
+    def batch_size(self, size):
+        self.calls["batch_size"] = size
+        return self
+
+    def limit(self, limit):
+        self.calls["limit"] = limit
+        self.docs = self.docs[:limit]
+        return self
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    def close(self):
+        self.closed = True
+
+
+class EntryWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = Mock()
+        self.writer = EntryWriter(self.collection)
+
+    def test_flushes_buffered_entries_as_upserts_keyed_on_device_and_date(self):
+        self.writer.add(build_entry(110, datetime(2025, 5, 1, 12, 5)))
+        self.writer.add(build_entry(108, datetime(2025, 5, 1, 12, 0)))
+        self.collection.bulk_write.return_value.upserted_count = 2
+        self.collection.bulk_write.return_value.upserted_ids = {0: "a", 1: "b"}
+
+        report = self.writer.flush()
+
+        first, second = (build_entry(108, datetime(2025, 5, 1, 12, 0)), build_entry(110, datetime(2025, 5, 1, 12, 5)))
+        self.assertEqual(self.collection.bulk_write.call_args.args[0], [
+            UpdateOne({"device": "dexcom-g7", "date": first["date"]}, {"$setOnInsert": first}, upsert=True),
+            UpdateOne({"device": "dexcom-g7", "date": second["date"]}, {"$setOnInsert": second}, upsert=True),
+        ])
+        self.assertEqual((report.inserted, report.deduped), (2, 0))
+        self.assertEqual([e["sgv"] for e in report.inserted_entries], [108, 110])
+
+    def test_counts_repeated_share_readings_as_deduped(self):
+        reading = build_entry(95, datetime(2025, 5, 1, 12, 0))
+        self.writer.add(reading)
+        self.writer.add(dict(reading))
+        self.collection.bulk_write.return_value.upserted_count = 0
+        self.collection.bulk_write.return_value.upserted_ids = {}
+
+        report = self.writer.flush()
+
+        self.assertEqual(len(self.collection.bulk_write.call_args.args[0]), 1)
+        self.assertEqual(report.deduped, 1)
+        self.assertEqual(self.writer.stats(), {"inserted": 0, "deduped": 2, "flushes": 1, "pending": 0})
+
+    def test_failed_flush_keeps_entries_for_the_next_attempt(self):
+        self.writer.add(build_entry(108, datetime(2025, 5, 1, 12, 0)))
+        self.collection.bulk_write.side_effect = AutoReconnect("primary cambiato")
+
+        with self.assertRaises(AutoReconnect):
+            self.writer.flush()
+        self.writer.add(build_entry(110, datetime(2025, 5, 1, 12, 5)))
+
+        self.assertEqual(self.writer.pending(), 2)
+        self.collection.bulk_write.side_effect = None
+        self.collection.bulk_write.return_value.upserted_count = 2
+        self.collection.bulk_write.return_value.upserted_ids = {0: "a", 1: "b"}
+        self.assertEqual(self.writer.flush().inserted, 2)
+        self.assertEqual(len(self.collection.bulk_write.call_args.args[0]), 2)
+
+    def test_empty_flush_does_not_touch_mongo(self):
+        self.assertEqual(self.writer.flush().written, 0)
+        self.collection.bulk_write.assert_not_called()
+
+    def test_removes_existing_duplicates_before_creating_the_unique_index(self):
+        created = []
+
+        def create_index(keys, name, unique=False):
+            if name == UNIQUE_INDEX and not created:
+                created.append(name)
+                raise OperationFailure("duplicate key", code=11000)
+
+        self.collection.create_index.side_effect = create_index
+        self.collection.aggregate.return_value = [{"ids": ["c", "a", "b"]}]
+        self.collection.bulk_write.return_value.deleted_count = 2
+
+        self.assertEqual(ensure_indexes(self.collection, remove_duplicates=True), 2)
+        self.assertEqual(self.collection.create_index.call_count, 3)
+        self.assertEqual(self.collection.bulk_write.call_args.args[0],
+                         [DeleteMany({"_id": {"$in": ["b", "c"]}})])
+
+    def test_keeps_duplicates_unless_removal_is_requested(self):
+        def create_index(keys, name, unique=False):
+            if name == UNIQUE_INDEX:
+                raise OperationFailure("duplicate key", code=11000)
+
+        self.collection.create_index.side_effect = create_index
+
+        with self.assertRaises(OperationFailure):
+            ensure_indexes(self.collection)
+        self.collection.aggregate.assert_not_called()
+        self.collection.bulk_write.assert_not_called()
+
+
+class IterRangeTest(unittest.TestCase):
+    def setUp(self):
+        self.docs = [{"_id": i, "sgv": 100 + i, "date": i * 60_000, "direction": "→"} for i in range(12)]
+        self.cursor = FakeCursor([dict(d) for d in self.docs])
+        self.collection = Mock()
+        self.collection.find.return_value = self.cursor
+
+    def test_projects_fields_and_pushes_the_limit_to_mongo(self):
+        rows = list(iter_range(self.collection, 0, 10**9, fields=["sgv"], after=120_000, limit=3))
+
+        query, projection = self.collection.find.call_args.args
+        self.assertEqual(query["date"], {"$gte": 0, "$lt": 10**9, "$gt": 120_000})
+        self.assertEqual(projection, {"sgv": 1, "date": 1, "_id": 0})
+        self.assertEqual(self.cursor.calls["sort"], ("date", 1))
+        self.assertEqual(self.cursor.calls["limit"], 3)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0][0], 0)
+        self.assertNotIn("date", rows[0][1])
+        self.assertTrue(self.cursor.closed)
+
+    def test_downsamples_to_the_first_reading_of_each_step(self):
+        rows = list(iter_range(self.collection, 0, 10**9, step_ms=5 * 60_000, limit=2))
+
+        self.assertEqual([date for date, _ in rows], [0, 300_000])
+        self.assertNotIn("limit", self.cursor.calls)
+        self.assertEqual(rows[0][1]["_id"], "0")
+
+
+    def test_downsampled_pages_do_not_repeat_the_step_of_the_cursor(self):
+        docs = [{"sgv": 100 + i, "date": i * 60_000} for i in range(20)]
+        self.collection.find.side_effect = lambda query, projection: FakeCursor(
+            [dict(d) for d in docs if d["date"] > query["date"].get("$gt", -1)])
+
+        first = list(iter_range(self.collection, 0, 10**9, step_ms=5 * 60_000, limit=2))
+        second = list(iter_range(self.collection, 0, 10**9, after=first[-1][0], step_ms=5 * 60_000, limit=2))
+
+        self.assertEqual([date for date, _ in first], [0, 300_000])
+        self.assertEqual([date for date, _ in second], [600_000, 900_000])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+import unittest
+from unittest.mock import Mock
+
+from pymongo.errors import ServerSelectionTimeoutError
+
+from outbox import Outbox, OutboxItem, SheetSink, SupabaseSink
+
+try:
+    import mongomock
+except ImportError:  # mongomock è facoltativo, come per bench_load.py
+    mongomock = None
+
+
+class _Sink:
+    def __init__(self, batch_size=50, failures=0):
+        self.batch_size = batch_size
+        self.failures = failures
+        self.batches = []
+
+    def send(self, items):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Supabase non raggiungibile")
+        self.batches.append([(item.key, dict(item.payload)) for item in items])
+
+
+@unittest.skipIf(mongomock is None, "mongomock non installato")
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1_000_000.0
+        self.collection = mongomock.MongoClient().nightscout.outbox
+
+    def _outbox(self, **sinks):
+        outbox = Outbox(self.collection, sinks, backoff_base=5, max_attempts=3, clock=lambda: self.now)
+        outbox._ensure_started = lambda: None  # consegna guidata dal test con drain_once
+        return outbox
+
+    def test_merges_fields_by_key_and_sends_one_batch_per_sink(self):
+        supabase, sheet = _Sink(), _Sink()
+        outbox = self._outbox(supabase=supabase, sheet=sheet)
+
+        outbox.append("supabase", 7, {"t1": 130.0})
+        outbox.append("supabase", 7, {"t2": 132.0})
+        outbox.append("supabase", 8, {"t1": 101.0})
+        outbox.append("sheet", "a", {"glicemia": 120})
+
+        self.assertEqual(outbox.backlog()["supabase"]["pending"], 2)
+        self.assertEqual(outbox.drain_once(), 3)
+        self.assertEqual(supabase.batches, [[("7", {"t1": 130.0, "t2": 132.0}), ("8", {"t1": 101.0})]])
+        self.assertEqual(sheet.batches, [[("a", {"glicemia": 120})]])
+        self.assertEqual(self.collection.count_documents({}), 0)
+
+    def test_splits_the_backlog_into_batches(self):
+        sink = _Sink(batch_size=2)
+        outbox = self._outbox(supabase=sink)
+        for meal in range(5):
+            outbox.append("supabase", meal, {"t1": 100 + meal})
+
+        self.assertEqual(outbox.drain_once(), 5)
+
+        self.assertEqual([len(batch) for batch in sink.batches], [2, 2, 1])
+        self.assertEqual(outbox.stats()["batches"], 3)
+
+    def test_retries_with_backoff_then_marks_as_failed(self):
+        sink = _Sink(failures=3)
+        outbox = self._outbox(supabase=sink)
+        outbox.append("supabase", 7, {"t1": 130.0})
+
+        self.assertEqual(outbox.drain_once(), 0)
+        self.now += 4
+        self.assertEqual(outbox.drain_once(), 0)  # backoff di 5 secondi non ancora trascorso
+        self.now += 1
+        outbox.drain_once()
+        self.now += 10
+        outbox.drain_once()
+
+        doc = self.collection.find_one({"_id": "supabase:7"})
+        self.assertEqual((doc["attempts"], doc["failed"]), (3, True))
+        self.assertEqual(outbox.backlog()["supabase"], {"pending": 0, "failed": 1, "oldest_seconds": None})
+        self.now += 3600
+        self.assertEqual(outbox.drain_once(), 0)
+
+    def test_new_fields_give_a_failed_entry_all_its_attempts_again(self):
+        sink = _Sink(failures=4)
+        outbox = self._outbox(supabase=sink)
+        outbox.append("supabase", 7, {"t1": 130.0})
+        for _ in range(3):
+            outbox.drain_once()
+            self.now += 60
+
+        outbox.append("supabase", 7, {"t2": 132.0})
+        outbox.drain_once()
+
+        doc = self.collection.find_one({"_id": "supabase:7"})
+        self.assertEqual((doc["attempts"], doc["failed"]), (1, False))
+        self.now += 60
+        self.assertEqual(outbox.drain_once(), 1)
+        self.assertEqual(sink.batches[-1], [("7", {"t1": 130.0, "t2": 132.0})])
+
+    def test_fields_appended_during_delivery_are_sent_next(self):
+        outbox = self._outbox(supabase=None)
+
+        class _Racing(_Sink):
+            def send(self, items):
+                super().send(items)
+                if len(self.batches) == 1:
+                    outbox.append("supabase", 7, {"t2": 132.0})
+
+        sink = outbox.sinks["supabase"] = _Racing()
+        outbox.append("supabase", 7, {"t1": 130.0})
+
+        outbox.drain_once()
+        outbox.drain_once()
+
+        self.assertEqual(sink.batches, [[("7", {"t1": 130.0})], [("7", {"t1": 130.0, "t2": 132.0})]])
+        self.assertEqual(self.collection.count_documents({}), 0)
+
+    def test_claimed_entries_are_not_sent_by_another_process(self):
+        first, second = _Sink(), _Sink()
+        outbox = self._outbox(supabase=first)
+        other = self._outbox(supabase=second)
+        outbox.append("supabase", 7, {"t1": 130.0})
+
+        claimed = outbox._claim("supabase", 50, self.now)
+
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(other.drain_once(), 0)
+        self.now += 61  # lease scaduto: il processo che l'aveva preso è morto
+        self.assertEqual(other.drain_once(), 1)
+
+
+class OutboxFallbackTest(unittest.TestCase):
+    def test_sends_directly_when_mongo_is_unavailable(self):
+        collection = Mock()
+        collection.update_one.side_effect = ServerSelectionTimeoutError("mongo giù")
+        sink = _Sink()
+        outbox = Outbox(collection, {"supabase": sink})
+
+        self.assertFalse(outbox.append("supabase", 7, {"t1": 130.0}))
+
+        self.assertEqual(sink.batches, [[("7", {"t1": 130.0})]])
+        self.assertIsNone(outbox._thread)
+
+
+class OutboxWithoutMongoTest(unittest.TestCase):
+    def test_sends_directly_and_never_starts_the_drainer(self):
+        sink = _Sink()
+        outbox = Outbox(None, {"sheet": sink})
+
+        outbox.start()
+        self.assertFalse(outbox.append("sheet", "a", {"glicemia": 120}))
+
+        self.assertEqual(sink.batches, [[("a", {"glicemia": 120})]])
+        self.assertIsNone(outbox._thread)
+        self.assertIsNone(outbox.stats()["backlog"])
+
+
+@unittest.skipIf(mongomock is None, "mongomock non installato")
+class OutboxStartTest(unittest.TestCase):
+    def test_start_drains_entries_left_by_a_previous_process(self):
+        collection = mongomock.MongoClient().nightscout.outbox
+        previous = Outbox(collection, {"supabase": _Sink()})
+        previous._ensure_started = lambda: None
+        previous.append("supabase", 7, {"t1": 130.0})
+
+        sink = _Sink()
+        outbox = Outbox(collection, {"supabase": sink}, interval=0.05)
+        self.addCleanup(outbox.stop)
+        outbox.start()
+
+        self.assertTrue(outbox.flush(5))
+        self.assertEqual(sink.batches, [[("7", {"t1": 130.0})]])
+
+
+class SinkTest(unittest.TestCase):
+    def test_supabase_patches_existing_rows_grouped_by_payload(self):
+        session = Mock()
+        sink = SupabaseSink("https://x.supabase.co/", "KEY", "analisi_dati", session=session)
+
+        sink.send([OutboxItem("7", {"t1": 130.0, "t2": 132.0}), OutboxItem("8", {"t1": 101.0}),
+                   OutboxItem("9", {"t2": 132.0, "t1": 130.0})])
+
+        session.post.assert_not_called()
+        self.assertEqual(session.patch.call_count, 2)
+        first, second = session.patch.call_args_list
+        self.assertEqual(first.args[0], "https://x.supabase.co/rest/v1/analisi_dati")
+        self.assertEqual(first.kwargs["params"], {"id": "in.(7,9)"})
+        self.assertEqual(first.kwargs["json"], {"t1": 130.0, "t2": 132.0})
+        self.assertEqual((second.kwargs["params"], second.kwargs["json"]), ({"id": "eq.8"}, {"t1": 101.0}))
+        self.assertEqual(first.kwargs["headers"]["Prefer"], "return=minimal")
+
+    def test_sheet_posts_one_object_per_row_by_default(self):
+        session = Mock()
+        sink = SheetSink("https://script.google.com/exec", session=session)
+
+        sink.send([OutboxItem("a", {"glicemia": 120}), OutboxItem("b", {"glicemia": 118})])
+
+        self.assertEqual([c.kwargs["json"] for c in session.post.call_args_list],
+                         [{"glicemia": 120}, {"glicemia": 118}])
+
+    def test_sheet_posts_a_list_only_when_batching_is_enabled(self):
+        session = Mock()
+        sink = SheetSink("https://script.google.com/exec", session=session, batch_size=20)
+
+        sink.send([OutboxItem("a", {"glicemia": 120}), OutboxItem("b", {"glicemia": 118})])
+
+        self.assertEqual([c.kwargs["json"] for c in session.post.call_args_list],
+                         [[{"glicemia": 120}, {"glicemia": 118}]])
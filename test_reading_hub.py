@@ -0,0 +1,75 @@
+import threading
+import time
+import unittest
+
+from reading_hub import HubFull, ReadingHub, format_event, max_subscribers_for, sse_stream
+
+
+class ReadingHubTest(unittest.TestCase):
+    def test_subscriber_limit_leaves_threads_for_other_requests(self):
+        self.assertEqual(max_subscribers_for(8), 6)
+        self.assertEqual(max_subscribers_for(8, requested=4), 4)
+        self.assertEqual(max_subscribers_for(32, requested=20), 20)
+        self.assertEqual(max_subscribers_for(2), 1)
+
+    def test_wakes_a_waiting_subscriber_as_soon_as_a_reading_is_published(self):
+        hub = ReadingHub()
+        received = []
+
+        def listen():
+            started = time.monotonic()
+            received.append((hub.wait(0, timeout=5), time.monotonic() - started))
+
+        listener = threading.Thread(target=listen)
+        listener.start()
+        time.sleep(0.05)
+        hub.publish(1000, {"sgv": 100})
+        listener.join(5)
+
+        events, waited = received[0]
+        self.assertEqual(events, [(1000, {"sgv": 100})])
+        self.assertLess(waited, 1)
+
+    def test_ignores_out_of_order_events_and_keeps_a_bounded_backlog(self):
+        hub = ReadingHub(backlog=2)
+        for event_id in (1, 2, 2, 3):
+            hub.publish(event_id, {})
+
+        self.assertEqual(hub.published, 3)
+        self.assertEqual((hub.oldest_id(), hub.latest_id()), (2, 3))
+        self.assertEqual([e for e, _ in hub.wait(1, timeout=0)], [2, 3])
+
+    def test_caps_subscribers(self):
+        hub = ReadingHub(max_subscribers=1)
+        hub.subscribe()
+        with self.assertRaises(HubFull):
+            hub.subscribe()
+        hub.unsubscribe()
+        hub.subscribe()
+
+
+class SseStreamTest(unittest.TestCase):
+    def test_replays_backfill_then_live_events_with_heartbeats(self):
+        hub = ReadingHub()
+        hub.publish(300, {"sgv": 103})
+        stream = sse_stream(hub, 100, backfill=iter([(200, {"sgv": 102})]), heartbeat=0.01)
+
+        chunks = [next(stream) for _ in range(4)]
+
+        self.assertEqual(chunks[0], "retry: 5000\n\n")
+        self.assertEqual(chunks[1], format_event(200, {"sgv": 102}))
+        self.assertEqual(chunks[2], 'id: 300\nevent: reading\ndata: {"sgv": 103}\n\n')
+        self.assertEqual(chunks[3], ": heartbeat\n\n")
+
+    def test_new_client_starts_from_the_latest_reading(self):
+        hub = ReadingHub()
+        hub.publish(100, {"sgv": 90})
+        hub.publish(200, {"sgv": 95})
+        stream = sse_stream(hub, None, heartbeat=0.01)
+        next(stream)
+
+        self.assertEqual(next(stream), format_event(200, {"sgv": 95}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram_notifier import TelegramNotifier
+
+
+class _StubTelegram(BaseHTTPRequestHandler):
+    """Risponde come l'API Bot di Telegram; la prima richiesta per chat riceve 429/500."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, body))
+            attempts = server.attempts[body["chat_id"]] = server.attempts.get(body["chat_id"], 0) + 1
+        failure = server.failures.get(body["chat_id"])
+        if failure and attempts == 1:
+            status, payload = failure
+        else:
+            status, payload = 200, {"ok": True}
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TelegramNotifierTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _StubTelegram)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.attempts = {}
+        self.server.failures = {}
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def _notifier(self, chat_ids, **kwargs):
+        notifier = TelegramNotifier("TOKEN", chat_ids, api_url=f"http://127.0.0.1:{self.server.server_port}",
+                                    backoff_base=0.01, **kwargs)
+        self.addCleanup(notifier.stop)
+        return notifier
+
+    def test_delivers_to_every_chat_and_records_latency(self):
+        notifier = self._notifier(["1", "2", "3"])
+
+        self.assertTrue(notifier.send("🚨 Discesa rapida"))
+        self.assertTrue(notifier.flush(5))
+
+        self.assertEqual(sorted(body["chat_id"] for _, body in self.server.requests), ["1", "2", "3"])
+        self.assertEqual(self.server.requests[0][0], "/botTOKEN/sendMessage")
+        stats = notifier.stats()
+        self.assertEqual((stats["sent"], stats["failed"]), (3, 0))
+        self.assertIn("latency_p95_ms", stats)
+
+    def test_per_message_targets_replace_the_default_chats(self):
+        notifier = self._notifier(["1"])
+
+        self.assertTrue(notifier.send("altro account", chat_ids=["8", "9"]))
+        self.assertFalse(notifier.send("nessun destinatario", chat_ids=[]))
+        notifier.flush(5)
+
+        self.assertEqual(sorted(body["chat_id"] for _, body in self.server.requests), ["8", "9"])
+
+    def test_retries_rate_limits_and_server_errors(self):
+        self.server.failures = {
+            "1": (429, {"ok": False, "parameters": {"retry_after": 0.01}}),
+            "2": (502, {"ok": False}),
+        }
+        notifier = self._notifier(["1", "2"])
+
+        notifier.send("test")
+        notifier.flush(5)
+
+        stats = notifier.stats()
+        self.assertEqual((stats["sent"], stats["retries"], stats["failed"]), (2, 2, 0))
+
+    def test_retry_after_is_capped_by_the_maximum_backoff(self):
+        self.server.failures = {"1": (429, {"ok": False, "parameters": {"retry_after": 3600}})}
+        notifier = self._notifier(["1"], backoff_max=0.05)
+
+        notifier.send("test")
+
+        self.assertTrue(notifier.flush(5))
+        self.assertEqual((notifier.stats()["sent"], notifier.stats()["retries"]), (1, 1))
+
+    def test_client_errors_are_not_retried(self):
+        self.server.failures = {"1": (400, {"ok": False, "description": "chat not found"})}
+        notifier = self._notifier(["1"])
+
+        notifier.send("test")
+        notifier.flush(5)
+
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(notifier.stats()["failed"], 1)
+
+    def test_full_queue_drops_instead_of_blocking_the_caller(self):
+        notifier = self._notifier(["1"], max_queue=1)
+        notifier._thread = threading.Thread()  # nessun consumatore: la coda resta piena
+
+        self.assertTrue(notifier.send("uno"))
+        self.assertFalse(notifier.send("due"))
+        self.assertEqual(notifier.stats()["dropped"], 1)
+
+    def test_without_token_nothing_is_queued(self):
+        self.assertFalse(TelegramNotifier(None, ["1"]).send("test"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
-from main import app, start_background_sync
+from main import app, avvio_differito
 
-start_background_sync()
+# La sincronizzazione parte dopo la prima richiesta (o SYNC_START_DELAY secondi)
+avvio_differito()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5001)